@@ -0,0 +1,104 @@
+"""
+Benchmarks the cold-start time of predicting a slate of games in a fresh python process:
+unpickling the sklearn model through predict_game_outcomes.py (which imports pandas,
+sklearn and requests) against predict_fast.py (json artifact and numpy only). Both score
+from the same team state snapshot, built from synthetic data in a temporary directory.
+Run from the repo root with
+
+    python -m benchmarks.bench_cold_start
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import subprocess
+import sqlite3
+import pickle
+import sys
+import os
+from sklearn.linear_model import LogisticRegression
+
+from scripts.process_feed_data import process_season_feed_data
+from scripts.features import WEIGHT_PREV_SEASON, materialize_team_baselines
+from scripts.build_ml_dataset import build_season_features
+from scripts.team_state import build_team_state, save_team_state
+from scripts.model_artifact import export_model_artifact
+from scripts.predict_game_outcomes import PATH_MODEL, MODEL_FEATURES
+from benchmarks.synthetic import create_synthetic_db
+
+PATH_REPO = Path.cwd()
+SEASONS = [2018, 2019]
+GAMES = [(1, 2), (3, 4), (5, 6), (7, 8)] ## (home, away) franchise ids
+REPEATS = 5
+
+## the old path: predict_game_outcomes.py's snapshot prediction with the pickled model
+SCRIPT_PICKLE = f"""
+import pickle
+import pandas as pd
+from scripts.predict_game_outcomes import PATH_MODEL, predict_games_from_snapshot
+from scripts.team_state import load_team_state_snapshot
+df_games = pd.DataFrame({{'game_id': range({len(GAMES)}), 'home_id': {[home for home, _ in GAMES]}, 'away_id': {[away for _, away in GAMES]},
+                         'home_team': '', 'away_team': ''}})
+df = predict_games_from_snapshot(df_games, load_team_state_snapshot(), pickle.load(open(PATH_MODEL, 'rb')))
+print(' '.join(str(prob) for prob in df['home_prob']))
+"""
+
+## the new path: predict_fast.py
+SCRIPT_FAST = f"""
+from scripts.predict_fast import predict_fast
+print(' '.join(str(round(100 * prob, 1)) for prob in predict_fast({[home for home, _ in GAMES]}, {[away for _, away in GAMES]})))
+"""
+
+## FUNCTIONS ##
+
+def time_cold_start(script):
+
+    """
+    Returns the best wall time of REPEATS fresh python processes running script, and its output.
+    """
+
+    env = dict(os.environ, PYTHONPATH = str(PATH_REPO))
+    timings = []
+    for _ in range(REPEATS):
+        start = perf_counter()
+        output = subprocess.run([sys.executable, '-c', script], env = env, capture_output = True, text = True, check = True).stdout
+        timings.append(perf_counter() - start)
+
+    return min(timings), output.strip()
+
+
+## SCRIPT ##
+
+if __name__ == "__main__":
+
+    with TemporaryDirectory() as path_tmp:
+
+        ## the scripts read and write relative to the working directory
+        os.chdir(path_tmp)
+        os.symlink(PATH_REPO/'queries', 'queries')
+
+        conn = sqlite3.connect(':memory:')
+        cursor = conn.cursor()
+        create_synthetic_db(conn, cursor, SEASONS)
+        for season in SEASONS:
+            process_season_feed_data(season, conn, cursor)
+        df_baselines = materialize_team_baselines(conn, cursor)
+        save_team_state(build_team_state(conn, SEASONS[-1]))
+
+        df = build_season_features(SEASONS[-1], conn, df_baselines)
+        model = LogisticRegression().fit(df[MODEL_FEATURES], df['home_win'].astype('int'))
+        PATH_MODEL.parent.mkdir(parents = True, exist_ok = True)
+        pickle.dump(model, open(PATH_MODEL, 'wb'))
+        export_model_artifact(model, MODEL_FEATURES, 0.539, weight_previous_season = WEIGHT_PREV_SEASON)
+
+        time_pickle, output_pickle = time_cold_start(SCRIPT_PICKLE)
+        time_fast, output_fast = time_cold_start(SCRIPT_FAST)
+
+        os.chdir(PATH_REPO)
+
+    print(f'{len(GAMES)} games, best of {REPEATS} fresh processes')
+    print(f'pickled sklearn model: {1000 * time_pickle:.0f}ms -> {output_pickle}')
+    print(f'json artifact + numpy: {1000 * time_fast:.0f}ms -> {output_fast}')
+    print(f'{time_pickle / time_fast:.1f}x faster cold start, same predictions: {output_pickle == output_fast}')
@@ -0,0 +1,85 @@
+"""
+Benchmarks loading the training data from the columnar feature store against parsing the
+old csv handoff, on a full 10-season mlfeatures table built from synthetic data. Loads are
+timed for the whole table and for what train_model.py actually reads (three columns of the
+training seasons). Run from the repo root with
+
+    python -m benchmarks.bench_feature_store
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import sqlite3
+import pandas as pd
+
+from scripts.process_feed_data import process_season_feed_data
+from scripts.features import materialize_team_baselines
+from scripts.build_ml_dataset import TRAINING_SEASONS, build_season_features, write_season_features
+from scripts.feature_store import export_feature_store, load_features
+from benchmarks.synthetic import create_synthetic_db
+
+SEASONS = list(range(2010, 2021))
+FEATURE_SEASONS = SEASONS[1:]
+TRAINING_COLUMNS = ['season', 'wins_per_game_home', 'wins_per_game_away', 'home_win']
+REPEATS = 5
+
+## FUNCTIONS ##
+
+def time_load(load):
+
+    """
+    Returns the best time of REPEATS calls of load.
+    """
+
+    timings = []
+    for _ in range(REPEATS):
+        start = perf_counter()
+        load()
+        timings.append(perf_counter() - start)
+
+    return min(timings)
+
+def directory_size(path):
+
+    """
+    Returns the total size in bytes of the files under path.
+    """
+
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+
+
+## SCRIPT ##
+
+if __name__ == "__main__":
+
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    create_synthetic_db(conn, cursor, SEASONS)
+    for season in SEASONS:
+        process_season_feed_data(season, conn, cursor)
+
+    df_baselines = materialize_team_baselines(conn, cursor)
+    for season in FEATURE_SEASONS:
+        write_season_features(build_season_features(season, conn, df_baselines), season, conn, cursor)
+
+    with TemporaryDirectory() as path_tmp:
+
+        path_csv = Path(path_tmp)/'dataset.csv'
+        path_store = Path(path_tmp)/'feature_store'
+        pd.read_sql_query('SELECT * FROM mlfeatures', conn).to_csv(path_csv, index = False)
+        version = export_feature_store(conn, FEATURE_SEASONS, path_store)
+
+        n_rows = load_features(['season'], path = path_store).shape[0]
+        print(f'{len(FEATURE_SEASONS)} seasons, {n_rows} rows (csv {path_csv.stat().st_size / 1e6:.1f} MB, '
+              f'store {directory_size(path_store) / 1e6:.1f} MB)')
+
+        loads = {'all columns, all seasons': (lambda: pd.read_csv(path_csv),
+                                              lambda: load_features(path = path_store)),
+                 'training columns and seasons': (lambda: pd.read_csv(path_csv, usecols = TRAINING_COLUMNS).pipe(lambda df: df[df['season'].isin(TRAINING_SEASONS)]),
+                                                  lambda: load_features(TRAINING_COLUMNS, TRAINING_SEASONS, path = path_store))}
+        for label, (load_csv, load_store) in loads.items():
+            time_csv, time_store = time_load(load_csv), time_load(load_store)
+            print(f'{label}: csv {1000 * time_csv:.1f}ms, feature store {1000 * time_store:.1f}ms ({time_csv / time_store:.0f}x)')
@@ -0,0 +1,85 @@
+"""
+Benchmarks the mlfeatures write stage of build_ml_dataset.py on a full 10-season rebuild
+of synthetic data, comparing the old per-row loop (a linear membership scan and one
+execute_query per row) against the batched, hash-diffed write_season_features. Run from
+the repo root with
+
+    python -m benchmarks.bench_mlfeatures
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from time import perf_counter
+import sqlite3
+import pandas as pd
+
+from scripts.helper import execute_query
+from scripts.process_feed_data import process_season_feed_data
+from scripts.features import materialize_team_baselines
+from scripts.build_ml_dataset import build_season_features, write_season_features
+from benchmarks.synthetic import create_synthetic_db
+
+PATH_QUERIES = Path('queries')
+SEASONS = list(range(2010, 2021))
+FEATURE_SEASONS = SEASONS[1:]
+
+## FUNCTIONS ##
+
+def write_features_per_row(df, season, conn, cursor):
+
+    """
+    The old write stage: scan the season's existing game ids for each row and insert rows one at a time.
+    """
+
+    execute_query(PATH_QUERIES / 'create_table_mlfeatures', cursor)
+    df_mlfeatures = pd.read_sql_query(f'SELECT * from mlfeatures WHERE season = {season}', conn)
+    for row in df.iterrows():
+        if row[1]['game_id'] not in df_mlfeatures['game_id'].values:
+            game_dict = dict(row[1])
+            execute_query(PATH_QUERIES / 'insert_or_ignore_entry', cursor,
+                          values = tuple(game_dict.values()),
+                          replacements = {'xtablex' : 'mlfeatures',
+                                          'xkeysx': ', '.join(list(game_dict.keys())),
+                                          'xvaluesx': '(' + ', '.join(['?'] * len(game_dict.keys())) + ')'})
+    conn.commit()
+
+def time_rebuild(writer, season_features, conn, cursor):
+
+    """
+    Writes every season's features twice (a rebuild into an empty table, then a re-run over
+    a full table) and returns the time taken by each pass.
+    """
+
+    cursor.execute('DROP TABLE IF EXISTS mlfeatures')
+    timings = []
+    for _ in range(2):
+        start = perf_counter()
+        for season, df in season_features.items():
+            writer(df, season, conn, cursor)
+        timings.append(perf_counter() - start)
+
+    return timings
+
+
+## SCRIPT ##
+
+if __name__ == "__main__":
+
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    create_synthetic_db(conn, cursor, SEASONS)
+    for season in SEASONS:
+        process_season_feed_data(season, conn, cursor)
+
+    df_baselines = materialize_team_baselines(conn, cursor)
+    season_features = {season: build_season_features(season, conn, df_baselines) for season in FEATURE_SEASONS}
+    n_rows = sum([df.shape[0] for df in season_features.values()])
+
+    timings_old = time_rebuild(write_features_per_row, season_features, conn, cursor)
+    timings_new = time_rebuild(lambda df, season, conn, cursor: write_season_features(df, season, conn, cursor, replace_changed = True),
+                               season_features, conn, cursor)
+
+    print(f'{len(FEATURE_SEASONS)} seasons, {n_rows} rows')
+    for label, i in [('rebuild into empty table', 0), ('re-run over full table', 1)]:
+        print(f'{label}: per-row loop {timings_old[i]:.2f}s, batched {timings_new[i]:.2f}s ({timings_old[i] / timings_new[i]:.0f}x)')
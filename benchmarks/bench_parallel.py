@@ -0,0 +1,96 @@
+"""
+Benchmarks a full rebuild (processing every season, then building every season's features)
+serially and in the season-parallel mode of process_feed_data.py and build_ml_dataset.py,
+with a range of worker counts. Each run starts from the same (seeded) synthetic db, and
+the resulting mlfeatures tables are checked to be identical. Wall time should scale with
+the number of cores, up to the number of seasons. Run from the repo root with
+
+    python -m benchmarks.bench_parallel [--teams 31] [--seasons 11] [--workers 1 2 4]
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import argparse
+import os
+import pandas as pd
+
+from scripts.helper import create_database_connection
+from scripts.process_feed_data import process_season_feed_data, process_seasons_parallel
+from scripts.features import materialize_team_baselines
+from scripts.build_ml_dataset import build_season_features, write_season_features, build_seasons_parallel
+from benchmarks.synthetic import create_synthetic_db
+
+FIRST_SEASON = 2010
+
+## FUNCTIONS ##
+
+def rebuild(path_db, seasons, workers):
+
+    """
+    Processes and builds every season of the db, returning the wall time of each step and a
+    hash of the resulting mlfeatures table.
+    """
+
+    conn, cursor = create_database_connection(path_db)
+
+    start = perf_counter()
+    if workers == 1:
+        for season in seasons:
+            process_season_feed_data(season, conn, cursor)
+    else:
+        process_seasons_parallel(seasons, conn, cursor, path_db, workers, full = True)
+    time_process = perf_counter() - start
+
+    start = perf_counter()
+    df_baselines = materialize_team_baselines(conn, cursor)
+    if workers == 1:
+        for season in seasons[1:]:
+            write_season_features(build_season_features(season, conn, df_baselines), season, conn, cursor)
+    else:
+        build_seasons_parallel(seasons[1:], conn, cursor, df_baselines, path_db, workers)
+    time_build = perf_counter() - start
+
+    df = pd.read_sql_query('SELECT * FROM mlfeatures ORDER BY game_id', conn)
+    conn.close()
+
+    return time_process, time_build, pd.util.hash_pandas_object(df, index = False).sum()
+
+
+## SCRIPT ##
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Full rebuild time, serial against season-parallel.')
+    parser.add_argument('--teams', type = int, default = 31, help = 'number of teams in the synthetic league')
+    parser.add_argument('--seasons', type = int, default = 11)
+    parser.add_argument('--workers', type = int, nargs = '+', default = [1, 2, 4])
+    args = parser.parse_args()
+
+    seasons = list(range(FIRST_SEASON, FIRST_SEASON + args.seasons))
+    cwd = os.getcwd()
+
+    with TemporaryDirectory() as path_tmp:
+
+        ## the team state snapshot is written relative to the working directory
+        os.chdir(path_tmp)
+        os.symlink(Path(cwd)/'queries', 'queries')
+
+        results = {}
+        for workers in args.workers:
+            path_db = Path(path_tmp)/f'workers_{workers}.db'
+            conn, cursor = create_database_connection(path_db)
+            n_games = create_synthetic_db(conn, cursor, seasons, n_teams = args.teams)
+            conn.close()
+            results[workers] = rebuild(path_db, seasons, workers)
+
+        os.chdir(cwd)
+
+    print(f'{len(seasons)} seasons, {args.teams} teams, {n_games} games, {os.cpu_count()} cpus')
+    time_serial = sum(results[args.workers[0]][:2])
+    for workers, (time_process, time_build, hash_features) in results.items():
+        print(f'{workers:2d} workers: process {time_process:6.2f}s  build {time_build:6.2f}s  '
+              f'total {time_process + time_build:6.2f}s ({time_serial / (time_process + time_build):4.1f}x)  '
+              f'same features: {hash_features == results[args.workers[0]][2]}')
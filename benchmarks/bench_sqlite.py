@@ -0,0 +1,112 @@
+"""
+Reports the latency of the pipeline's hot read queries on a file db built from synthetic
+data, before (bare connection, only the UNIQUE constraints) and after migrate_database
+(covering indexes, ANALYZE) with the connection pragmas of create_database_connection.
+The query plan used after migrating is printed with each query. Run from the repo root with
+
+    python -m benchmarks.bench_sqlite [--teams 31]
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import argparse
+import os
+
+from scripts.helper import create_database_connection, migrate_database
+from scripts.process_feed_data import process_season_feed_data
+from scripts.features import materialize_team_baselines
+from scripts.build_ml_dataset import build_season_features, write_season_features
+from benchmarks.synthetic import create_synthetic_db
+
+SEASONS = list(range(2010, 2021))
+SEASON = 2019 ## season the per-season queries filter on
+REPEATS = 5
+
+## the pipeline's read queries, as issued by process_feed_data.py, features.py and build_ml_dataset.py
+QUERIES = {
+    'process: season games': f'SELECT * FROM boxscore WHERE season = {SEASON} AND game_type IN (2,3)',
+    'incremental: unprocessed games': f"""SELECT * FROM boxscore WHERE season = {SEASON} AND game_type IN (2,3)
+                                          AND game_id NOT IN (SELECT game_id FROM boxscore_processed WHERE season = {SEASON})""",
+    'incremental: last team rows': f"""SELECT t.* FROM boxscore_processed_team t
+                                       JOIN (SELECT franchise_id, MAX(games_played_after) AS games_played_after FROM boxscore_processed_team
+                                             WHERE season = {SEASON} AND franchise_id IN (1, 2, 3, 4) GROUP BY franchise_id) m
+                                       ON t.franchise_id = m.franchise_id AND t.games_played_after = m.games_played_after
+                                       WHERE t.season = {SEASON}""",
+    'baselines: final team rows': """SELECT t.season, t.franchise_id, t.games_played_after, t.wins_after
+                                     FROM boxscore_processed_team t
+                                     JOIN (SELECT season, franchise_id, MAX(games_played_after) AS games_played_after
+                                           FROM boxscore_processed_team GROUP BY season, franchise_id) m
+                                     ON t.season = m.season AND t.franchise_id = m.franchise_id AND t.games_played_after = m.games_played_after""",
+    'baselines: season teams': 'SELECT DISTINCT season, home_franchise_id AS franchise_id FROM boxscore_processed',
+    'features: team state': f"""SELECT season, franchise_id, datetime, games_played_after, wins_after
+                                FROM boxscore_processed_team WHERE season IN ({SEASON})""",
+    'build: processed season': f'SELECT * FROM boxscore_processed WHERE season = {SEASON}',
+    'train: mlfeatures season': f'SELECT * FROM mlfeatures WHERE season = {SEASON}',
+}
+
+## FUNCTIONS ##
+
+def time_queries(cursor):
+
+    """
+    Returns the best time of REPEATS runs of each query.
+    """
+
+    timings = {}
+    for label, query in QUERIES.items():
+        best = float('inf')
+        for _ in range(REPEATS):
+            start = perf_counter()
+            cursor.execute(query).fetchall()
+            best = min(best, perf_counter() - start)
+        timings[label] = best
+
+    return timings
+
+
+## SCRIPT ##
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Query latency before and after the sqlite tuning.')
+    parser.add_argument('--teams', type = int, default = 31, help = 'number of teams in the synthetic league')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as path_tmp:
+
+        path_db = Path(path_tmp)/'nhl.db'
+
+        ## build the db with a bare connection, as before
+        conn, cursor = create_database_connection(path_db, pragmas = {})
+        create_synthetic_db(conn, cursor, SEASONS, n_teams = args.teams)
+        cwd = os.getcwd()
+        os.chdir(path_tmp) ## the team state snapshot is written relative to the working directory
+        os.symlink(Path(cwd)/'queries', 'queries')
+        for season in SEASONS:
+            process_season_feed_data(season, conn, cursor)
+        df_baselines = materialize_team_baselines(conn, cursor)
+        for season in SEASONS[1:]:
+            write_season_features(build_season_features(season, conn, df_baselines), season, conn, cursor)
+        timings_before = time_queries(cursor)
+        conn.close()
+
+        ## migrate, then reconnect with the tuned pragmas
+        conn, cursor = create_database_connection(path_db)
+        start = perf_counter()
+        indexes = migrate_database(conn, cursor)
+        time_migrate = perf_counter() - start
+        timings_after = time_queries(cursor)
+
+        plans = {label: ' | '.join(row[-1] for row in cursor.execute(f'EXPLAIN QUERY PLAN {query}').fetchall())
+                 for label, query in QUERIES.items()}
+        n_games = cursor.execute('SELECT COUNT(*) FROM boxscore').fetchone()[0]
+        conn.close()
+        os.chdir(cwd)
+
+    print(f'{len(SEASONS)} seasons, {args.teams} teams, {n_games} games; migration ({len(indexes)} indexes + ANALYZE) took {1000 * time_migrate:.0f}ms')
+    for label in QUERIES:
+        before, after = timings_before[label], timings_after[label]
+        print(f'{label:32s} before {1000 * before:8.2f}ms  after {1000 * after:8.2f}ms  ({before / after:5.1f}x)  {plans[label]}')
@@ -0,0 +1,66 @@
+"""
+Compares the write throughput (rows/sec) of the old stringified VALUES insert path
+against the parameterized executemany writer in scripts/helper.py, on a synthetic
+season of boxscore_processed_team rows. Run from the repo root with
+
+    python -m benchmarks.bench_writes
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from time import perf_counter
+import sqlite3
+
+from scripts.helper import execute_query, write_dataframe
+from scripts.process_feed_data import compute_team_game_stats
+from benchmarks.synthetic import generate_boxscore_season
+
+PATH_QUERIES = Path('queries')
+N_REPEATS = 5
+
+## FUNCTIONS ##
+
+def write_stringified(df, table, cursor):
+
+    """
+    The old insert path: one INSERT statement with every row pasted in as a stringified tuple.
+    """
+
+    execute_query(PATH_QUERIES/'insert_or_ignore_entry', cursor,
+                  replacements = {'xtablex' : table,
+                                  'xkeysx' : ', '.join(list(df.iloc[0].to_dict().keys())),
+                                  'xvaluesx' : ', '.join([str(tuple(row[1].to_dict().values())) for row in df.iterrows()])})
+
+def time_writer(writer, df, table, create_query):
+
+    """
+    Times a writer over N_REPEATS fresh in-memory dbs, returning the best rows/sec.
+    """
+
+    best = 0
+    for _ in range(N_REPEATS):
+        conn = sqlite3.connect(':memory:')
+        cursor = conn.cursor()
+        execute_query(PATH_QUERIES/create_query, cursor)
+        start = perf_counter()
+        writer(df, table, cursor)
+        conn.commit()
+        best = max(best, df.shape[0] / (perf_counter() - start))
+        conn.close()
+
+    return best
+
+
+## SCRIPT ##
+
+if __name__ == "__main__":
+
+    df_team_results = compute_team_game_stats(generate_boxscore_season(2019)).drop(columns = 'is_home')
+
+    rows_per_sec_old = time_writer(write_stringified, df_team_results, 'boxscore_processed_team', 'create_table_boxscore_processed_team')
+    rows_per_sec_new = time_writer(write_dataframe, df_team_results, 'boxscore_processed_team', 'create_table_boxscore_processed_team')
+
+    print(f'{df_team_results.shape[0]} rows x {df_team_results.shape[1]} columns')
+    print(f'stringified VALUES: {rows_per_sec_old:,.0f} rows/sec')
+    print(f'executemany:        {rows_per_sec_new:,.0f} rows/sec ({rows_per_sec_new / rows_per_sec_old:.1f}x)')
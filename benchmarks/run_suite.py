@@ -0,0 +1,207 @@
+"""
+Reproducible benchmark suite of the whole pipeline on a synthetic league of configurable
+size. Each stage runs in its own fresh python process, so its timing and peak memory
+(resource.getrusage) are measured in isolation:
+
+    extract   extract_boxscore_data over every game's live feed dict
+    process   process_season_feed_data for every season
+    build     the build_ml_dataset.py feature build (baselines, features, mlfeatures writes)
+    train     fitting the logistic model and exporting its artifact
+    predict   batch prediction of every game of the last season
+
+Stages run in order on one db in a temporary directory (each builds on the previous one).
+Results, with throughput and peak RSS per stage, are written to a json file for comparing
+runs. Run from the repo root with e.g.
+
+    python -m benchmarks.run_suite --teams 31 --games-per-team 82 --seasons 5
+    python -m benchmarks.run_suite --scale 10  ## 10x the league size
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from datetime import datetime, timezone
+from time import perf_counter
+import subprocess
+import platform
+import resource
+import argparse
+import json
+import sys
+import os
+
+PATH_REPO = Path.cwd()
+PATH_RESULTS = Path('benchmarks/results')
+PATH_DB = Path('data/raw/nhl.db')
+
+STAGES = ['extract', 'process', 'build', 'train', 'predict']
+FIRST_SEASON = 2010
+
+## FUNCTIONS ##
+
+def get_peak_rss_mb():
+
+    """
+    Returns the peak resident set size of this process so far, in MB.
+    """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ## kilobytes on linux
+
+def run_stage(stage, seasons, n_teams, games_per_team):
+
+    """
+    Runs one stage against the db in the working directory (in a child process).
+
+    :param stage: name of the stage
+    :param seasons: list of seasons
+    :param n_teams: number of teams in the league
+    :param games_per_team: number of games played by each team per season
+    :return: dict with the stage's wall time, number of items processed and peak rss
+    """
+
+    ## imports are part of each child, not of the stage's timing
+    import pickle
+    import pandas as pd
+    from sklearn.linear_model import LogisticRegression
+    from scripts.helper import create_database_connection
+    from scripts.download_game_data import extract_boxscore_data
+    from scripts.process_feed_data import process_season_feed_data
+    from scripts.features import WEIGHT_PREV_SEASON, materialize_team_baselines
+    from scripts.build_ml_dataset import build_season_features, write_season_features
+    from scripts.model_artifact import export_model_artifact
+    from scripts.predict_game_outcomes import PATH_MODEL, MODEL_FEATURES, compute_schedule_features, predict_games
+    from benchmarks.synthetic import generate_boxscore_season, generate_live_feeds
+
+    conn, cursor = create_database_connection(PATH_DB)
+    rss_before = get_peak_rss_mb()
+
+    if stage == 'extract':
+        feeds = [feed for season in seasons
+                 for feed in generate_live_feeds(generate_boxscore_season(season, n_teams, games_per_team))]
+        rss_before = get_peak_rss_mb()
+        start = perf_counter()
+        n_items = len([extract_boxscore_data(feed) for feed in feeds])
+
+    elif stage == 'process':
+        start = perf_counter()
+        n_items = sum([process_season_feed_data(season, conn, cursor) for season in seasons])
+
+    elif stage == 'build':
+        start = perf_counter()
+        df_baselines = materialize_team_baselines(conn, cursor)
+        n_items = 0
+        for season in seasons[1:]:
+            df = build_season_features(season, conn, df_baselines)
+            write_season_features(df, season, conn, cursor)
+            n_items += df.shape[0]
+
+    elif stage == 'train':
+        df = pd.read_sql_query(f"SELECT {', '.join(MODEL_FEATURES)}, home_win FROM mlfeatures WHERE season < {seasons[-1]}", conn)
+        start = perf_counter()
+        model = LogisticRegression().fit(df[MODEL_FEATURES], df['home_win'].astype('int'))
+        PATH_MODEL.parent.mkdir(parents = True, exist_ok = True)
+        pickle.dump(model, open(PATH_MODEL, 'wb'))
+        export_model_artifact(model, MODEL_FEATURES, 0.539, weight_previous_season = WEIGHT_PREV_SEASON)
+        n_items = df.shape[0]
+
+    elif stage == 'predict':
+        model = pickle.load(open(PATH_MODEL, 'rb'))
+        df_games = pd.read_sql_query(f"""SELECT game_id, season, datetime, home_franchise_id AS home_id, away_franchise_id AS away_id,
+                                         home_name AS home_team, away_name AS away_team FROM boxscore WHERE season = {seasons[-1]}""", conn)
+        start = perf_counter()
+        df = predict_games(compute_schedule_features(df_games, conn), model)
+        n_items = df.shape[0]
+
+    else:
+        raise ValueError(f'Unknown stage {stage}, expected one of {STAGES}')
+
+    seconds = perf_counter() - start
+    conn.close()
+
+    return {'seconds': seconds, 'items': n_items, 'items_per_second': n_items / seconds,
+            'peak_rss_mb': get_peak_rss_mb(), 'baseline_rss_mb': rss_before}
+
+def get_commit():
+
+    """
+    Returns the git commit of the repo, if available.
+    """
+
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = PATH_REPO, capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(n_teams, games_per_team, n_seasons, stages = STAGES):
+
+    """
+    Creates the synthetic db in a temporary directory and runs each stage in a fresh process.
+
+    :param n_teams: number of teams in the league
+    :param games_per_team: number of games played by each team per season
+    :param n_seasons: number of seasons
+    :param stages: stages to run, in order
+    :return: dict with the configuration, environment and per-stage results
+    """
+
+    from scripts.helper import create_database_connection
+    from benchmarks.synthetic import create_synthetic_db
+
+    seasons = list(range(FIRST_SEASON, FIRST_SEASON + n_seasons))
+    results = {'config': {'teams': n_teams, 'games_per_team': games_per_team, 'seasons': n_seasons},
+               'commit': get_commit(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'created_at': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+               'stages': {}}
+
+    with TemporaryDirectory() as path_tmp:
+
+        ## the scripts read and write relative to the working directory
+        os.symlink(PATH_REPO/'queries', Path(path_tmp)/'queries')
+        (Path(path_tmp)/PATH_DB).parent.mkdir(parents = True)
+        conn, cursor = create_database_connection(Path(path_tmp)/PATH_DB)
+        results['config']['games'] = create_synthetic_db(conn, cursor, seasons, n_teams, games_per_team)
+        conn.close()
+
+        env = dict(os.environ, PYTHONPATH = str(PATH_REPO))
+        for stage in stages:
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.run_suite', '--stage', stage, '--teams', str(n_teams),
+                                     '--games-per-team', str(games_per_team), '--seasons', str(n_seasons)],
+                                    cwd = path_tmp, env = env, capture_output = True, text = True, check = True).stdout
+            results['stages'][stage] = json.loads(output.strip().splitlines()[-1])
+            stage_results = results['stages'][stage]
+            print(f"{stage:8s} {stage_results['items']:8d} items  {stage_results['seconds']:8.2f}s  "
+                  f"{stage_results['items_per_second']:10.0f}/s  peak rss {stage_results['peak_rss_mb']:6.0f}MB")
+
+    return results
+
+
+## SCRIPT ##
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Benchmark each pipeline stage on a synthetic league.')
+    parser.add_argument('--teams', type = int, default = 31)
+    parser.add_argument('--games-per-team', type = int, default = 82)
+    parser.add_argument('--seasons', type = int, default = 5)
+    parser.add_argument('--scale', type = int, default = 1, help = 'multiply the number of teams (e.g. 10 for 10x the league size)')
+    parser.add_argument('--stages', nargs = '+', default = STAGES, choices = STAGES)
+    parser.add_argument('--output', type = Path, help = 'json file for the results (defaults to benchmarks/results/<time>.json)')
+    parser.add_argument('--stage', choices = STAGES, help = argparse.SUPPRESS) ## run a single stage in this process
+    args = parser.parse_args()
+
+    n_teams = args.teams * args.scale
+    seasons = list(range(FIRST_SEASON, FIRST_SEASON + args.seasons))
+
+    if args.stage is not None:
+        print(json.dumps(run_stage(args.stage, seasons, n_teams, args.games_per_team)))
+
+    else:
+        results = run_suite(n_teams, args.games_per_team, args.seasons, args.stages)
+        path_output = args.output or PATH_RESULTS/f"{results['created_at'].replace(':', '')}.json"
+        path_output.parent.mkdir(parents = True, exist_ok = True)
+        with open(path_output, 'w') as f:
+            json.dump(results, f, indent = 2)
+        print(f'results written to {path_output}')
@@ -0,0 +1,133 @@
+"""
+Generates synthetic NHL data matching the boxscore table schema (and the live feed dicts it
+is extracted from), so that the pipeline can be benchmarked without the live api or a real db.
+"""
+
+## SETUP ##
+
+from pathlib import Path
+import pandas as pd
+import numpy as np
+
+from scripts.helper import execute_query, write_dataframe
+
+PATH_QUERIES = Path('queries')
+FIRST_FRANCHISE_ID = 1
+
+## FUNCTIONS ##
+
+def generate_boxscore_season(season, n_teams = 31, games_per_team = 82, seed = 0):
+
+    """
+    Generates a season of regular season games between n_teams teams, with every
+    column of the boxscore table filled in with plausible random values.
+
+    :param season: year in which the season started
+    :param n_teams: number of teams in the league
+    :param games_per_team: number of games played by each team
+    :param seed: seed for the random number generator
+    :return: dataframe with one row per game, in the column order of the boxscore table
+    """
+
+    rng = np.random.default_rng(seed + season)
+    n_games = n_teams * games_per_team // 2
+
+    ## pair up teams at random, one game every three hours from the start of october
+    home_index = rng.integers(0, n_teams, n_games)
+    away_index = (home_index + rng.integers(1, n_teams, n_games)) % n_teams
+    franchise_ids = np.arange(FIRST_FRANCHISE_ID, FIRST_FRANCHISE_ID + n_teams)
+    datetimes = pd.Timestamp(f'{season}-10-01') + pd.to_timedelta(np.arange(n_games) * 3, unit = 'h')
+
+    df = pd.DataFrame({
+        'game_id': [f'{season}02{game:04d}' for game in range(1, n_games + 1)],
+        'game_type': 2,
+        'season': season,
+        'datetime': datetimes.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'venue_name': [f'Arena {franchise_id}' for franchise_id in franchise_ids[home_index]],
+        'venue_link': [f'/api/v1/venues/{franchise_id}' for franchise_id in franchise_ids[home_index]],
+        'away_id': franchise_ids[away_index],
+        'away_franchise_id': franchise_ids[away_index],
+        'away_name': [f'Team {franchise_id}' for franchise_id in franchise_ids[away_index]],
+        'home_id': franchise_ids[home_index],
+        'home_franchise_id': franchise_ids[home_index],
+        'home_name': [f'Team {franchise_id}' for franchise_id in franchise_ids[home_index]],
+    })
+
+    ## game stats; ties in goals are broken by a shootout
+    goals = rng.poisson(3, (n_games, 2))
+    shootout = goals[:, 0] == goals[:, 1]
+    home_wins = np.where(shootout, rng.random(n_games) < 0.5, goals[:, 0] > goals[:, 1])
+    df['winner'] = np.where(home_wins, 'home', 'away')
+    df['shootout'] = shootout.astype('int')
+
+    fo_percent = np.round(rng.uniform(35, 65, n_games), 1)
+    for i, side in enumerate(['away', 'home']):
+        df[f'{side}_goals'] = goals[:, 1 - i]
+        df[f'{side}_pim'] = rng.poisson(8, n_games)
+        df[f'{side}_shots'] = rng.poisson(30, n_games)
+        df[f'{side}_pp_goals'] = rng.binomial(3, 0.2, n_games)
+        df[f'{side}_pp_attempts'] = df[f'{side}_pp_goals'] + rng.poisson(2, n_games)
+        df[f'{side}_fo_percent'] = fo_percent if side == 'away' else np.round(100 - fo_percent, 1)
+        df[f'{side}_blocks'] = rng.poisson(14, n_games)
+        df[f'{side}_takeaways'] = rng.poisson(7, n_games)
+        df[f'{side}_giveaways'] = rng.poisson(9, n_games)
+        df[f'{side}_hits'] = rng.poisson(22, n_games)
+
+    return df
+
+def create_synthetic_db(conn, cursor, seasons, n_teams = 31, games_per_team = 82, seed = 0):
+
+    """
+    Fills the boxscore table of a db with synthetic seasons.
+
+    :param conn: conn for the db
+    :param cursor: cursor for the db
+    :param seasons: iterable of seasons to generate
+    :param n_teams: number of teams in the league
+    :param games_per_team: number of games played by each team per season
+    :param seed: seed for the random number generator
+    :return: number of games written
+    """
+
+    execute_query(PATH_QUERIES/'create_table_boxscore', cursor)
+
+    n_games = 0
+    for season in seasons:
+        df_season = generate_boxscore_season(season, n_teams = n_teams, games_per_team = games_per_team, seed = seed)
+        n_games += write_dataframe(df_season, 'boxscore', cursor)
+    conn.commit()
+
+    return n_games
+
+def generate_live_feeds(df_season):
+
+    """
+    Converts synthetic boxscore rows back into the live feed dicts they would have been
+    extracted from, so that extract_boxscore_data returns the original rows.
+
+    :param df_season: dataframe as returned by generate_boxscore_season
+    :return: list of live feed dicts, one per game
+    """
+
+    stat_keys = {'goals': 'goals', 'pim': 'pim', 'shots': 'shots', 'pp_goals': 'powerPlayGoals',
+                 'pp_attempts': 'powerPlayOpportunities', 'fo_percent': 'faceOffWinPercentage',
+                 'blocks': 'blocked', 'takeaways': 'takeaways', 'giveaways': 'giveaways', 'hits': 'hits'}
+
+    feeds = []
+    for row in df_season.to_dict('records'):
+        teams = {side: {'id': int(row[f'{side}_id']), 'franchiseId': int(row[f'{side}_franchise_id']), 'name': row[f'{side}_name']}
+                 for side in ['away', 'home']}
+        skater_stats = {side: {'teamStats': {'teamSkaterStats': {key: row[f'{side}_{stat}'] for stat, key in stat_keys.items()}}}
+                        for side in ['away', 'home']}
+        linescore = {'hasShootout': bool(row['shootout'])}
+        if row['shootout']:
+            linescore['shootoutInfo'] = {side: {'scores': int(row['winner'] == side)} for side in ['away', 'home']}
+
+        feeds.append({'gamePk': int(row['game_id']),
+                      'gameData': {'status': {'detailedState': 'Final'},
+                                   'datetime': {'dateTime': row['datetime']},
+                                   'venue': {'name': row['venue_name'], 'link': row['venue_link']},
+                                   'teams': teams},
+                      'liveData': {'linescore': linescore, 'boxscore': {'teams': skater_stats}}})
+
+    return feeds
@@ -0,0 +1,202 @@
+"""
+This script backtests the logistic model with walk-forward validation over the mlfeatures
+table. Each fold trains on every game before a cut-off (an expanding window) and is scored
+on the following season or month. Folds are fitted in parallel in a process pool, and each
+fitted fold model is cached on disk under a hash of its feature set, window and training
+data, so re-runs only fit the folds that changed (e.g. a newly added feature set).
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import hashlib
+import json
+import pickle
+import pandas as pd
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from sklearn import metrics
+
+from scripts.helper import create_database_connection
+
+PATH_DB = Path('data/raw/nhl.db')
+PATH_FOLD_MODELS = Path('models/backtest')
+
+FEATURE_SETS = [['wins_per_game_home', 'wins_per_game_away']]
+TARGET = 'home_win'
+CUTOFF = 0.539 ## same cut-off as train_model.py
+MIN_TRAINING_SEASONS = 1 ## number of seasons every fold trains on at least
+WORKERS = 4
+
+## FUNCTIONS ##
+
+def load_backtest_data(conn, features):
+
+    """
+    Reads the games of the mlfeatures table with the given features, sorted by datetime.
+
+    :param conn: conn for the db
+    :param features: list of feature columns
+    :return: dataframe with columns game_id, season, datetime, the target and the features
+    """
+
+    columns = ', '.join(['game_id', 'season', 'datetime', TARGET] + list(features))
+    df = pd.read_sql_query(f'SELECT {columns} FROM mlfeatures', conn)
+    df = df.dropna().sort_values(['datetime', 'game_id']).reset_index(drop = True)
+    df[TARGET] = df[TARGET].astype('int')
+
+    return df
+
+def generate_folds(df, window = 'season', min_training_seasons = MIN_TRAINING_SEASONS):
+
+    """
+    Splits the games into expanding-window folds. Each fold's test period is a season (or a
+    month), and its training set is every game before the test period starts.
+
+    :param df: dataframe as returned by load_backtest_data
+    :param window: 'season' or 'month'
+    :param min_training_seasons: number of full seasons before the first test period
+    :return: list of dicts with the fold's test period label and its train / test row positions
+    """
+
+    seasons = np.sort(df['season'].unique())
+    df_test = df[df['season'].isin(seasons[min_training_seasons:])]
+    if window == 'season':
+        periods = df_test['season'].astype('str')
+    elif window == 'month':
+        periods = df_test['datetime'].str[:7]
+    else:
+        raise ValueError(f'Unknown window {window}, expected season or month')
+
+    folds = []
+    for period, index in df_test.groupby(periods, sort = True).groups.items():
+        test_rows = np.asarray(index)
+        folds.append({'period': period,
+                      'train_rows': np.arange(test_rows.min()), ## df is sorted by datetime
+                      'test_rows': test_rows})
+
+    return folds
+
+def hash_fold(features, period, X_train, y_train):
+
+    """
+    Hashes everything a fold model depends on: the feature set, the window and the
+    training data itself (so reprocessed or newly added games invalidate the cache).
+
+    :param features: list of feature columns
+    :param period: test period label of the fold
+    :param X_train: training features
+    :param y_train: training target
+    :return: hex digest
+    """
+
+    h = hashlib.sha1(json.dumps({'features': list(features), 'period': period,
+                                 'model': LogisticRegression().get_params()}, sort_keys = True).encode())
+    h.update(np.ascontiguousarray(X_train, dtype = 'float64').tobytes())
+    h.update(np.ascontiguousarray(y_train, dtype = 'int64').tobytes())
+
+    return h.hexdigest()
+
+def fit_fold(X_train, y_train):
+
+    """
+    Fits the logistic model of one fold (run in a worker process).
+
+    :param X_train: training features
+    :param y_train: training target
+    :return: fitted LogisticRegression
+    """
+
+    return LogisticRegression().fit(X_train, y_train)
+
+def score_fold(model, X_test, y_test, cutoff = CUTOFF):
+
+    """
+    Scores a fold model on its test period.
+
+    :param model: fitted classifier
+    :param X_test: test features
+    :param y_test: test target
+    :param cutoff: probability above which a home win is predicted
+    :return: dict with log loss, brier score and accuracy
+    """
+
+    probs = model.predict_proba(X_test)[:, 1]
+
+    return {'log_loss': metrics.log_loss(y_test, probs, labels = [0, 1]),
+            'brier': metrics.brier_score_loss(y_test, probs),
+            'accuracy': metrics.accuracy_score(y_test, probs > cutoff)}
+
+def run_backtest(df, feature_sets = FEATURE_SETS, window = 'season', workers = WORKERS, path_models = PATH_FOLD_MODELS):
+
+    """
+    Runs the walk-forward backtest of every feature set. Fold models found in the cache are
+    reused, and the rest are fitted in parallel.
+
+    :param df: dataframe as returned by load_backtest_data, including every feature of feature_sets
+    :param feature_sets: list of feature lists
+    :param window: 'season' or 'month'
+    :param workers: number of worker processes
+    :param path_models: directory of cached fold models (None disables caching)
+    :return: dataframe with one row per feature set and fold, including n_train, n_test, the scores and whether the model was cached
+    """
+
+    folds = generate_folds(df, window)
+    y = df[TARGET].to_numpy()
+
+    ## look up every (feature set, fold) in the cache, and collect the ones that need fitting
+    tasks = []
+    for features in feature_sets:
+        X = df[features].to_numpy(dtype = 'float64')
+        for fold in folds:
+            key = hash_fold(features, fold['period'], X[fold['train_rows']], y[fold['train_rows']])
+            path_model = None if path_models is None else Path(path_models)/f'{key}.pickle'
+            is_cached = path_model is not None and path_model.exists()
+            tasks.append({'features': features, 'fold': fold, 'X': X, 'path': path_model, 'cached': is_cached,
+                          'model': pickle.load(open(path_model, 'rb')) if is_cached else None})
+
+    to_fit = [task for task in tasks if not task['cached']]
+    if len(to_fit) > 0:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            futures = [executor.submit(fit_fold, task['X'][task['fold']['train_rows']], y[task['fold']['train_rows']]) for task in to_fit]
+            for task, future in zip(to_fit, futures):
+                task['model'] = future.result()
+                if task['path'] is not None:
+                    task['path'].parent.mkdir(parents = True, exist_ok = True)
+                    pickle.dump(task['model'], open(task['path'], 'wb'))
+
+    results = []
+    for task in tasks:
+        fold = task['fold']
+        scores = score_fold(task['model'], task['X'][fold['test_rows']], y[fold['test_rows']])
+        results.append({'features': ', '.join(task['features']), 'period': fold['period'],
+                        'n_train': fold['train_rows'].shape[0], 'n_test': fold['test_rows'].shape[0],
+                        **scores, 'cached': task['cached']})
+
+    return pd.DataFrame(results)
+
+
+## SCRIPT ##
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Walk-forward backtest of the logistic model over mlfeatures.')
+    parser.add_argument('--window', choices = ['season', 'month'], default = 'season')
+    parser.add_argument('--features', nargs = '+', action = 'append', help = 'a feature set (repeat for several)')
+    parser.add_argument('--workers', type = int, default = WORKERS)
+    parser.add_argument('--output', type = Path, help = 'optional csv to write the per-fold scores to')
+    args = parser.parse_args()
+
+    feature_sets = args.features or FEATURE_SETS
+
+    conn, cursor = create_database_connection(PATH_DB)
+    df = load_backtest_data(conn, sorted({feature for features in feature_sets for feature in features}))
+
+    df_results = run_backtest(df, feature_sets, args.window, args.workers)
+    print(df_results.to_string(index = False))
+    print(df_results.groupby('features')[['log_loss', 'brier', 'accuracy']].mean())
+
+    if args.output is not None:
+        df_results.to_csv(args.output, index = False)
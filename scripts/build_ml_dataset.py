@@ -8,143 +8,163 @@ to be used in the ML model. These variables are saved in the mlfeatures table.
 
 import pandas as pd
 import numpy as np
+import argparse
 from copy import deepcopy
+from functools import partial
 from pathlib import Path
-from scripts.helper import create_database_connection, execute_query
+from scripts.helper import create_database_connection, migrate_database, execute_query, write_dataframe, compute_seasons_parallel
+from scripts.feature_store import export_feature_store
+from scripts.features import BASELINE_STATS, WEIGHT_PREV_SEASON, materialize_team_baselines, load_team_state, compute_point_in_time_features, hash_feature_rows
+from scripts.team_state import refresh_team_state_baselines
+from scripts.instrumentation import span, start_run, finish_run
 
 PATH_DB = Path('data/raw/nhl.db')
 PATH_DATA_PROCESSED = Path('data/processed')
 PATH_QUERIES = Path('queries')
-WEIGHT_PREV_SEASON = 10 # consider previous season to be equivalent to this many games
 SEASONS = np.arange(2011, 2021)
+TRAINING_SEASONS = [2011, 2012, 2013, 2014, 2015, 2016] ## seasons to train model on
+REPLACE_CHANGED_FEATURES = True ## overwrite existing mlfeatures rows whose values have changed
 
 ## FUNCTIONS ##
 
-def weight_season_stats(df, previous, current, games_played, weight_previous_season):
-       """
-       Computes a weighted average for a statistic including the previous year as equivalent
-       to weight_previous_season games from the current year.
-
-       :param df: dataframe including game-by-game data
-       :param previous: column containing previous year's stat
-       :param current: column containing this year's stat
-       :param games_played: column containing number of games played so far this year
-       :param weight_previous_season: weight of previous season
-       :return: weighted stat
+def build_season_features(season, conn, df_baselines):
        """
+       Builds the feature engineered variables for each game of a season, with each team's
+       stats as of the start of the game (see compute_point_in_time_features).
 
-       return (weight_previous_season * df[previous] + df[current]) / (df[games_played] + weight_previous_season)
-
-### DATA PROCESSING ###
-
-conn, cursor = create_database_connection(PATH_DB)
-
-df_all_seasons = pd.DataFrame({})
-for season in SEASONS:
-
-       print(season)
+       :param season: year in which the season started
+       :param conn: conn for the db
+       :param df_baselines: previous-season baselines, as returned by compute_previous_season_baselines
+       :return: dataframe with one row per game, in the column order of the mlfeatures table
+       """
 
-       ## query the data for the season
-       df_season = pd.read_sql(f"SELECT * FROM boxscore_processed WHERE season = {season}", conn)
-       df_season_prev = pd.read_sql(f"SELECT * FROM boxscore_processed WHERE season = {season-1}", conn)
+       with span('build.features'):
 
-       ### determine whether this season has any new teams
-       teams_all = df_season['home_franchise_id'].unique()
-       teams_prev = df_season_prev['home_franchise_id'].unique()
-       teams_new = teams_all[[team not in teams_prev for team in teams_all]]
+              ## query the data for the season
+              df_season = pd.read_sql(f"SELECT * FROM boxscore_processed WHERE season = {season}", conn)
+              df_state = load_team_state(conn, [season])
 
-       ### get the previous season's stats for each team
-       df_season_previous = pd.DataFrame({})
-       for team in teams_prev:
+              ### keep games between teams with a previous-season baseline (including imputed means for new teams)
+              franchise_ids = df_baselines.loc[df_baselines['season'] == season, 'franchise_id']
+              df_season = df_season[df_season['home_franchise_id'].isin(franchise_ids) & df_season['away_franchise_id'].isin(franchise_ids)].reset_index(drop = True)
 
-              query_team = f'SELECT * FROM boxscore_processed_team WHERE season = {season - 1} AND franchise_id = {team}'
-              df_team = pd.read_sql(query_team, conn)
-              n_games_played = np.max(df_team['games_played_after'])
+              ## set up the start of the dataset
+              df = deepcopy(df_season[['game_id', 'game_type', 'season', 'datetime', 'away_franchise_id', 'home_franchise_id']])
+              df['home_win'] = df_season['winner'] == 'home'  ## y-variable to be predicted
 
-              goals_for_per_game = df_team.loc[n_games_played-1, ['goals_for_after']].values[0] / n_games_played
-              goals_against_per_game = df_team.loc[n_games_played-1, ['goals_against_after']].values[0] / n_games_played
-              shots_for_per_game = df_team.loc[n_games_played-1, ['shots_for_after']].values[0] / n_games_played
-              shots_against_per_game = df_team.loc[n_games_played-1, ['shots_against_after']].values[0] / n_games_played
-              wins_per_game = df_team.loc[n_games_played-1, ['wins_after']].values[0] / n_games_played
+              ## ADD FEATURES
+              ## per-game stats for the home and away team as of the start of each game
+              for side in ['home', 'away']:
+                     df_queries = pd.DataFrame({'franchise_id': df_season[f'{side}_franchise_id'],
+                                                'season': df_season['season'],
+                                                'datetime': df_season['datetime']})
+                     df_features = compute_point_in_time_features(df_queries, df_state, df_baselines, WEIGHT_PREV_SEASON)
+                     for stat in BASELINE_STATS:
+                            df[f'{stat}_per_game_{side}'] = df_features[f'{stat}_per_game']
 
+              ## match the column order of the mlfeatures table
+              feature_cols = [f'{stat}_per_game_{side}' for stat in BASELINE_STATS for side in ['home', 'away']]
+              df = df[['game_id', 'game_type', 'season', 'datetime', 'away_franchise_id', 'home_franchise_id', 'home_win'] + feature_cols]
 
-              df_team_previous = pd.DataFrame({'franchise_id' : [team],
-                                               'previous_goals_for_per_game' : [goals_for_per_game],
-                                               'previous_goals_against_per_game' : [goals_against_per_game],
-                                               'previous_shots_for_per_game' : [shots_for_per_game],
-                                               'previous_shots_against_per_game' : [shots_against_per_game],
-                                               'previous_wins_per_game' : [wins_per_game]})
-              df_season_previous = pd.concat([df_season_previous, df_team_previous])
+       return df
 
+def write_season_features(df, season, conn, cursor, replace_changed = False):
+       """
+       Writes a season of features to the mlfeatures table in one batch. New rows are diffed
+       against the rows already in the table through a per-row hash index keyed by game_id,
+       so only missing rows (and, optionally, rows whose features changed) are written.
+
+       :param df: dataframe as returned by build_season_features
+       :param season: year in which the season started
+       :param conn: conn for the db
+       :param cursor: cursor for the db
+       :param replace_changed: whether to replace existing rows whose values differ
+       :return: tuple with the number of rows inserted and the number of rows replaced
+       """
 
-       ### impute the mean for teams that didn't exist last season
-       means = df_season_previous.mean()
-       df_missing = pd.DataFrame(columns=means.index)
-       for i, missing_team in enumerate(teams_new):
-              df_missing.loc[i] = means.values
-              df_missing['franchise_id'][i] = missing_team
-       df_season_previous = pd.concat([df_season_previous, df_missing])
+       ## create the table if it doesn't exist
+       execute_query(PATH_QUERIES / 'create_table_mlfeatures', cursor)
 
-       ### add previous season info to this season's dataset
-       df_season = pd.merge(df_season, df_season_previous, left_on = 'home_franchise_id', right_on = 'franchise_id')
-       df_season = pd.merge(df_season, df_season_previous, left_on = 'away_franchise_id', right_on = 'franchise_id', suffixes = ('_home','_away'))
+       df_existing = pd.read_sql_query(f'SELECT * from mlfeatures WHERE season = {season}', conn)
+       is_new = ~df['game_id'].isin(df_existing['game_id'])
+       n_inserted = write_dataframe(df[is_new], 'mlfeatures', cursor)
 
+       n_replaced = 0
+       if replace_changed and df_existing.shape[0] > 0:
+              hash_new = hash_feature_rows(df[~is_new])
+              hash_existing = hash_feature_rows(df_existing).reindex(hash_new.index)
+              changed_ids = hash_new.index[hash_new.values != hash_existing.values]
+              n_replaced = write_dataframe(df[df['game_id'].isin(changed_ids)], 'mlfeatures', cursor, on_conflict = 'REPLACE')
 
-       ## set up the start of the dataset
-       df = deepcopy(df_season[['game_id', 'game_type', 'season', 'datetime', 'away_franchise_id', 'home_franchise_id']])
-       df['home_win'] = df_season['winner'] == 'home'  ## y-variable to be predicted
+       conn.commit()
 
-       ## ADD FEATURES
-       ## wins per game
-       df['wins_per_game_home'] = weight_season_stats(df_season, 'previous_wins_per_game_home', 'home_season_wins', 'home_season_games_played', WEIGHT_PREV_SEASON)
-       df['wins_per_game_away'] = weight_season_stats(df_season, 'previous_wins_per_game_away', 'away_season_wins', 'away_season_games_played', WEIGHT_PREV_SEASON)
+       return n_inserted, n_replaced
 
-       ## goals for per game
-       df['goals_for_per_game_home'] = weight_season_stats(df_season, 'previous_goals_for_per_game_home', 'home_season_goals_for', 'home_season_games_played', WEIGHT_PREV_SEASON)
-       df['goals_for_per_game_away'] = weight_season_stats(df_season, 'previous_goals_for_per_game_away', 'away_season_goals_for', 'away_season_games_played', WEIGHT_PREV_SEASON)
+def build_seasons_parallel(seasons, conn, cursor, df_baselines, path_db = PATH_DB, workers = None, replace_changed = False):
+       """
+       Builds the features of many seasons at once: each season is built in a pool of worker
+       processes (it only depends on its own games and the materialized baselines), and written
+       by this process, the db's only writer, as they complete.
+
+       :param seasons: iterable of seasons
+       :param conn: conn for the db
+       :param cursor: cursor for the db
+       :param df_baselines: previous-season baselines, as returned by materialize_team_baselines
+       :param path_db: path of the db, opened by each worker
+       :param workers: number of worker processes (defaults to the number of cpus)
+       :param replace_changed: whether to replace existing rows whose values differ
+       :return: dict mapping season to a tuple with the number of rows inserted and replaced
+       """
 
-       ## goals against per game
-       df['goals_against_per_game_home'] = weight_season_stats(df_season, 'previous_goals_against_per_game_home', 'home_season_goals_against', 'home_season_games_played', WEIGHT_PREV_SEASON)
-       df['goals_against_per_game_away'] = weight_season_stats(df_season, 'previous_goals_against_per_game_away', 'away_season_goals_against', 'away_season_games_played', WEIGHT_PREV_SEASON)
+       build = partial(build_season_features, df_baselines = df_baselines)
 
-       ## shots for per game
-       df['shots_for_per_game_home'] = weight_season_stats(df_season, 'previous_shots_for_per_game_home', 'home_season_shots_for', 'home_season_games_played', WEIGHT_PREV_SEASON)
-       df['shots_for_per_game_away'] = weight_season_stats(df_season, 'previous_shots_for_per_game_away', 'away_season_shots_against', 'away_season_games_played', WEIGHT_PREV_SEASON)
+       n_rows = {}
+       for season, df in compute_seasons_parallel(build, [int(season) for season in seasons], path_db, workers):
+              with span('build.write'):
+                     n_rows[season] = write_season_features(df, season, conn, cursor, replace_changed = replace_changed)
 
-       ## shots against per game
-       df['shots_against_per_game_home'] = weight_season_stats(df_season, 'previous_shots_against_per_game_home', 'home_season_shots_against', 'home_season_games_played', WEIGHT_PREV_SEASON)
-       df['shots_against_per_game_away'] = weight_season_stats(df_season, 'previous_shots_against_per_game_away', 'away_season_shots_for', 'away_season_games_played', WEIGHT_PREV_SEASON)
+       return n_rows
 
-       ## create the table if it doesn't exist
-       execute_query(PATH_QUERIES / 'create_table_mlfeatures', cursor)
 
-       ## query the table in order to skip any existing game
-       df_mlfeatures = pd.read_sql_query(f'SELECT * from mlfeatures WHERE season = {season}', conn)
-       for row in df.iterrows():
-              if row[1]['game_id'] not in df_mlfeatures['game_id'].values:
-                     game_dict = dict(row[1])
-                     execute_query(PATH_QUERIES / 'insert_or_ignore_entry', cursor,
-                                   values=tuple(game_dict.values()),
-                                   replacements={'xtablex' : 'mlfeatures',
-                                                 'xkeysx': ', '.join(list(game_dict.keys())),
-                                                 'xvaluesx': '(' + ', '.join(['?'] * len(game_dict.keys())) + ')'})
-       conn.commit()
+### DATA PROCESSING ###
 
+if __name__ == "__main__":
 
+       parser = argparse.ArgumentParser(description = 'Build the mlfeatures table and export it to the feature store.')
+       parser.add_argument('--workers', type = int, default = 1, help = 'build seasons in this many worker processes (writes stay in the main process)')
+       args = parser.parse_args()
 
+       start_run('build')
+       conn, cursor = create_database_connection(PATH_DB)
 
-### SAVE TRAIN SET TO CSV ###
+       ## previous-season baselines for all teams and seasons, materialized once
+       with span('build.baselines'):
+              df_baselines = materialize_team_baselines(conn, cursor)
+              refresh_team_state_baselines(conn)
 
-TRAINING_SEASONS = [2011, 2012, 2013, 2014, 2015, 2016] ## seasons to train model on
+       if args.workers > 1:
+              n_rows = build_seasons_parallel(SEASONS, conn, cursor, df_baselines, PATH_DB, args.workers, REPLACE_CHANGED_FEATURES)
+              for season in sorted(n_rows):
+                     print(f'{season}: {n_rows[season][0]} rows inserted, {n_rows[season][1]} rows replaced')
 
-season_string = ', '.join([str(season) for season in TRAINING_SEASONS])
-df_all_seasons = pd.read_sql_query(f'SELECT * from mlfeatures WHERE season IN ({season_string})', conn)
+       else:
+              for season in SEASONS:
 
+                     print(season)
+                     df = build_season_features(season, conn, df_baselines)
 
-## save
-df_all_seasons.to_csv(PATH_DATA_PROCESSED/'dataset_2021_03_01_wins_only.csv', index = False)
+                     with span('build.write'):
+                            n_inserted, n_replaced = write_season_features(df, season, conn, cursor, replace_changed = REPLACE_CHANGED_FEATURES)
+                     print(f'{n_inserted} rows inserted, {n_replaced} rows replaced')
 
 
+       with span('build.migrate'):
+              migrate_database(conn, cursor)
 
+       ### EXPORT TO THE FEATURE STORE ###
 
+       with span('build.feature_store'):
+              version = export_feature_store(conn, SEASONS)
+       print(f'feature store version {version}')
 
+       print(f'run report written to {finish_run()}')
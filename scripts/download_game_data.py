@@ -1,58 +1,189 @@
 
 """
 This script downloads boxscore data for all regular season and playoff games
-from 2010 to 2019, saving the data in a SQLite3 db located at PATH_DB.
+of the seasons in SEASONS (2010-11 to 2020-21), saving the data in a SQLite3 db located at PATH_DB.
 """
 
 ## SETUP ##
 
-from requests import get
+from requests import get, Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
 from pathlib import Path
-import pandas as pd
-from time import sleep
+import json
+from time import sleep, monotonic
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from scripts.helper import create_database_connection, execute_query
+from scripts.helper import create_database_connection, migrate_database, execute_query, write_rows
+from scripts.feed_archive import PATH_FEEDS, read_feed, write_feed, iter_archived_feeds
+from scripts.instrumentation import count, span, start_run, finish_run
 
 PATH_DB = Path('data/raw/nhl.db')
 PATH_QUERIES = Path('queries')
+PATH_SCHEDULES = Path('data/raw/schedules')
+
+API_BASE_URL = 'https://statsapi.web.nhl.com/api/v1'
+CONCURRENCY = 8 ## number of downloads in flight at once
+REQUESTS_PER_SECOND = 4 ## sustained request rate allowed across all workers
+MAX_RETRIES = 3 ## retries for failed requests (connection errors, 429s, 5xxs)
+BACKOFF_SECONDS = 1 ## base delay between retries, doubled on each attempt
+REQUEST_TIMEOUT = 30
+INGEST_BATCH_SIZE = 500 ## number of new games buffered between commits
 
 
 ## FUNCTIONS ##
 
-def generate_game_url(season, season_segment, game_number):
+class TokenBucket:
+
+    """
+    Thread-safe token bucket used to cap the request rate across download workers.
+    Tokens refill continuously at `rate` per second, up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+
+        """
+        Blocks until a token is available, then consumes it.
+        """
+
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+def create_session(concurrency = CONCURRENCY):
 
     """
-    Generates the url for a particular nhl game. The url is a concatenation
-    of the year, season type, and game number.
+    Creates a requests session whose connection pool is large enough for the given
+    number of concurrent downloads, so that connections are reused across games.
 
-    Inputs:
-    :param season: the year in which the season started
-    :param season_segment: 1 = preseason, 2 = regular season, 3 = playoffs
-    :param game_number:
-    :return: tuple containing the game code (i.e. segment of the url coding for the particular game) and the url
+    :param concurrency: number of downloads in flight at once
+    :return: requests session
     """
 
-    ## the game code is just a concatenation of the year (in which the season started)
-    ## the season segment (zero padded to len 2, 0 = preseason, 1 = regular, 2 = playoffs),
-    ## and the game number (zero padded to len 4)
-    game_code = str(season) + str(season_segment).zfill(2) + str(game_number).zfill(4)
-    game_url = f"https://statsapi.web.nhl.com/api/v1/game/{game_code}/feed/live"
+    session = Session()
+    adapter = HTTPAdapter(pool_connections = concurrency, pool_maxsize = concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
 
-    return game_code, game_url
+    return session
 
-def download_page(url):
+def download_page(url, session = None, rate_limiter = None, retries = 0, backoff = BACKOFF_SECONDS):
 
     """
-    Downloads a webpage given a url and returns a json object.
+    Downloads a webpage given a url and returns a json object. Connection errors,
+    rate limiting (429) and server errors (5xx) are retried with exponential backoff.
 
     :param url: url for the page to be downloaded
+    :param session: optional requests session, used to reuse connections
+    :param rate_limiter: optional TokenBucket shared by all download workers
+    :param retries: number of times to retry a failed request
+    :param backoff: base delay in seconds between retries
     :return: json object containing the page's data
     """
 
-    data = get(url)
-    data = data.json()
+    fetch = get if session is None else session.get
+
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            data = fetch(url, timeout = REQUEST_TIMEOUT)
+            count('requests')
+            count('bytes_downloaded', len(data.content))
+            if data.status_code == 429 or data.status_code >= 500:
+                raise RequestException(f'{data.status_code} response for {url}')
+            return data.json()
+        except (RequestException, ValueError):
+            if attempt == retries:
+                raise
+            count('request_retries')
+            sleep(backoff * 2 ** attempt)
+
+def download_games(game_codes, on_feed, concurrency = CONCURRENCY, rate = REQUESTS_PER_SECOND, retries = MAX_RETRIES,
+                   backoff = BACKOFF_SECONDS, base_url = API_BASE_URL, session = None, path_archive = PATH_FEEDS):
+
+    """
+    Downloads the live feeds for many games concurrently, sharing one connection pool
+    and one rate limit between all workers. Feeds already in the raw feed archive are
+    read from disk instead, and newly downloaded completed games are added to it. A game
+    that still fails after its retries is reported rather than aborting the other games.
+    Each feed is handed to on_feed (in the calling thread) as soon as it arrives and is not
+    kept, so only the feeds waiting to be handled are held in memory.
+
+    :param game_codes: iterable of game codes (e.g. '2019020001')
+    :param on_feed: function of a game code and its live feed dict, called once per game downloaded
+    :param concurrency: number of downloads in flight at once
+    :param rate: maximum sustained requests per second
+    :param retries: number of times to retry a failed request
+    :param backoff: base delay in seconds between retries
+    :param base_url: root of the stats api
+    :param session: optional requests session (one is created if not given)
+    :param path_archive: root directory of the raw feed archive (None disables the archive)
+    :return: tuple with a sorted list of the game codes downloaded and a sorted list of the game codes that failed
+    """
+
+    game_codes = [str(game_code) for game_code in game_codes]
+    if session is None:
+        session = create_session(concurrency)
+    rate_limiter = TokenBucket(rate)
+
+    def fetch(game_code):
+        if path_archive is not None:
+            data = read_feed(game_code, path_archive)
+            if data is not None:
+                count('feed_archive_hits')
+                return data
+        game_url = f"{base_url}/game/{game_code}/feed/live"
+        data = download_page(game_url, session = session, rate_limiter = rate_limiter, retries = retries, backoff = backoff)
+        if path_archive is not None and is_completed_game(data):
+            write_feed(data, path_archive) ## only final feeds are archived, since they no longer change
+        return data
+
+    downloaded = []
+    failed = []
+    with ThreadPoolExecutor(max_workers = concurrency) as executor:
+        futures = {executor.submit(fetch, game_code): game_code for game_code in game_codes}
+        for future in as_completed(futures):
+            game_code = futures.pop(future) ## drop the reference to the finished future, and with it the feed
+            try:
+                data = future.result()
+            except (RequestException, ValueError):
+                failed.append(game_code)
+                count('download_failures')
+                continue
+            on_feed(game_code, data)
+            downloaded.append(game_code)
+
+    return sorted(downloaded), sorted(failed)
+
+def is_completed_game(dict_live):
+
+    """
+    Checks whether a live feed dict describes a game that exists and has been completed.
+
+    :param dict_live: dict containing live feed data
+    :return: True if the game is final, False otherwise
+    """
+
+    if 'message' in dict_live:
+        return False ## this occurs when the game can't be found (e.g. non-existent game code)
 
-    return data
+    return dict_live['gameData']['status']['detailedState'] == 'Final'
 
 def determine_game_winner(dict_live):
 
@@ -131,56 +262,200 @@ def extract_boxscore_data(dict_live):
 
     return dict_data
 
-def add_boxscore_to_db(season, season_segment, game_number, conn, cursor):
+def extract_archived_boxscores(seasons = None, path_archive = PATH_FEEDS):
 
     """
+    Re-extracts boxscore data offline from every completed game in the raw feed archive.
 
-    :param season: start year for a particular season
-    :param season_segment: 1 = preseason, 2 = regular season, 3 = playoffs
-    :param game_number:  number representing a particular game
-    :param conn:  conn for the db
+    :param seasons: optional iterable of seasons to restrict to
+    :param path_archive: root directory of the raw feed archive
+    :return: list of boxscore dicts as returned by extract_boxscore_data
+    """
+
+    return [extract_boxscore_data(data) for data in iter_archived_feeds(seasons, path_archive) if is_completed_game(data)]
+
+def insert_boxscores(rows, conn, cursor):
+
+    """
+    Inserts many extracted boxscore rows into the boxscore table in one transaction.
+    Games already in the table are left untouched.
+
+    :param rows: list of dicts as returned by extract_boxscore_data
+    :param conn: conn for the db
     :param cursor: cursor for the db
-    :return: returns 1 if the game has been completed and 0 otherwise
+    :return: no return
     """
 
-    game_code, game_url = generate_game_url(season, season_segment, game_number)
-    data = download_page(game_url)
+    if len(rows) == 0:
+        return
+
+    keys = list(rows[0].keys())
+    write_rows([tuple(row[key] for key in keys) for row in rows], keys, 'boxscore', cursor)
+    conn.commit()
+
+def get_existing_game_ids(conn, season = None):
 
-    add_game = False ## flag indicating whether to actually add the game
+    """
+    Finds the ids of all games (optionally from a single season) that are already in the boxscore table.
 
-    if 'message' in data:
-        print(f'Game {game_code} does not exist.')
-        return 0 ## this occurs when the game can't be found (e.g. non-existent game code)
+    :param conn: conn for the db
+    :param season: optional start year for a particular season
+    :return: set of game ids (as strings)
+    """
 
-    elif data['gameData']['status']['detailedState'] != 'Final':
-        print(f'Game {game_code} has not yet been completed.')
-        return 0 ## this occurs when the game exists but hasn't yet been completed
+    if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'boxscore'").fetchone() is None:
+        return set()
 
-    elif (pd.read_sql("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'boxscore'", conn).shape[0] > 0):
-        if (pd.read_sql_query(f'SELECT * from boxscore WHERE game_id = {game_code}', conn).shape[0] > 0): # can only run this if the table exists
-            print(f'Game {game_code} already exists in the database.')
-            return 1 ## this occurs when the game already exists in the database
+    if season is None:
+        return {str(row[0]) for row in conn.execute('SELECT game_id FROM boxscore')}
 
-        else: ## in this case we actually add the game
-            add_game = True
+    return {str(row[0]) for row in conn.execute('SELECT game_id FROM boxscore WHERE season = ?', (int(season),))}
 
-    else:
-        add_game = True
+class IngestSession:
 
-    if add_game:
+    """
+    Session-level ingest state for the boxscore table. The boxscore table is created and
+    the set of known game ids is loaded once when the session starts; new rows are then
+    buffered and written with executemany, committing once every batch_size games.
+    Use as a context manager so that any remaining rows are flushed at the end.
+    """
 
-        sleep(1)
-        print(f'Game {game_code} added to database.')
-        dict_data = extract_boxscore_data(data)
+    def __init__(self, conn, cursor, batch_size = INGEST_BATCH_SIZE):
+        self.conn = conn
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.rows = []
 
-        ## add data
         execute_query(PATH_QUERIES/'create_table_boxscore', cursor)
-        execute_query(PATH_QUERIES/'insert_entry_boxscore', cursor,
-                      values = tuple(dict_data.values()),
-                      replacements = {'xkeysx' : ', '.join(list(dict_data.keys())), 'xvaluesx' : ', '.join(['?'] * len(dict_data.keys()))})
-        conn.commit()
+        self.known_game_ids = get_existing_game_ids(conn)
+
+    def __contains__(self, game_code):
+        return str(game_code) in self.known_game_ids
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, dict_data):
 
-        return 1
+        """
+        Buffers a boxscore row, flushing the buffer once it reaches batch_size rows.
+
+        :param dict_data: dict as returned by extract_boxscore_data
+        :return: no return
+        """
+
+        if dict_data['game_id'] in self.known_game_ids:
+            return
+        self.known_game_ids.add(dict_data['game_id'])
+        self.rows.append(dict_data)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+
+        """
+        Writes all buffered rows to the boxscore table and commits.
+        """
+
+        insert_boxscores(self.rows, self.conn, self.cursor)
+        self.rows = []
+
+def download_schedule(season, base_url = API_BASE_URL, session = None, path_cache = PATH_SCHEDULES):
+
+    """
+    Downloads the regular season and playoff schedule for a season from the schedule
+    endpoint. Schedules for seasons where every game is final are cached to disk
+    and read from there on later calls.
+
+    :param season: start year for a particular season
+    :param base_url: root of the stats api
+    :param session: optional requests session
+    :param path_cache: directory holding cached schedule files (None disables caching)
+    :return: dict containing the schedule data
+    """
+
+    path_schedule = None if path_cache is None else Path(path_cache)/f'{season}.json'
+    if path_schedule is not None and path_schedule.exists():
+        count('schedule_cache_hits')
+        with open(path_schedule) as f:
+            return json.load(f)
+
+    schedule_url = f"{base_url}/schedule?season={season}{season + 1}&gameType=R,P"
+    schedule = download_page(schedule_url, session = session, retries = MAX_RETRIES)
+
+    ## only cache once the season is over, otherwise newly completed games would be missed
+    all_final = all(game['status']['detailedState'] == 'Final'
+                    for day in schedule.get('dates', []) for game in day['games'])
+    if path_schedule is not None and all_final and schedule.get('totalGames', 0) > 0:
+        path_schedule.parent.mkdir(parents = True, exist_ok = True)
+        with open(path_schedule, 'w') as f:
+            json.dump(schedule, f)
+
+    return schedule
+
+def extract_season_game_codes(schedule, completed_only = True):
+
+    """
+    Lists the game codes of all regular season and playoff games in a schedule.
+
+    :param schedule: dict containing schedule data, as returned by download_schedule
+    :param completed_only: only include games whose status is final
+    :return: sorted list of game codes
+    """
+
+    game_codes = set()
+    for day in schedule.get('dates', []):
+        for game in day['games']:
+            if str(game['gamePk'])[4:6] not in ('02', '03'):
+                continue ## ignore pre-season and all-star games
+            if completed_only and game['status']['detailedState'] != 'Final':
+                continue
+            game_codes.add(str(game['gamePk']))
+
+    return sorted(game_codes)
+
+def download_season(season, ingest, concurrency = CONCURRENCY, rate = REQUESTS_PER_SECOND,
+                    base_url = API_BASE_URL, session = None, path_archive = PATH_FEEDS):
+
+    """
+    Downloads every completed regular season and playoff game for a season that is not
+    already in the db, and adds them to the boxscore table as they arrive (the ingest
+    session commits every batch_size games). The games to fetch are enumerated from the
+    season schedule, so no requests are spent on non-existent games.
+
+    :param season: start year for a particular season
+    :param ingest: IngestSession for the db
+    :param concurrency: number of downloads in flight at once
+    :param rate: maximum sustained requests per second
+    :param base_url: root of the stats api
+    :param session: optional requests session
+    :param path_archive: root directory of the raw feed archive (None disables the archive)
+    :return: tuple with the number of games added and the list of game codes that failed to download
+    """
+
+    with span('download.schedule'):
+        schedule = download_schedule(season, base_url = base_url, session = session)
+        game_codes = [game_code for game_code in extract_season_game_codes(schedule) if game_code not in ingest]
+
+    n_games = 0
+
+    def add_feed(game_code, data):
+        nonlocal n_games
+        if is_completed_game(data):
+            ingest.add(extract_boxscore_data(data))
+            n_games += 1
+
+    with span('download.games'):
+        _, failed = download_games(game_codes, add_feed, concurrency = concurrency, rate = rate, base_url = base_url,
+                                   session = session, path_archive = path_archive)
+
+    with span('download.ingest'):
+        ingest.flush()
+
+    return n_games, failed
 
 
 ## SCRIPT ##
@@ -189,33 +464,24 @@ SEASONS = [2010, 2011, 2012, 2013, 2014, 2015, 2016, 2017, 2018, 2019, 2020]
 
 if __name__ == "__main__":
 
+    start_run('download')
     conn, cursor = create_database_connection(PATH_DB)
-
-    print('downloading regular season game data...')
-    for season in SEASONS:
-        print(season)
-        cont = True
-        game = 0
-        while cont:
-            game += 1
-            cont = add_boxscore_to_db(season, 2, game, conn, cursor) ## True if the game exists / is complete, False otherwise
-
-    print('downloading post-season game data...')
-    for season in SEASONS:
-        print(season)
-        for round in [1,2,3,4]:
-            series = 0
-            cont = True
-            while cont:
-                series += 1
-                game_number = 0
-                while cont:
-                    game_number += 1
-                    game_num = '0' + str(round) + str(series) + str(game_number) ## game id more complex for playoffs than reg seson
-                    cont = add_boxscore_to_db(season, 3, game_num, conn, cursor)
-                if game_number > 1:
-                    cont = True
-
+    session = create_session(CONCURRENCY)
+
+    with IngestSession(conn, cursor) as ingest:
+        for season in SEASONS:
+            try:
+                n_games, failed = download_season(season, ingest, session = session)
+            except (RequestException, ValueError) as error:
+                print(f'{season}: schedule failed to download ({error}), skipping the season')
+                continue
+            print(f'{season}: {n_games} games added to database')
+            if len(failed) > 0:
+                print(f'{season}: {len(failed)} games failed to download ({", ".join(failed)}), rerun to retry them')
+
+    migrate_database(conn, cursor)
     conn.close()
 
+    print(f'run report written to {finish_run()}')
+
 
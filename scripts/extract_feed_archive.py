@@ -0,0 +1,135 @@
+"""
+This script rebuilds the boxscore table from the raw live feed archive, re-running
+extract_boxscore_data over every archived game in a process pool. It is used to add a
+new stat column without downloading every season again: add the column to
+queries/create_table_boxscore and extract_boxscore_data, then run e.g.
+
+    python -m scripts.extract_feed_archive --fields away_hits home_hits
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import argparse
+import os
+
+from scripts.helper import create_database_connection, execute_query, execute_query_many, write_rows, add_missing_columns
+from scripts.feed_archive import PATH_FEEDS, read_feed, list_archived_game_codes
+from scripts.download_game_data import extract_boxscore_data, is_completed_game
+
+PATH_DB = Path('data/raw/nhl.db')
+PATH_QUERIES = Path('queries')
+
+CHUNK_SIZE = 200 ## games parsed per task sent to a worker
+TRANSACTION_SIZE = 5000 ## rows written between commits
+
+## FUNCTIONS ##
+
+def extract_archived_rows(game_codes, fields = None, path_archive = PATH_FEEDS):
+
+    """
+    Reads and extracts the boxscore data for a chunk of archived games. Runs in a worker process.
+
+    :param game_codes: list of game codes
+    :param fields: optional list of boxscore fields to keep (game_id is always kept)
+    :param path_archive: root directory of the raw feed archive
+    :return: tuple with the list of column names and the list of value tuples
+    """
+
+    keys = fields
+    rows = []
+    for game_code in game_codes:
+        data = read_feed(game_code, path_archive)
+        if data is None or not is_completed_game(data):
+            continue
+        dict_data = extract_boxscore_data(data)
+        if keys is None:
+            keys = list(dict_data.keys())
+        rows.append(tuple(dict_data[key] for key in keys))
+
+    return keys, rows
+
+def write_boxscore_rows(rows, keys, cursor, update_only):
+
+    """
+    Writes extracted rows to the boxscore table. Full rows replace any existing entry
+    for the game; a subset of fields only updates those columns on existing games.
+
+    :param rows: list of value tuples ordered as keys
+    :param keys: column names, starting with game_id
+    :param cursor: cursor for the db
+    :param update_only: whether to update existing rows rather than insert full rows
+    :return: no return
+    """
+
+    if update_only:
+        execute_query_many(PATH_QUERIES/'update_entry', cursor,
+                           values_list = [row[1:] + row[:1] for row in rows],
+                           replacements = {'xtablex' : 'boxscore',
+                                           'xupdatesx' : ', '.join([f'{key} = ?' for key in keys[1:]]),
+                                           'xkeyx' : 'game_id'})
+    else:
+        write_rows(rows, keys, 'boxscore', cursor, on_conflict = 'REPLACE')
+
+def rebuild_boxscore_from_archive(conn, cursor, seasons = None, fields = None, workers = None, path_archive = PATH_FEEDS):
+
+    """
+    Re-extracts every archived game in parallel and streams the results into the
+    boxscore table in large transactions.
+
+    :param conn: conn for the db
+    :param cursor: cursor for the db
+    :param seasons: optional iterable of seasons to restrict to
+    :param fields: optional list of boxscore fields to extract; when given, only those
+                   columns are updated on games already in the table
+    :param workers: number of worker processes (defaults to the number of cores)
+    :param path_archive: root directory of the raw feed archive
+    :return: tuple with the number of games written and the elapsed time in seconds
+    """
+
+    start = perf_counter()
+
+    if fields is not None:
+        fields = ['game_id'] + [field for field in fields if field != 'game_id']
+
+    ## make sure the table (and any newly added column) exists before writing
+    execute_query(PATH_QUERIES/'create_table_boxscore', cursor)
+    added_columns = add_missing_columns(PATH_QUERIES/'create_table_boxscore', cursor, 'boxscore')
+    if len(added_columns) > 0:
+        print(f'added columns: {", ".join(added_columns)}')
+    conn.commit()
+
+    game_codes = list_archived_game_codes(seasons, path_archive)
+    chunks = [game_codes[i:i + CHUNK_SIZE] for i in range(0, len(game_codes), CHUNK_SIZE)]
+
+    n_written = 0
+    buffer = []
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        results = executor.map(extract_archived_rows, chunks, [fields] * len(chunks), [path_archive] * len(chunks))
+        for i, (keys, rows) in enumerate(results):
+            buffer += rows
+            if len(buffer) >= TRANSACTION_SIZE or (i == len(chunks) - 1 and len(buffer) > 0):
+                write_boxscore_rows(buffer, keys, cursor, update_only = fields is not None)
+                conn.commit()
+                n_written += len(buffer)
+                buffer = []
+
+    return n_written, perf_counter() - start
+
+
+## SCRIPT ##
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Rebuild the boxscore table from the raw feed archive.')
+    parser.add_argument('--seasons', type = int, nargs = '+', help = 'seasons to rebuild (default: all archived seasons)')
+    parser.add_argument('--fields', nargs = '+', help = 'boxscore fields to update (default: rewrite full rows)')
+    parser.add_argument('--workers', type = int, default = os.cpu_count(), help = 'number of worker processes')
+    args = parser.parse_args()
+
+    conn, cursor = create_database_connection(PATH_DB)
+    n_games, elapsed = rebuild_boxscore_from_archive(conn, cursor, seasons = args.seasons, fields = args.fields, workers = args.workers)
+    print(f'{n_games} games written in {elapsed:.1f}s ({n_games / max(elapsed, 1e-9):.0f} games/sec)')
+    conn.close()
@@ -0,0 +1,8 @@
+"""
+Definitions of the model's features, shared by features.py and the team state snapshot
+(team_state.py). Kept free of pandas, so that numpy-only prediction (predict_fast.py)
+can import them without pandas' import time.
+"""
+
+BASELINE_STATS = ['wins', 'goals_for', 'goals_against', 'shots_for', 'shots_against']
+WEIGHT_PREV_SEASON = 10 # consider previous season to be equivalent to this many games
@@ -0,0 +1,215 @@
+"""
+Columnar, versioned store of the mlfeatures table, replacing the csv handoff between
+build_ml_dataset.py and train_model.py. Each version is a directory holding one .npy file
+per column per season, with typed columns (float32 features, small ints for ids and flags),
+so that loading reads (or memory-maps) only the columns and seasons needed. Each version's
+manifest records the pipeline inputs (upstream table sizes and code) that produced it.
+
+    data/processed/feature_store/LATEST
+    data/processed/feature_store/<version>/manifest.json
+    data/processed/feature_store/<version>/season=<season>/<column>.npy
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from datetime import datetime, timezone
+import hashlib
+import shutil
+import json
+import os
+import pandas as pd
+import numpy as np
+
+from scripts.features import hash_feature_rows
+
+PATH_FEATURE_STORE = Path('data/processed/feature_store')
+PATH_SCRIPTS = Path('scripts')
+
+COLUMN_DTYPES = {'game_id': 'int64', 'game_type': 'int8', 'season': 'int16', 'datetime': 'datetime64[s]',
+                 'away_franchise_id': 'int16', 'home_franchise_id': 'int16', 'home_win': 'int8'}
+FEATURE_DTYPE = 'float32' ## every other column of mlfeatures
+
+## upstream tables whose size (and latest game, where they have a datetime) identify the inputs of a version;
+## mlfeatures is also digested by value, since replacing changed rows keeps its size and latest game
+INPUT_TABLES = {'boxscore': True, 'boxscore_processed': True, 'team_baselines': False, 'mlfeatures': True}
+INPUT_SCRIPTS = ['process_feed_data.py', 'features.py', 'build_ml_dataset.py']
+
+## FUNCTIONS ##
+
+def compute_pipeline_inputs(conn, seasons, input_tables = INPUT_TABLES, input_scripts = INPUT_SCRIPTS):
+
+    """
+    Describes the inputs a feature store version (or any pipeline stage, see pipeline.py) is
+    built from: the row count and latest datetime of each upstream table (plus a digest of
+    the mlfeatures rows, see compute_features_digest), and a hash of the code that transforms them.
+
+    :param conn: conn for the db
+    :param seasons: seasons being exported
+    :param input_tables: dict mapping upstream table to whether it has a datetime column
+    :param input_scripts: file names of the scripts (in PATH_SCRIPTS) that transform the tables
+    :return: dict describing the inputs
+    """
+
+    season_string = ', '.join([str(int(season)) for season in seasons])
+    tables = {}
+    for table, has_datetime in input_tables.items():
+        if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is None:
+            continue
+        columns = 'COUNT(*), MAX(datetime)' if has_datetime else 'COUNT(*), NULL'
+        n_rows, max_datetime = conn.execute(f'SELECT {columns} FROM {table} WHERE season IN ({season_string})').fetchone()
+        tables[table] = {'rows': n_rows, 'max_datetime': max_datetime}
+        if table == 'mlfeatures':
+            tables[table]['digest'] = compute_features_digest(conn, seasons)
+
+    code = hashlib.sha1()
+    for script in input_scripts:
+        code.update((PATH_SCRIPTS/script).read_bytes())
+
+    return {'seasons': [int(season) for season in seasons], 'tables': tables, 'code': code.hexdigest()}
+
+def compute_features_digest(conn, seasons):
+
+    """
+    Digests the mlfeatures rows of each season by value, as the sum of their row hashes (see
+    features.hash_feature_rows), so that rows replaced in place change the digest.
+
+    :param conn: conn for the db
+    :param seasons: iterable of seasons
+    :return: dict mapping season (as a string) to its digest
+    """
+
+    digests = {}
+    for season in seasons:
+        df = pd.read_sql_query(f'SELECT * FROM mlfeatures WHERE season = {int(season)}', conn)
+        digests[str(int(season))] = str(hash_feature_rows(df).sum()) if df.shape[0] > 0 else None
+
+    return digests
+
+def to_column_array(values, column):
+
+    """
+    Converts a column of the mlfeatures table to its typed store array.
+
+    :param values: series of column values
+    :param column: column name
+    :return: numpy array
+    """
+
+    if column == 'datetime':
+        return pd.to_datetime(values, utc = True).dt.tz_localize(None).to_numpy().astype('datetime64[s]')
+
+    return values.to_numpy().astype(COLUMN_DTYPES.get(column, FEATURE_DTYPE))
+
+def get_latest_version(path = PATH_FEATURE_STORE):
+
+    """
+    Looks up the most recently exported version of the store.
+
+    :param path: root directory of the store
+    :return: version id, or None if nothing has been exported
+    """
+
+    path_latest = Path(path)/'LATEST'
+    if not path_latest.exists():
+        return None
+
+    return path_latest.read_text().strip()
+
+def read_manifest(version = None, path = PATH_FEATURE_STORE):
+
+    """
+    Reads the manifest of a version of the store.
+
+    :param version: version id (defaults to the latest)
+    :param path: root directory of the store
+    :return: dict with the version's seasons, columns, dtypes and inputs
+    """
+
+    version = version or get_latest_version(path)
+    if version is None:
+        raise FileNotFoundError(f'No feature store version found in {path}')
+
+    with open(Path(path)/version/'manifest.json') as f:
+        return json.load(f)
+
+def export_feature_store(conn, seasons, path = PATH_FEATURE_STORE):
+
+    """
+    Exports the mlfeatures rows of the given seasons as a new version of the store. The
+    version id is a hash of the pipeline inputs, so re-exporting unchanged inputs is a no-op.
+    The version is written to a temporary directory and renamed into place once complete.
+
+    :param conn: conn for the db
+    :param seasons: seasons to export
+    :param path: root directory of the store
+    :return: version id
+    """
+
+    inputs = compute_pipeline_inputs(conn, seasons)
+    version = hashlib.sha1(json.dumps(inputs, sort_keys = True).encode()).hexdigest()[:12]
+    path_version = Path(path)/version
+
+    if not (path_version/'manifest.json').exists():
+
+        path_tmp = Path(path)/f'.{version}.tmp'
+        shutil.rmtree(path_tmp, ignore_errors = True)
+
+        season_rows = {}
+        for season in seasons:
+            df = pd.read_sql_query(f'SELECT * FROM mlfeatures WHERE season = {int(season)} ORDER BY datetime, game_id', conn)
+            path_season = path_tmp/f'season={int(season)}'
+            path_season.mkdir(parents = True)
+            for column in df.columns:
+                np.save(path_season/f'{column}.npy', to_column_array(df[column], column))
+            season_rows[int(season)] = df.shape[0]
+
+        manifest = {'version': version,
+                    'created_at': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                    'seasons': season_rows,
+                    'columns': {column: COLUMN_DTYPES.get(column, FEATURE_DTYPE) for column in df.columns},
+                    'inputs': inputs}
+        with open(path_tmp/'manifest.json', 'w') as f:
+            json.dump(manifest, f, indent = 2)
+
+        shutil.rmtree(path_version, ignore_errors = True) ## an earlier export that didn't complete
+        os.replace(path_tmp, path_version)
+
+    (Path(path)/'LATEST').write_text(version)
+
+    return version
+
+def load_features(columns = None, seasons = None, version = None, path = PATH_FEATURE_STORE, as_frame = True):
+
+    """
+    Loads columns of the store for some seasons. Only the requested columns and seasons are
+    read from disk; a single season's columns are memory-mapped and returned without copying,
+    while several seasons are read straight into their concatenation.
+
+    :param columns: columns to load (defaults to all)
+    :param seasons: seasons to load (defaults to all in the version)
+    :param version: version id (defaults to the latest)
+    :param path: root directory of the store
+    :param as_frame: return a dataframe rather than a dict of arrays
+    :return: dataframe, or dict mapping column to array
+    """
+
+    manifest = read_manifest(version, path)
+    columns = columns or list(manifest['columns'])
+    seasons = list(manifest['seasons']) if seasons is None else [str(int(season)) for season in seasons]
+
+    missing = [season for season in seasons if season not in manifest['seasons']]
+    if len(missing) > 0:
+        raise KeyError(f"Seasons {missing} not in feature store version {manifest['version']}")
+
+    path_version = Path(path)/manifest['version']
+    arrays = {}
+    for column in columns:
+        parts = [np.load(path_version/f'season={season}'/f'{column}.npy', mmap_mode = 'r' if len(seasons) == 1 else None)
+                 for season in seasons]
+        arrays[column] = parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    if as_frame:
+        return pd.DataFrame(arrays)
+
+    return arrays
@@ -0,0 +1,272 @@
+"""
+Feature engineering shared by the training dataset build (build_ml_dataset.py) and
+prediction (predict_game_outcomes.py), so that both compute features the same way.
+"""
+
+## SETUP ##
+
+from pathlib import Path
+import pandas as pd
+import numpy as np
+
+from scripts.helper import execute_query, write_dataframe
+from scripts.feature_config import BASELINE_STATS, WEIGHT_PREV_SEASON
+
+PATH_QUERIES = Path('queries')
+
+## FUNCTIONS ##
+
+def weight_season_stats(df, previous, current, games_played, weight_previous_season):
+
+    """
+    Computes a weighted average for a statistic including the previous year as equivalent
+    to weight_previous_season games from the current year.
+
+    :param df: dataframe including game-by-game data
+    :param previous: column containing previous year's stat
+    :param current: column containing this year's stat
+    :param games_played: column containing number of games played so far this year
+    :param weight_previous_season: weight of previous season
+    :return: weighted stat
+    """
+
+    return (weight_previous_season * df[previous] + df[current]) / (df[games_played] + weight_previous_season)
+
+def compute_previous_season_baselines(conn):
+
+    """
+    Computes every team's per-game stats over the previous season, for all seasons at once.
+    Teams that didn't exist in the previous season (e.g. expansion teams) are given the
+    mean of the other teams' per-game stats from that season, as soon as they have played
+    a processed game (home or away).
+
+    :param conn: conn for the db
+    :return: dataframe with columns season, franchise_id and previous_{stat}_per_game, where
+             season is the season the baseline applies to (i.e. the season after the stats)
+    """
+
+    ## each team's final row of each season, in a single query
+    stat_cols = ', '.join([f't.{stat}_after' for stat in BASELINE_STATS])
+    query = f"""SELECT t.season, t.franchise_id, t.games_played_after, {stat_cols}
+                FROM boxscore_processed_team t
+                JOIN (SELECT season, franchise_id, MAX(games_played_after) AS games_played_after
+                      FROM boxscore_processed_team GROUP BY season, franchise_id) m
+                ON t.season = m.season AND t.franchise_id = m.franchise_id AND t.games_played_after = m.games_played_after"""
+    df_final = pd.read_sql_query(query, conn)
+
+    df_baselines = pd.DataFrame({'season': df_final['season'] + 1, 'franchise_id': df_final['franchise_id']})
+    for stat in BASELINE_STATS:
+        df_baselines[f'previous_{stat}_per_game'] = df_final[f'{stat}_after'] / df_final['games_played_after']
+
+    ## impute the previous season's mean for teams that didn't exist last season
+    baseline_cols = [f'previous_{stat}_per_game' for stat in BASELINE_STATS]
+    df_means = df_baselines.groupby('season')[baseline_cols].agg(lambda values: values.mean()).reset_index()
+    df_teams = pd.read_sql_query("""SELECT DISTINCT season, home_franchise_id AS franchise_id FROM boxscore_processed
+                                    UNION SELECT DISTINCT season, away_franchise_id AS franchise_id FROM boxscore_processed""", conn)
+    df_new_teams = pd.merge(df_teams, df_baselines[['season', 'franchise_id']], how = 'left', indicator = True)
+    df_new_teams = df_new_teams[df_new_teams['_merge'] == 'left_only'].drop(columns = '_merge')
+    df_new_teams = pd.merge(df_new_teams, df_means, on = 'season') ## only seasons that have a previous season
+
+    df_baselines = pd.concat([df_baselines, df_new_teams], ignore_index = True)
+
+    return df_baselines.sort_values(['season', 'franchise_id']).reset_index(drop = True)
+
+def impute_missing_baselines(df_baselines, df_queries):
+
+    """
+    Adds a baseline for every (season, team) pair of df_queries that has none, e.g. an
+    expansion team before any of its games has been processed: the mean of the baselines of
+    the season's other teams, as compute_previous_season_baselines imputes once it has played.
+    Seasons without any baselines (the first season of data) are left without.
+
+    :param df_baselines: previous-season baselines, as returned by load_team_baselines
+    :param df_queries: dataframe with columns franchise_id and season
+    :return: df_baselines with a row added for each missing pair
+    """
+
+    baseline_cols = [f'previous_{stat}_per_game' for stat in BASELINE_STATS]
+    df_pairs = df_queries[['season', 'franchise_id']].drop_duplicates().astype('int64')
+    df_known = df_baselines[['season', 'franchise_id']].astype('int64')
+    df_missing = pd.merge(df_pairs, df_known, how = 'left', indicator = True)
+    df_missing = df_missing[df_missing['_merge'] == 'left_only'].drop(columns = '_merge')
+    if df_missing.shape[0] == 0:
+        return df_baselines
+
+    df_means = df_baselines.astype({'season': 'int64'}).groupby('season')[baseline_cols].mean().reset_index()
+    df_missing = pd.merge(df_missing, df_means, on = 'season') ## only seasons that have baselines
+
+    return pd.concat([df_baselines, df_missing], ignore_index = True)
+
+def materialize_team_baselines(conn, cursor):
+
+    """
+    Computes the previous-season baselines for all teams and seasons and saves them to
+    the team_baselines table, replacing any existing rows.
+
+    :param conn: conn for the db
+    :param cursor: cursor for the db
+    :return: dataframe as returned by compute_previous_season_baselines
+    """
+
+    df_baselines = compute_previous_season_baselines(conn)
+
+    execute_query(PATH_QUERIES/'create_table_team_baselines', cursor)
+    write_dataframe(df_baselines, 'team_baselines', cursor, on_conflict = 'REPLACE')
+    conn.commit()
+
+    return df_baselines
+
+def load_team_baselines(conn, season = None):
+
+    """
+    Reads the previous-season baselines from the team_baselines table.
+
+    :param conn: conn for the db
+    :param season: optional season to restrict to
+    :return: dataframe with columns season, franchise_id and previous_{stat}_per_game
+    """
+
+    if season is None:
+        return pd.read_sql_query('SELECT * FROM team_baselines', conn)
+
+    return pd.read_sql_query(f'SELECT * FROM team_baselines WHERE season = {season}', conn)
+
+def load_team_state(conn, seasons):
+
+    """
+    Reads every team's cumulative totals after each game of the given seasons, in a single query.
+
+    :param conn: conn for the db
+    :param seasons: iterable of seasons
+    :return: dataframe with columns season, franchise_id, datetime, games_played_after and {stat}_after
+    """
+
+    season_string = ', '.join([str(int(season)) for season in seasons])
+    stat_cols = ', '.join([f'{stat}_after' for stat in BASELINE_STATS])
+    query = f"""SELECT season, franchise_id, datetime, games_played_after, {stat_cols}
+                FROM boxscore_processed_team WHERE season IN ({season_string})"""
+
+    return pd.read_sql_query(query, conn)
+
+def encode_team_times(franchise_ids, seasons, datetimes):
+
+    """
+    Encodes (season, franchise, datetime) triples as single int64 keys that sort by team-season
+    first and datetime second, so that point-in-time lookups are one np.searchsorted.
+
+    :param franchise_ids: array of franchise ids
+    :param seasons: array of seasons
+    :param datetimes: utc datetimes (or strings)
+    :return: array of int64 keys
+    """
+
+    team_keys = 1000 * np.asarray(seasons, dtype = 'int64') + np.asarray(franchise_ids, dtype = 'int64')
+    seconds = (pd.DatetimeIndex(pd.to_datetime(datetimes, utc = True)) - pd.Timestamp(0, tz = 'UTC')) // pd.Timedelta(seconds = 1)
+
+    return (team_keys << 32) + np.asarray(seconds, dtype = 'int64')
+
+def prepare_point_in_time_lookup(df_state, df_baselines):
+
+    """
+    Arranges the team totals and previous-season baselines as arrays sorted by team-season
+    (and datetime), for lookup_point_in_time_features. Build once and reuse it to featurize
+    many batches against the same state (e.g. in prediction_server.py).
+
+    :param df_state: team totals, as returned by load_team_state
+    :param df_baselines: previous-season baselines, as returned by compute_previous_season_baselines
+    :return: dict with the state and baseline arrays
+    """
+
+    keys = encode_team_times(df_state['franchise_id'], df_state['season'], df_state['datetime'])
+    order = np.argsort(keys, kind = 'stable')
+    state = {'keys': keys[order]}
+    for col in ['games_played_after'] + [f'{stat}_after' for stat in BASELINE_STATS]:
+        state[col] = df_state[col].to_numpy(dtype = 'float64')[order]
+
+    baseline_keys = 1000 * df_baselines['season'].to_numpy(dtype = 'int64') + df_baselines['franchise_id'].to_numpy(dtype = 'int64')
+    order = np.argsort(baseline_keys, kind = 'stable')
+    baselines = {'keys': baseline_keys[order]}
+    for stat in BASELINE_STATS:
+        baselines[f'previous_{stat}_per_game'] = df_baselines[f'previous_{stat}_per_game'].to_numpy(dtype = 'float64')[order]
+
+    return {'state': state, 'baselines': baselines}
+
+def lookup_point_in_time_features(lookup, franchise_ids, seasons, datetimes, weight_previous_season = WEIGHT_PREV_SEASON):
+
+    """
+    Computes the weighted per-game features of a batch of (team, as-of datetime) pairs with
+    array operations. Each team's season totals are taken from its last game strictly before
+    the as-of datetime (zero if it hasn't played yet), and combined with its previous-season
+    baseline, weighted as weight_previous_season games.
+
+    :param lookup: dict as returned by prepare_point_in_time_lookup
+    :param franchise_ids: array of franchise ids
+    :param seasons: array of seasons
+    :param datetimes: as-of datetimes
+    :param weight_previous_season: weight of previous season
+    :return: dict mapping {stat}_per_game to an array of features (nan if the team-season has no baseline)
+    """
+
+    state, baselines = lookup['state'], lookup['baselines']
+    keys = encode_team_times(franchise_ids, seasons, datetimes)
+    team_keys = keys >> 32
+
+    ## latest row strictly before each as-of datetime, if it belongs to the same team-season
+    ## (indexing only the matched rows, so that empty state works)
+    rows = np.searchsorted(state['keys'], keys, side = 'left') - 1
+    has_played = rows >= 0
+    has_played[has_played] = (state['keys'][rows[has_played]] >> 32) == team_keys[has_played]
+    totals = {}
+    for col, values in state.items():
+        if col != 'keys':
+            totals[col] = np.zeros(keys.shape[0])
+            totals[col][has_played] = values[rows[has_played]]
+
+    positions = np.searchsorted(baselines['keys'], team_keys)
+    has_baseline = positions < baselines['keys'].shape[0]
+    has_baseline[has_baseline] = baselines['keys'][positions[has_baseline]] == team_keys[has_baseline]
+    for stat in BASELINE_STATS:
+        totals[f'previous_{stat}_per_game'] = np.full(keys.shape[0], np.nan)
+        totals[f'previous_{stat}_per_game'][has_baseline] = baselines[f'previous_{stat}_per_game'][positions[has_baseline]]
+
+    return {f'{stat}_per_game': weight_season_stats(totals, f'previous_{stat}_per_game', f'{stat}_after',
+                                                    'games_played_after', weight_previous_season)
+            for stat in BASELINE_STATS}
+
+def compute_point_in_time_features(df_queries, df_state, df_baselines, weight_previous_season = WEIGHT_PREV_SEASON):
+
+    """
+    Computes the weighted per-game features of a batch of (team, as-of date) pairs with array
+    operations (see lookup_point_in_time_features).
+
+    :param df_queries: dataframe with columns franchise_id, season and datetime (the as-of datetime)
+    :param df_state: team totals, as returned by load_team_state
+    :param df_baselines: previous-season baselines, as returned by compute_previous_season_baselines
+    :param weight_previous_season: weight of previous season
+    :return: dataframe with a {stat}_per_game column per stat, aligned with the rows of df_queries
+    """
+
+    lookup = prepare_point_in_time_lookup(df_state, df_baselines)
+    features = lookup_point_in_time_features(lookup, df_queries['franchise_id'], df_queries['season'], df_queries['datetime'],
+                                             weight_previous_season)
+
+    return pd.DataFrame(features, index = df_queries.index)
+
+def hash_feature_rows(df):
+
+    """
+    Hashes each row of a features dataframe, after normalizing the dtypes that change
+    on a round trip through sqlite (e.g. home_win is read back as an int).
+
+    :param df: dataframe with the columns of the mlfeatures table
+    :return: series of row hashes indexed by game_id
+    """
+
+    df = df.set_index('game_id')
+    df = df.assign(home_win = df['home_win'].astype('int64'),
+                   game_type = df['game_type'].astype('int64'),
+                   season = df['season'].astype('int64'),
+                   away_franchise_id = df['away_franchise_id'].astype('int64'),
+                   home_franchise_id = df['home_franchise_id'].astype('int64'))
+
+    return pd.util.hash_pandas_object(df, index = False)
@@ -0,0 +1,105 @@
+"""
+On-disk archive of raw live feed payloads. Each completed game's full live feed json
+is stored gzip-compressed in its own file, grouped by season, so that boxscore data
+can be re-extracted offline without downloading the feeds again.
+"""
+
+## SETUP ##
+
+from pathlib import Path
+import gzip
+import json
+import os
+
+PATH_FEEDS = Path('data/raw/feeds')
+COMPRESS_LEVEL = 6
+
+## FUNCTIONS ##
+
+def get_feed_path(game_code, path_archive = PATH_FEEDS):
+
+    """
+    Returns the path at which a game's live feed is archived. Feeds are grouped
+    into one directory per season (the first four digits of the game code).
+
+    :param game_code: game code (e.g. '2019020001')
+    :param path_archive: root directory of the archive
+    :return: path to the archived feed
+    """
+
+    game_code = str(game_code)
+
+    return Path(path_archive)/game_code[:4]/f'{game_code}.json.gz'
+
+def read_feed(game_code, path_archive = PATH_FEEDS):
+
+    """
+    Reads a game's live feed from the archive.
+
+    :param game_code: game code (e.g. '2019020001')
+    :param path_archive: root directory of the archive
+    :return: dict containing live feed data, or None if the game isn't archived
+    """
+
+    path_feed = get_feed_path(game_code, path_archive)
+    if not path_feed.exists():
+        return None
+
+    with gzip.open(path_feed, 'rt') as f:
+        return json.load(f)
+
+def write_feed(dict_live, path_archive = PATH_FEEDS):
+
+    """
+    Writes a game's live feed to the archive. The file is written under a temporary
+    name and then renamed, so a partially written feed is never read back.
+
+    :param dict_live: dict containing live feed data
+    :param path_archive: root directory of the archive
+    :return: path to the archived feed
+    """
+
+    path_feed = get_feed_path(dict_live['gamePk'], path_archive)
+    path_feed.parent.mkdir(parents = True, exist_ok = True)
+
+    path_tmp = path_feed.with_name(f'{path_feed.name}.{os.getpid()}.tmp')
+    with gzip.open(path_tmp, 'wt', compresslevel = COMPRESS_LEVEL) as f:
+        json.dump(dict_live, f, separators = (',', ':'))
+    os.replace(path_tmp, path_feed)
+
+    return path_feed
+
+def list_archived_game_codes(seasons = None, path_archive = PATH_FEEDS):
+
+    """
+    Lists the game codes of all archived feeds.
+
+    :param seasons: optional iterable of seasons to restrict to
+    :param path_archive: root directory of the archive
+    :return: sorted list of game codes
+    """
+
+    path_archive = Path(path_archive)
+    if seasons is None:
+        season_dirs = [path for path in path_archive.glob('*') if path.is_dir()]
+    else:
+        season_dirs = [path_archive/str(season) for season in seasons]
+
+    game_codes = [path_feed.name[:-len('.json.gz')]
+                  for season_dir in season_dirs
+                  for path_feed in season_dir.glob('*.json.gz')]
+
+    return sorted(game_codes)
+
+def iter_archived_feeds(seasons = None, path_archive = PATH_FEEDS):
+
+    """
+    Iterates over all archived feeds, in game code order.
+
+    :param seasons: optional iterable of seasons to restrict to
+    :param path_archive: root directory of the archive
+    :return: generator of live feed dicts
+    """
+
+    for game_code in list_archived_game_codes(seasons, path_archive):
+        yield read_feed(game_code, path_archive)
@@ -1,20 +1,208 @@
 
 import sqlite3
 import re
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scripts.instrumentation import count, reset, collect, merge
 
-def create_database_connection(path):
+PATH_QUERIES = Path('queries')
+INSERT_QUERIES = {'IGNORE': 'insert_or_ignore_entry', 'REPLACE': 'insert_or_replace_entry'}
+
+MAX_PREPARED_QUERY_LENGTH = 10000 ## expanded queries longer than this (e.g. with inlined values) aren't cached
+
+## set on every connection: write-ahead logging (readers don't block the writer and commits
+## don't rewrite the db), fsync only at checkpoints, a 64MB page cache and memory-mapped reads
+SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -64000,
+                  'mmap_size': 256 * 1024 * 1024, 'temp_store': 'MEMORY'}
+
+## indexes for the pipeline's hot queries (filters on season, season and franchise, season and game type),
+## covering the columns those queries read; created by migrate_database on the tables that exist
+DATABASE_INDEXES = {'idx_boxscore_season_type': ('boxscore', ['season', 'game_type', 'datetime']),
+                    'idx_boxscore_processed_season': ('boxscore_processed', ['season', 'game_id']),
+                    'idx_boxscore_processed_season_home': ('boxscore_processed', ['season', 'home_franchise_id']),
+                    'idx_boxscore_processed_team_season_franchise': ('boxscore_processed_team', ['season', 'franchise_id', 'games_played_after']),
+                    'idx_mlfeatures_season': ('mlfeatures', ['season', 'datetime'])}
+ANALYSIS_LIMIT = 1000 ## rows sampled per index by ANALYZE, so it stays fast on a large db
+
+## column lists of each table of a database file, looked up once per (database file, table)
+## (in-memory databases keep their own, see DatabaseConnection)
+_TABLE_COLUMNS = {}
+
+## normalized query templates keyed by path, and expanded queries keyed by (path, replacements)
+_QUERY_TEMPLATES = {}
+_PREPARED_QUERIES = {}
+
+## connection of a worker process, opened by init_worker_connection
+_WORKER_CONN = None
+
+
+class DatabaseConnection(sqlite3.Connection):
 
     """
-    Given a path to a sqlite3 db, returns a conn and cursor to that db.
+    sqlite3 connection that looks up the file of its main database once, when it is opened,
+    and holds the column list cache of that database (see get_table_columns): the shared
+    cache for a database file, or a cache of its own for an in-memory database.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.database_path = self.execute('PRAGMA database_list').fetchone()[2] ## '' for an in-memory database
+        self.table_columns = _TABLE_COLUMNS if self.database_path != '' else {}
+
+
+def create_database_connection(path, pragmas = SQLITE_PRAGMAS):
+
+    """
+    Given a path to a sqlite3 db, returns a conn and cursor to that db, with the
+    connection tuned by the given pragmas.
     """
 
     ## connect to the database
-    conn = sqlite3.connect(str(path))
+    conn = sqlite3.connect(str(path), factory = DatabaseConnection)
     cursor = conn.cursor()
 
+    for pragma, value in pragmas.items():
+        cursor.execute(f'PRAGMA {pragma} = {value}')
+
     return conn, cursor
 
 
+def migrate_database(conn, cursor, indexes = DATABASE_INDEXES):
+
+    """
+    Brings the schema up to date: creates any missing indexes on the tables that exist,
+    then refreshes the query planner's statistics with ANALYZE.
+
+    :param conn: conn for db
+    :param cursor: cursor for db
+    :param indexes: dict mapping index name to (table, columns)
+    :return: list of names of the indexes on existing tables
+    """
+
+    tables = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()}
+
+    migrated = []
+    for index, (table, columns) in indexes.items():
+        if table in tables:
+            execute_query(PATH_QUERIES/'create_index', cursor,
+                          replacements = {'xindexx': index, 'xtablex': table, 'xcolumnsx': ', '.join(columns)})
+            migrated.append(index)
+
+    cursor.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+    cursor.execute('ANALYZE')
+    conn.commit()
+
+    return migrated
+
+
+def init_worker_connection(path):
+
+    """
+    Opens the connection a worker process reads the db with (see compute_seasons_parallel).
+    Also clears the spans and counters a forked worker inherits from its parent, so that
+    they aren't merged back into the parent's report a second time.
+
+    :param path: path of the db
+    :return: no output
+    """
+
+    reset()
+
+    global _WORKER_CONN
+    _WORKER_CONN, _ = create_database_connection(path)
+
+
+def compute_in_worker(function, season):
+
+    """
+    Calls function(season, conn) with the connection of the worker process, returning the
+    result with the spans and counters it recorded (for the caller to merge, see
+    instrumentation.merge).
+    """
+
+    result = function(season, _WORKER_CONN)
+
+    return result, collect()
+
+
+def compute_seasons_parallel(function, seasons, path, workers = None):
+
+    """
+    Computes function(season, conn) for each season in a pool of worker processes, each
+    reading the db through its own connection. Results are yielded as they complete, so
+    the caller can stay the db's only writer, writing each season while others compute.
+    The spans and counters recorded by the workers are merged into this process's.
+
+    :param function: picklable (module-level) function of a season and a conn, which only reads from the db
+    :param seasons: iterable of seasons
+    :param path: path of the db
+    :param workers: number of worker processes (defaults to the number of cpus)
+    :return: generator of (season, result) tuples, in order of completion
+    """
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = init_worker_connection, initargs = (str(path),)) as executor:
+        futures = {executor.submit(compute_in_worker, function, season): season for season in seasons}
+        for future in as_completed(futures):
+            result, recorded = future.result()
+            merge(recorded)
+            yield futures[future], result
+
+
+def load_query_template(query_path):
+
+    """
+    Reads a query script and normalizes its whitespace. Each file is only read once.
+
+    :param query_path: path to a text file containing a sql query
+    :return: query string
+    """
+
+    key = str(query_path)
+    if key not in _QUERY_TEMPLATES:
+
+        ## read in the query string
+        f = open(query_path)
+        query = f.read()
+        f.close()
+
+        ## clean up the query
+        query = re.sub('\n', ' ', query)
+        query = re.sub('\t', ' ', query)
+
+        _QUERY_TEMPLATES[key] = query
+
+    return _QUERY_TEMPLATES[key]
+
+
+def prepare_query(query_path, replacements = None):
+
+    """
+    Returns the query for a template with the replacements filled in. The expanded query is
+    cached per (template, replacements), so repeated calls (e.g. one per inserted row or batch)
+    do no string work, and sqlite's own statement cache sees the identical string each time.
+
+    :param query_path: path to a text file containing a sql query
+    :param replacements: dict with keys to be replaced by values in the query string
+    :return: query string
+    """
+
+    key = (str(query_path), None if replacements is None else tuple(replacements.items()))
+    if key in _PREPARED_QUERIES:
+        return _PREPARED_QUERIES[key]
+
+    query = load_query_template(query_path)
+
+    ## add in any variables if necessary
+    if replacements is not None:
+        for replacement in replacements.keys():
+            query = re.sub(replacement, replacements[replacement], query)
+
+    if len(query) <= MAX_PREPARED_QUERY_LENGTH:
+        _PREPARED_QUERIES[key] = query
+
+    return query
+
+
 def execute_query(query_path, cursor, values = None, replacements = None):
 
     """
@@ -27,22 +215,158 @@ def execute_query(query_path, cursor, values = None, replacements = None):
     :return: no output
     """
 
+    query = prepare_query(query_path, replacements)
+
+    ## execute the query, passing in values if they exist
+    if values is None:
+        cursor.execute(query)
+    else:
+        cursor.execute(query, values)
+    count('queries_issued')
+
+
+def execute_query_many(query_path, cursor, values_list, replacements = None):
+
+    """
+    Executes a query script once for each set of values, in a single executemany call.
+
+    :param query_path: path to a text file containing a sql query
+    :param cursor: cursor for db
+    :param values_list: iterable of value tuples used for inserts
+    :param replacements: dict with keys to be replaced by values in the query string
+    :return: no output
+    """
+
+    cursor.executemany(prepare_query(query_path, replacements), values_list)
+    count('queries_issued')
+
+
+def add_missing_columns(query_path, cursor, table):
+
+    """
+    Adds to an existing table any columns that are defined in its create table query
+    but are missing from the table (e.g. after a new stat is added to the query).
+
+    :param query_path: path to a text file containing a create table query
+    :param cursor: cursor for db
+    :param table: name of the table
+    :return: list of names of the columns that were added
+    """
+
     ## read in the query string
     f = open(query_path)
     query = f.read()
     f.close()
 
-    ## clean up the query
-    query = re.sub('\n', ' ', query)
-    query = re.sub('\t', ' ', query)
+    ## column definitions are the lines between the parentheses, excluding constraints
+    body = query[query.index('(') + 1:query.rindex(')')]
+    definitions = [line.strip().rstrip(',') for line in body.split('\n')]
+    definitions = [definition for definition in definitions if definition != '' and not definition.upper().startswith('UNIQUE')]
 
-    ## add in any variables if necessary
-    if replacements is not None:
-        for replacement in replacements.keys():
-            query = re.sub(replacement, replacements[replacement], query)
+    existing_columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})').fetchall()]
 
-    ## execute the query, passing in values if they exist
-    if values is None:
-        cursor.execute(query)
-    else:
-        cursor.execute(query, values)
\ No newline at end of file
+    added_columns = []
+    for definition in definitions:
+        column = definition.split()[0]
+        if column not in existing_columns:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {definition}')
+            added_columns.append(column)
+
+    ## the cached column list is now out of date
+    if len(added_columns) > 0:
+        cache, path = get_column_cache(cursor)
+        cache.pop((path, table), None)
+
+    return added_columns
+
+
+def get_column_cache(cursor):
+
+    """
+    Finds the column list cache of a cursor's database, without querying the db.
+
+    :param cursor: cursor for db
+    :return: tuple with the cache (a dict keyed by (database file, table)) and the database file;
+             an empty dict for connections not opened by create_database_connection, which aren't cached
+    """
+
+    connection = cursor.connection
+    if not isinstance(connection, DatabaseConnection):
+        return {}, None
+
+    return connection.table_columns, connection.database_path
+
+
+def get_table_columns(cursor, table, refresh = False):
+
+    """
+    Returns the column names of a table. The list is cached per database file and table
+    (see get_column_cache), so the schema is only looked up the first time (or when refresh
+    is True, or after add_missing_columns alters the table).
+
+    :param cursor: cursor for db
+    :param table: name of the table
+    :param refresh: whether to look the columns up again (e.g. after altering the table)
+    :return: list of column names
+    """
+
+    cache, path = get_column_cache(cursor)
+    if refresh or (path, table) not in cache:
+        cache[(path, table)] = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})').fetchall()]
+
+    return cache[(path, table)]
+
+
+def write_rows(rows, columns, table, cursor, on_conflict = 'IGNORE'):
+
+    """
+    Inserts many rows into a table with a single parameterized executemany call.
+
+    :param rows: iterable of value sequences (e.g. a list of tuples or a 2d array's .tolist())
+    :param columns: column names, in the order of the values in each row
+    :param table: name of the table
+    :param cursor: cursor for db
+    :param on_conflict: 'IGNORE' or 'REPLACE', for rows clashing with a unique constraint
+    :return: no output
+    """
+
+    table_columns = get_table_columns(cursor, table)
+    unknown_columns = [column for column in columns if column not in table_columns]
+    if len(unknown_columns) > 0:
+        raise ValueError(f'Columns not in table {table}: {", ".join(unknown_columns)}')
+
+    execute_query_many(PATH_QUERIES/INSERT_QUERIES[on_conflict], cursor,
+                       values_list = rows,
+                       replacements = {'xtablex' : table,
+                                       'xkeysx' : ', '.join(columns),
+                                       'xvaluesx' : '(' + ', '.join(['?'] * len(columns)) + ')'})
+    count('rows_written', max(cursor.rowcount, 0)) ## rows actually inserted or replaced, not ignored
+
+
+def write_dataframe(df, table, cursor, on_conflict = 'IGNORE'):
+
+    """
+    Inserts every row of a dataframe into a table with parameterized executemany.
+    Values are converted column by column to native python types, with NaN written as NULL.
+
+    :param df: dataframe whose columns are all columns of the table
+    :param table: name of the table
+    :param cursor: cursor for db
+    :param on_conflict: 'IGNORE' or 'REPLACE', for rows clashing with a unique constraint
+    :return: number of rows written
+    """
+
+    if df.shape[0] == 0:
+        return 0
+
+    columns_values = []
+    for column in df.columns:
+        values = df[column].tolist()
+        is_missing = df[column].isna().to_numpy()
+        if is_missing.any():
+            values = [None if missing else value for value, missing in zip(values, is_missing)]
+        columns_values.append(values)
+
+    write_rows(list(zip(*columns_values)), list(df.columns), table, cursor, on_conflict = on_conflict)
+
+    return df.shape[0]
@@ -0,0 +1,206 @@
+"""
+Timing and counting shared by the pipeline stages (download, process, build, predict).
+Code marks named spans (timed blocks) and bumps named counters (rows written, queries
+issued, bytes downloaded, cache hits); each stage's script wraps its run in start_run and
+finish_run, which dumps everything recorded as a json report. Setting the environment
+variable PIPELINE_PROFILE to cprofile and/or tracemalloc (comma separated) also captures a
+cProfile profile (saved next to the report) and the top memory allocation sites.
+
+Worker processes hand what they record back with their results (see collect and merge), so
+in parallel runs the spans of the workers are summed across processes and can add up to
+more than the wall time. Profilers only cover the main process.
+
+Only the standard library is imported here, and spans and counters are cheap enough to
+leave on; they aren't meant for per-row loops.
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from threading import Lock
+from time import perf_counter
+import resource
+import json
+import os
+
+PATH_REPORTS = Path('data/reports')
+PROFILE_ENV_VAR = 'PIPELINE_PROFILE'
+TRACEMALLOC_TOP = 20 ## allocation sites listed in the report
+
+## spans and counters recorded since the last reset, and the current run
+_SPANS = {}
+_COUNTERS = {}
+_RUN = {}
+_LOCK = Lock() ## download workers record from several threads
+
+## FUNCTIONS ##
+
+def reset():
+
+    """
+    Clears all recorded spans and counters.
+
+    :return: no return
+    """
+
+    with _LOCK:
+        _SPANS.clear()
+        _COUNTERS.clear()
+
+def count(name, n = 1):
+
+    """
+    Adds n to a named counter.
+
+    :param name: counter name, e.g. 'rows_written'
+    :param n: amount to add
+    :return: no return
+    """
+
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + n
+
+@contextmanager
+def span(name):
+
+    """
+    Times a block of code under a name. Spans with the same name accumulate their calls,
+    total and maximum time.
+
+        with span('process.compute'):
+            ...
+
+    :param name: span name, e.g. 'process.compute'
+    """
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start
+        with _LOCK:
+            stats = _SPANS.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+
+def collect():
+
+    """
+    Takes the spans and counters recorded since the last reset, clearing them. Worker
+    processes return these with each result, for the main process to merge.
+
+    :return: dict with the spans and counters
+    """
+
+    with _LOCK:
+        recorded = {'spans': dict(_SPANS), 'counters': dict(_COUNTERS)}
+        _SPANS.clear()
+        _COUNTERS.clear()
+
+    return recorded
+
+def merge(recorded):
+
+    """
+    Adds spans and counters recorded in another process (as returned by collect) to this
+    process's.
+
+    :param recorded: dict with the spans and counters
+    :return: no return
+    """
+
+    with _LOCK:
+        for name, other in recorded['spans'].items():
+            stats = _SPANS.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['calls'] += other['calls']
+            stats['seconds'] += other['seconds']
+            stats['max_seconds'] = max(stats['max_seconds'], other['max_seconds'])
+        for name, n in recorded['counters'].items():
+            _COUNTERS[name] = _COUNTERS.get(name, 0) + n
+
+def get_profile_modes():
+
+    """
+    Reads which profilers are switched on by the PIPELINE_PROFILE environment variable.
+
+    :return: set containing any of 'cprofile' and 'tracemalloc'
+    """
+
+    return {mode.strip().lower() for mode in os.environ.get(PROFILE_ENV_VAR, '').split(',')} & {'cprofile', 'tracemalloc'}
+
+def start_run(stage):
+
+    """
+    Starts recording a run of a pipeline stage: clears previous spans and counters and
+    starts any profilers switched on by PIPELINE_PROFILE.
+
+    :param stage: name of the stage, e.g. 'process'
+    :return: no return
+    """
+
+    reset()
+    _RUN.clear()
+    _RUN.update({'stage': stage, 'started_at': datetime.now(timezone.utc), 'start': perf_counter(),
+                 'modes': get_profile_modes()})
+
+    if 'tracemalloc' in _RUN['modes']:
+        import tracemalloc
+        tracemalloc.start()
+    if 'cprofile' in _RUN['modes']:
+        import cProfile
+        _RUN['profiler'] = cProfile.Profile()
+        _RUN['profiler'].enable()
+
+def get_report():
+
+    """
+    Collects everything recorded so far in the current run.
+
+    :return: dict with the run's stage, timing, peak rss, spans (slowest first) and counters
+    """
+
+    with _LOCK:
+        spans = dict(sorted(_SPANS.items(), key = lambda item: -item[1]['seconds']))
+        counters = dict(sorted(_COUNTERS.items()))
+
+    return {'stage': _RUN.get('stage'),
+            'started_at': _RUN['started_at'].strftime('%Y-%m-%dT%H:%M:%SZ') if 'started_at' in _RUN else None,
+            'wall_seconds': perf_counter() - _RUN['start'] if 'start' in _RUN else None,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, ## kilobytes on linux
+            'spans': spans,
+            'counters': counters}
+
+def finish_run(path = PATH_REPORTS):
+
+    """
+    Stops any profilers and saves the run's report as json (and its cProfile stats as .prof).
+
+    :param path: directory for reports
+    :return: path of the report
+    """
+
+    report = get_report()
+    name = f"{report['stage']}_{_RUN['started_at'].strftime('%Y%m%dT%H%M%S')}"
+    Path(path).mkdir(parents = True, exist_ok = True)
+
+    if 'profiler' in _RUN:
+        _RUN['profiler'].disable()
+        _RUN['profiler'].dump_stats(Path(path)/f'{name}.prof')
+        report['cprofile'] = str(Path(path)/f'{name}.prof')
+
+    if 'tracemalloc' in _RUN['modes']:
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        report['tracemalloc'] = {'peak_mb': tracemalloc.get_traced_memory()[1] / 1e6,
+                                 'top': [{'site': str(stat.traceback), 'mb': stat.size / 1e6, 'blocks': stat.count}
+                                         for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]]}
+        tracemalloc.stop()
+
+    path_report = Path(path)/f'{name}.json'
+    with open(path_report, 'w') as f:
+        json.dump(report, f, indent = 2)
+
+    return path_report
@@ -0,0 +1,67 @@
+"""
+Compact, dependency-free artifact of a fitted logistic model: its coefficients, intercept,
+feature order and cut-off saved as json, so that predicting only needs numpy (no sklearn
+unpickling). Only json, pathlib and numpy are imported here, to keep predictor start-up fast.
+"""
+
+## SETUP ##
+
+from pathlib import Path
+import json
+import numpy as np
+
+PATH_MODEL_ARTIFACT = Path('models/2021_04_20_logreg_win_percentage_only.json')
+
+## FUNCTIONS ##
+
+def export_model_artifact(model, features, cutoff, path = PATH_MODEL_ARTIFACT, **metadata):
+
+    """
+    Saves a fitted logistic model as a json artifact.
+
+    :param model: fitted binary LogisticRegression
+    :param features: feature names, in the order the model was fitted on
+    :param cutoff: probability above which the positive class is predicted
+    :param path: path of the json file
+    :param metadata: any other json-serializable values to record (e.g. the training seasons)
+    :return: dict saved to the artifact
+    """
+
+    artifact = {'features': list(features),
+                'coef': [float(coef) for coef in model.coef_[0]],
+                'intercept': float(model.intercept_[0]),
+                'cutoff': float(cutoff),
+                **metadata}
+
+    Path(path).parent.mkdir(parents = True, exist_ok = True)
+    with open(path, 'w') as f:
+        json.dump(artifact, f, indent = 2)
+
+    return artifact
+
+def load_model_artifact(path = PATH_MODEL_ARTIFACT):
+
+    """
+    Loads a json model artifact.
+
+    :param path: path of the json file
+    :return: dict with the artifact's values, with coef as a float64 array
+    """
+
+    with open(path) as f:
+        artifact = json.load(f)
+    artifact['coef'] = np.asarray(artifact['coef'], dtype = 'float64')
+
+    return artifact
+
+def predict_proba_from_artifact(artifact, X):
+
+    """
+    Computes the probability of the positive class, as the model's predict_proba would.
+
+    :param artifact: dict as returned by load_model_artifact
+    :param X: 2d array of features, with columns in the artifact's feature order
+    :return: array of probabilities
+    """
+
+    return 1 / (1 + np.exp(-(np.asarray(X, dtype = 'float64') @ artifact['coef'] + artifact['intercept'])))
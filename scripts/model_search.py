@@ -0,0 +1,208 @@
+"""
+This script searches feature subsets and LogisticRegression regularization settings, scoring
+each configuration with the walk-forward folds of backtest.py. The feature matrix is saved
+once as .npy files that every worker process memory-maps, so workers share the page cache
+instead of each receiving a copy. Configurations whose log loss over their first folds falls
+well behind the best finished configuration's over the same folds are stopped early. The
+result is a leaderboard table.
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations, product
+from multiprocessing import Array
+import argparse
+import pandas as pd
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+
+from scripts.helper import create_database_connection
+from scripts.features import BASELINE_STATS
+from scripts.backtest import TARGET, load_backtest_data, generate_folds, score_fold
+
+PATH_DB = Path('data/raw/nhl.db')
+PATH_SEARCH_MATRIX = Path('data/processed/search')
+
+C_VALUES = [0.01, 0.1, 1, 10, 100]
+PENALTIES = ['l2', 'l1']
+L1_RATIOS = {'l2': 0, 'l1': 1} ## sklearn deprecated penalty in favour of l1_ratio
+SOLVERS = {'l2': 'lbfgs', 'l1': 'liblinear'}
+WORKERS = 4
+EARLY_STOP_MIN_FOLDS = 2 ## folds every configuration is scored on before it can be stopped
+EARLY_STOP_TOLERANCE = 0.01 ## stop when the log loss so far is this fraction above the best finished configuration's
+
+## worker process state, set by init_worker
+_X = None
+_y = None
+_FOLDS = None
+_BEST = None
+
+## FUNCTIONS ##
+
+def save_search_matrix(df, features, path = PATH_SEARCH_MATRIX):
+
+    """
+    Saves the feature matrix and target as .npy files, for workers to memory-map.
+
+    :param df: dataframe as returned by load_backtest_data
+    :param features: list of feature columns, in matrix column order
+    :param path: directory of the .npy files
+    :return: no return
+    """
+
+    Path(path).mkdir(parents = True, exist_ok = True)
+    np.save(Path(path)/'X.npy', df[features].to_numpy(dtype = 'float64'))
+    np.save(Path(path)/'y.npy', df[TARGET].to_numpy(dtype = 'int64'))
+
+def generate_configs(c_values = C_VALUES, penalties = PENALTIES):
+
+    """
+    Lists every configuration to search: each non-empty subset of the stats (home and away
+    columns together) combined with each regularization setting.
+
+    :param c_values: inverse regularization strengths
+    :param penalties: regularization penalties
+    :return: list of dicts with keys features, C and penalty
+    """
+
+    subsets = [list(subset) for size in range(1, len(BASELINE_STATS) + 1) for subset in combinations(BASELINE_STATS, size)]
+
+    return [{'features': [f'{stat}_per_game_{side}' for stat in subset for side in ['home', 'away']], 'C': c, 'penalty': penalty}
+            for subset, c, penalty in product(subsets, c_values, penalties)]
+
+def init_worker(path, folds, best):
+
+    """
+    Memory-maps the search matrix once per worker process.
+
+    :param path: directory of the .npy files
+    :param folds: folds as returned by generate_folds
+    :param best: shared array holding the best finished configuration's mean log loss followed by its log loss on each fold
+    :return: no return
+    """
+
+    global _X, _y, _FOLDS, _BEST
+    _X = np.load(Path(path)/'X.npy', mmap_mode = 'r')
+    _y = np.load(Path(path)/'y.npy', mmap_mode = 'r')
+    _FOLDS, _BEST = folds, best
+
+def order_search_features(configs):
+
+    """
+    Orders the matrix columns by stat (as in BASELINE_STATS), home before away, the order of
+    each configuration's features, so that configurations of consecutive stats are contiguous
+    column blocks.
+
+    :param configs: list of configurations, as returned by generate_configs
+    :return: list of feature columns, in matrix column order
+    """
+
+    features = {feature for config in configs for feature in config['features']}
+
+    return [f'{stat}_per_game_{side}' for stat in BASELINE_STATS for side in ['home', 'away'] if f'{stat}_per_game_{side}' in features]
+
+def select_columns(X, columns):
+
+    """
+    Selects columns of the memory-mapped matrix. A contiguous block of columns is sliced, a
+    view of the memory map that copies nothing; any other selection is fancy indexing, which
+    copies the selected columns (once per configuration, not per fold).
+
+    :param X: memory-mapped matrix
+    :param columns: increasing matrix column indices
+    :return: array of the selected columns
+    """
+
+    if list(columns) == list(range(columns[0], columns[0] + len(columns))):
+        return X[:, columns[0]:columns[0] + len(columns)]
+
+    return X[:, columns]
+
+def evaluate_config(config, columns, min_folds = EARLY_STOP_MIN_FOLDS, tolerance = EARLY_STOP_TOLERANCE):
+
+    """
+    Scores a configuration on each fold in turn (run in a worker process), stopping early if
+    its log loss so far is clearly worse than the best finished configuration's on the same folds.
+
+    :param config: dict with keys features, C and penalty
+    :param columns: matrix column index of each feature
+    :param min_folds: folds to score before early stopping applies
+    :param tolerance: relative log loss margin above the best configuration that triggers a stop
+    :return: dict with the configuration, its mean scores, the number of folds scored and its status
+    """
+
+    X = select_columns(_X, columns)
+    fold_scores = []
+    for fold in _FOLDS:
+        model = LogisticRegression(C = config['C'], l1_ratio = L1_RATIOS[config['penalty']], solver = SOLVERS[config['penalty']])
+        model.fit(X[fold['train_rows']], _y[fold['train_rows']])
+        fold_scores.append(score_fold(model, X[fold['test_rows']], _y[fold['test_rows']]))
+
+        n_folds = len(fold_scores)
+        log_loss = sum(scores['log_loss'] for scores in fold_scores)
+        best_log_loss = sum(_BEST[1:n_folds + 1])
+        if n_folds >= min_folds and n_folds < len(_FOLDS) and log_loss > best_log_loss * (1 + tolerance):
+            status = 'stopped'
+            break
+    else:
+        status = 'finished'
+
+    mean_scores = pd.DataFrame(fold_scores).mean().to_dict()
+    if status == 'finished':
+        with _BEST.get_lock():
+            if mean_scores['log_loss'] < _BEST[0]:
+                _BEST[:] = [mean_scores['log_loss']] + [scores['log_loss'] for scores in fold_scores]
+
+    return {'features': ', '.join(config['features']), 'C': config['C'], 'penalty': config['penalty'],
+            'folds': len(fold_scores), **mean_scores, 'status': status}
+
+def run_search(df, configs, window = 'season', workers = WORKERS, path = PATH_SEARCH_MATRIX):
+
+    """
+    Scores every configuration in parallel over the walk-forward folds.
+
+    :param df: dataframe as returned by load_backtest_data, including every feature of configs
+    :param configs: list of configurations, as returned by generate_configs
+    :param window: 'season' or 'month'
+    :param workers: number of worker processes
+    :param path: directory for the memory-mapped .npy files
+    :return: leaderboard dataframe, best (lowest mean log loss) finished configuration first
+    """
+
+    features = order_search_features(configs)
+    save_search_matrix(df, features, path)
+    folds = generate_folds(df, window)
+    best = Array('d', [np.inf] * (len(folds) + 1))
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = init_worker, initargs = (path, folds, best)) as executor:
+        futures = [executor.submit(evaluate_config, config, [features.index(feature) for feature in config['features']])
+                   for config in configs]
+        df_leaderboard = pd.DataFrame([future.result() for future in futures])
+
+    return df_leaderboard.sort_values(['status', 'log_loss']).reset_index(drop = True)
+
+
+## SCRIPT ##
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Search feature subsets and regularization settings of the logistic model.')
+    parser.add_argument('--window', choices = ['season', 'month'], default = 'season')
+    parser.add_argument('--workers', type = int, default = WORKERS)
+    parser.add_argument('--top', type = int, default = 20, help = 'number of leaderboard rows to print')
+    parser.add_argument('--output', type = Path, help = 'optional csv to write the full leaderboard to')
+    args = parser.parse_args()
+
+    configs = generate_configs()
+
+    conn, cursor = create_database_connection(PATH_DB)
+    df = load_backtest_data(conn, [f'{stat}_per_game_{side}' for stat in BASELINE_STATS for side in ['home', 'away']])
+
+    df_leaderboard = run_search(df, configs, args.window, args.workers)
+    print(df_leaderboard.head(args.top).to_string())
+    print(f"{(df_leaderboard['status'] == 'stopped').sum()} of {len(configs)} configurations stopped early")
+
+    if args.output is not None:
+        df_leaderboard.to_csv(args.output, index = False)
@@ -0,0 +1,389 @@
+"""
+Single entry point for the whole pipeline, replacing running download_game_data.py,
+process_feed_data.py, build_ml_dataset.py and train_model.py by hand. The stages form a
+DAG of tasks keyed by season:
+
+    download[season] -> process[season] -> baselines -> build[season] -> export -> train
+
+download, process and build have one task per season, and baselines, export and train one
+task over all seasons. Before a task runs, its inputs are fingerprinted (row count and
+latest datetime of the upstream tables it reads for its season, and a hash of the code that
+transforms them) and compared with the fingerprint recorded in the pipeline_state table the
+last time it completed, so up-to-date partitions are skipped. A season still in progress
+(whose schedule isn't cached as final) is always re-downloaded.
+
+The seasons of the process and build stages are independent, so they are computed in
+parallel worker processes, each reading the db through its own connection; the frames they
+return are written by the main process, the db's only writer. Run from the repo root with e.g.
+
+    python -m scripts.pipeline
+    python -m scripts.pipeline --seasons 2019 2020 --stages process build --workers 4
+    python -m scripts.pipeline --stages build --force  ## rebuild even if up to date
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+from functools import partial
+from time import perf_counter
+import subprocess
+import argparse
+import hashlib
+import json
+import sys
+import os
+
+from scripts.helper import create_database_connection, migrate_database, execute_query, write_rows, init_worker_connection, compute_in_worker
+from scripts.instrumentation import count, span, merge, start_run, finish_run
+from scripts.download_game_data import SEASONS as DOWNLOAD_SEASONS, PATH_SCHEDULES, IngestSession, create_session, download_season
+from scripts.process_feed_data import SEASONS_TO_PROCESS, compute_season_feed_data, compute_season_feed_data_incremental, write_processed_season
+from scripts.features import materialize_team_baselines, load_team_baselines
+from scripts.team_state import refresh_team_state_baselines
+from scripts.build_ml_dataset import SEASONS as BUILD_SEASONS, TRAINING_SEASONS, REPLACE_CHANGED_FEATURES, build_season_features, write_season_features
+from scripts.feature_store import INPUT_SCRIPTS, compute_pipeline_inputs, export_feature_store, get_latest_version
+
+PATH_DB = Path('data/raw/nhl.db')
+PATH_QUERIES = Path('queries')
+
+STAGES = ['download', 'process', 'baselines', 'build', 'export', 'train'] ## in dependency order
+GLOBAL_SEASON = 0 ## season key of the tasks that run once over all seasons
+
+## seasons each stage runs for (None for the stages that run once over all seasons)
+STAGE_SEASONS = {'download': [int(season) for season in DOWNLOAD_SEASONS],
+                 'process': [int(season) for season in SEASONS_TO_PROCESS],
+                 'baselines': None,
+                 'build': [int(season) for season in BUILD_SEASONS],
+                 'export': None,
+                 'train': None}
+
+## upstream stages of each stage: 'same' for the task of the same season, 'all' for every task
+STAGE_DEPENDENCIES = {'download': [],
+                      'process': [('download', 'same')],
+                      'baselines': [('process', 'all')],
+                      'build': [('process', 'same'), ('baselines', 'all')],
+                      'export': [('build', 'all')],
+                      'train': [('export', 'all')]}
+
+PARALLEL_STAGES = ['process', 'build'] ## computed in worker processes, written by the main process
+
+## FUNCTIONS ##
+
+def get_compute_function(stage, full, conn):
+
+    """
+    Returns the function computing the frames of a process or build task in a worker process
+    (see compute_in_worker), without writing them.
+
+    :param stage: 'process' or 'build'
+    :param full: whether to recompute the whole season rather than only new games (process only)
+    :param conn: conn for the db
+    :return: function of a season and a conn
+    """
+
+    if stage == 'process':
+        return compute_season_feed_data if full else compute_season_feed_data_incremental
+
+    return partial(build_season_features, df_baselines = load_team_baselines(conn))
+
+def write_task(stage, season, frames, conn, cursor):
+
+    """
+    Writes the frames computed by a worker to the db.
+
+    :param stage: 'process' or 'build'
+    :param season: year in which the season started
+    :param frames: frames as returned by the function of get_compute_function
+    :param conn: conn for the db
+    :param cursor: cursor for the db
+    :return: number of games written
+    """
+
+    if stage == 'process':
+        if frames is None:
+            return 0
+        write_processed_season(season, *frames, conn, cursor)
+        return frames[0].shape[0]
+
+    n_inserted, n_replaced = write_season_features(frames, season, conn, cursor, replace_changed = REPLACE_CHANGED_FEATURES)
+
+    return n_inserted + n_replaced
+
+def run_serial_task(stage, season, conn, cursor, context):
+
+    """
+    Runs a download, baselines, export or train task in the main process.
+
+    :param stage: name of the stage
+    :param season: year in which the season started (GLOBAL_SEASON for the stages over all seasons)
+    :param conn: conn for the db
+    :param cursor: cursor for the db
+    :param context: dict holding the download session and ingest state, shared between download tasks
+    :return: no return
+    """
+
+    if stage == 'download':
+        if 'ingest' not in context:
+            context['session'] = create_session()
+            context['ingest'] = IngestSession(conn, cursor)
+        _, failed = download_season(season, context['ingest'], session = context['session'])
+        if len(failed) > 0:
+            ## the games downloaded are kept, but the task isn't recorded as done, so the next run retries
+            raise RuntimeError(f'{len(failed)} games failed to download: {", ".join(failed)}')
+
+    elif stage == 'baselines':
+        materialize_team_baselines(conn, cursor)
+        refresh_team_state_baselines(conn)
+
+    elif stage == 'export':
+        export_feature_store(conn, STAGE_SEASONS['build'])
+
+    elif stage == 'train':
+        subprocess.run([sys.executable, '-m', 'scripts.train_model'], check = True)
+
+def get_task_inputs(stage, season, conn):
+
+    """
+    Describes the inputs of a task: the upstream tables it reads for its season (see
+    compute_pipeline_inputs) and the code that transforms them.
+
+    :param stage: name of the stage
+    :param season: year in which the season started (GLOBAL_SEASON for the stages over all seasons)
+    :param conn: conn for the db
+    :return: dict describing the inputs
+    """
+
+    if stage == 'download':
+        return compute_pipeline_inputs(conn, [season], {'boxscore': True}, ['download_game_data.py'])
+
+    if stage == 'process':
+        return compute_pipeline_inputs(conn, [season], {'boxscore': True}, ['process_feed_data.py', 'team_state.py'])
+
+    if stage == 'baselines':
+        return compute_pipeline_inputs(conn, STAGE_SEASONS['process'], {'boxscore_processed': True, 'boxscore_processed_team': True}, ['features.py'])
+
+    if stage == 'build':
+        inputs = compute_pipeline_inputs(conn, [season], {'boxscore_processed': True, 'boxscore_processed_team': True},
+                                         ['features.py', 'build_ml_dataset.py'])
+        ## the season's baselines, by value, as they change when the previous season does
+        if 'team_baselines' in {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}:
+            rows = conn.execute('SELECT * FROM team_baselines WHERE season = ? ORDER BY franchise_id', (season,)).fetchall()
+            inputs['baselines'] = hashlib.sha1(repr(rows).encode()).hexdigest()
+        return inputs
+
+    if stage == 'export':
+        return compute_pipeline_inputs(conn, STAGE_SEASONS['build'], input_scripts = INPUT_SCRIPTS + ['feature_store.py'])
+
+    inputs = compute_pipeline_inputs(conn, TRAINING_SEASONS, {}, ['train_model.py', 'model_artifact.py'])
+    inputs['feature_store_version'] = get_latest_version()
+
+    return inputs
+
+def hash_inputs(inputs):
+
+    """
+    Hashes a dict of task inputs into a fingerprint.
+    """
+
+    return hashlib.sha1(json.dumps(inputs, sort_keys = True, default = str).encode()).hexdigest()
+
+def read_pipeline_state(conn):
+
+    """
+    Reads the fingerprint and inputs each task had when it last completed.
+
+    :param conn: conn for the db
+    :return: dict mapping (stage, season) to a dict with the fingerprint and inputs
+    """
+
+    if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'pipeline_state'").fetchone() is None:
+        return {}
+
+    return {(stage, season): {'fingerprint': fingerprint, 'inputs': json.loads(inputs)}
+            for stage, season, fingerprint, inputs in conn.execute('SELECT stage, season, fingerprint, inputs FROM pipeline_state')}
+
+def record_task(stage, season, conn, cursor):
+
+    """
+    Records a completed task with the fingerprint of its inputs as they are now.
+
+    :param stage: name of the stage
+    :param season: year in which the season started (GLOBAL_SEASON for the stages over all seasons)
+    :param conn: conn for the db
+    :param cursor: cursor for the db
+    :return: dict with the fingerprint and inputs recorded
+    """
+
+    inputs = get_task_inputs(stage, season, conn)
+    execute_query(PATH_QUERIES/'create_table_pipeline_state', cursor)
+    write_rows([(stage, season, hash_inputs(inputs), json.dumps(inputs, default = str),
+                 datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))],
+               ['stage', 'season', 'fingerprint', 'inputs', 'completed_at'], 'pipeline_state', cursor, on_conflict = 'REPLACE')
+    conn.commit()
+
+    return {'fingerprint': hash_inputs(inputs), 'inputs': inputs}
+
+def is_final(stage, season):
+
+    """
+    Checks whether a task's partition can no longer change upstream of the db, so that it can be
+    skipped when its fingerprint is unchanged: a download is final once its season's schedule
+    is cached (i.e. every game of the season is final).
+    """
+
+    return stage != 'download' or (PATH_SCHEDULES/f'{season}.json').exists()
+
+def plan_tasks(stages = STAGES, seasons = None):
+
+    """
+    Lists the tasks of the selected stages, in dependency order, with the upstream tasks each
+    one waits for. Dependencies on stages that aren't selected are dropped.
+
+    :param stages: stages to run
+    :param seasons: optional seasons to restrict the per-season stages to
+    :return: dict mapping (stage, season) to the list of (stage, season) tasks it depends on
+    """
+
+    partitions = {}
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        if STAGE_SEASONS[stage] is None:
+            partitions[stage] = [GLOBAL_SEASON]
+        else:
+            partitions[stage] = [season for season in STAGE_SEASONS[stage] if seasons is None or season in seasons]
+
+    tasks = {}
+    for stage, stage_seasons in partitions.items():
+        for season in stage_seasons:
+            dependencies = []
+            for upstream, scope in STAGE_DEPENDENCIES[stage]:
+                if upstream not in partitions:
+                    continue
+                if scope == 'all':
+                    dependencies += [(upstream, upstream_season) for upstream_season in partitions[upstream]]
+                elif season in partitions[upstream]:
+                    dependencies.append((upstream, season))
+            tasks[(stage, season)] = dependencies
+
+    return tasks
+
+def run_pipeline(tasks, path_db = PATH_DB, workers = None, force = False):
+
+    """
+    Runs the tasks of a plan as soon as their dependencies are done, skipping those whose
+    inputs are unchanged since they last completed. Process and build tasks are computed in a
+    pool of worker processes and written by this process (which merges the spans and counters
+    the workers recorded); the other tasks run in this process.
+    A failed task is reported and its downstream tasks are not run.
+
+    :param tasks: dict as returned by plan_tasks
+    :param path_db: path of the db
+    :param workers: number of worker processes (defaults to the number of cpus)
+    :param force: whether to run every task, even if it is up to date
+    :return: dict mapping each task to 'ran', 'skipped', 'failed' or 'blocked'
+    """
+
+    conn, cursor = create_database_connection(path_db)
+    state = read_pipeline_state(conn)
+    status = {}
+    pending = list(tasks)
+    running = {} ## future -> (task, start time)
+    context = {}
+
+    def finish(task, start, error = None):
+        stage, season = task
+        label = 'all' if season == GLOBAL_SEASON else season
+        if error is None:
+            state[task] = record_task(stage, season, conn, cursor)
+            status[task] = 'ran'
+            count('tasks_run')
+            print(f'{stage:9s} {label}: ran in {perf_counter() - start:.1f}s')
+        else:
+            status[task] = 'failed'
+            count('tasks_failed')
+            print(f'{stage:9s} {label}: failed ({error!r})')
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = init_worker_connection, initargs = (str(path_db),)) as executor:
+
+        while len(pending) > 0 or len(running) > 0:
+
+            ## start every task whose dependencies are done (one pass suffices, since tasks are in dependency order)
+            for task in list(pending):
+                dependencies = tasks[task]
+                if any(status.get(dependency) in ('failed', 'blocked') for dependency in dependencies):
+                    status[task] = 'blocked'
+                    pending.remove(task)
+                    continue
+                if not all(dependency in status for dependency in dependencies):
+                    continue
+
+                pending.remove(task)
+                stage, season = task
+                inputs = get_task_inputs(stage, season, conn)
+                previous = state.get(task)
+                if not force and previous is not None and previous['fingerprint'] == hash_inputs(inputs) and is_final(stage, season):
+                    status[task] = 'skipped'
+                    count('tasks_skipped')
+                    continue
+
+                start = perf_counter()
+                if stage in PARALLEL_STAGES:
+                    ## a process task recomputes its whole season unless only its data changed since it last ran
+                    full = force or previous is None or previous['inputs']['code'] != inputs['code']
+                    running[executor.submit(compute_in_worker, get_compute_function(stage, full, conn), season)] = (task, start)
+                else:
+                    try:
+                        with span(f'pipeline.{stage}'):
+                            run_serial_task(stage, season, conn, cursor, context)
+                        finish(task, start)
+                    except Exception as error:
+                        finish(task, start, error)
+
+            if len(running) == 0:
+                continue
+
+            ## write the results of the worker tasks as they complete
+            done, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                task, start = running.pop(future)
+                try:
+                    result, recorded = future.result()
+                    merge(recorded) ## the worker's spans and counters
+                    with span(f'pipeline.{task[0]}.write'):
+                        write_task(*task, result, conn, cursor)
+                    finish(task, start)
+                except Exception as error:
+                    finish(task, start, error)
+
+    if 'ingest' in context:
+        context['ingest'].flush()
+    if 'ran' in status.values():
+        migrate_database(conn, cursor)
+    conn.close()
+
+    return status
+
+
+## SCRIPT ##
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Run the pipeline, skipping the stages and seasons that are up to date.')
+    parser.add_argument('--stages', nargs = '+', default = STAGES, choices = STAGES)
+    parser.add_argument('--seasons', nargs = '+', type = int, help = 'seasons to run the per-season stages for (defaults to each stage\'s seasons)')
+    parser.add_argument('--workers', type = int, default = os.cpu_count(), help = 'worker processes for the process and build stages')
+    parser.add_argument('--force', action = 'store_true', help = 'run every task, even if it is up to date')
+    parser.add_argument('--db', type = Path, default = PATH_DB)
+    args = parser.parse_args()
+
+    start_run('pipeline')
+    status = run_pipeline(plan_tasks(args.stages, args.seasons), args.db, args.workers, args.force)
+
+    counts = {outcome: list(status.values()).count(outcome) for outcome in ['ran', 'skipped', 'failed', 'blocked']}
+    print(', '.join(f'{n} {outcome}' for outcome, n in counts.items()))
+    print(f'run report written to {finish_run()}')
+
+    if counts['failed'] + counts['blocked'] > 0:
+        sys.exit(1)
@@ -0,0 +1,93 @@
+"""
+Fast-starting predictor: scores games from the json model artifact and the team state
+snapshot with plain numpy, without importing pandas, sklearn or requests. Pass the home
+and away franchise id of each game in turn, e.g. for two games
+
+    python -m scripts.predict_fast 10 6 1 5
+
+Each game's home win probability is printed, as of the latest processed games. Exits with
+an error if the snapshot isn't current for the season (see team_state.is_team_state_current).
+"""
+
+## SETUP ##
+
+import argparse
+import sys
+import numpy as np
+
+from scripts.model_artifact import PATH_MODEL_ARTIFACT, load_model_artifact, predict_proba_from_artifact
+from scripts.team_state import PATH_TEAM_STATE, load_team_state_snapshot, is_team_state_current, compute_snapshot_features
+
+## FUNCTIONS ##
+
+def compute_artifact_features(snapshot, home_ids, away_ids, artifact):
+
+    """
+    Computes the artifact's features from the team state snapshot with
+    team_state.compute_snapshot_features (the previous-season weight is read from the artifact).
+
+    :param snapshot: structured array as returned by team_state.load_team_state_snapshot
+    :param home_ids: array of home franchise ids
+    :param away_ids: array of away franchise ids
+    :param artifact: dict as returned by load_model_artifact
+    :return: 2d array of features, with columns in the artifact's feature order
+    """
+
+    weight = artifact['weight_previous_season']
+    features = {'home': compute_snapshot_features(snapshot, home_ids, weight),
+                'away': compute_snapshot_features(snapshot, away_ids, weight)}
+
+    columns = []
+    for feature in artifact['features']:
+        stat, side = feature.rsplit('_per_game_', 1) ## e.g. wins_per_game_home
+        columns.append(features[side][f'{stat}_per_game'])
+
+    return np.column_stack(columns)
+
+def predict_fast(home_ids, away_ids, season = None, path_artifact = PATH_MODEL_ARTIFACT, path_team_state = PATH_TEAM_STATE):
+
+    """
+    Predicts the home win probability of each game from the artifact and the snapshot. The
+    snapshot must be current (see team_state.is_team_state_current): hold the season's totals
+    and a previous-season baseline for every team, as after a full pipeline run.
+
+    :param home_ids: array of home franchise ids
+    :param away_ids: array of away franchise ids
+    :param season: season of the games (defaults to the latest season in the snapshot)
+    :param path_artifact: path of the json model artifact
+    :param path_team_state: path of the team state snapshot
+    :return: array of home win probabilities
+    """
+
+    artifact = load_model_artifact(path_artifact)
+    snapshot = load_team_state_snapshot(path_team_state)
+    if snapshot is None:
+        raise FileNotFoundError(f'No team state snapshot at {path_team_state}')
+
+    season = int(snapshot['season'].max()) if season is None else season
+    if not is_team_state_current(snapshot, np.concatenate([home_ids, away_ids]), season):
+        raise ValueError(f'Team state snapshot is not current for season {season} (missing teams or baselines), rerun the pipeline')
+
+    return predict_proba_from_artifact(artifact, compute_artifact_features(snapshot, home_ids, away_ids, artifact))
+
+
+## SCRIPT ##
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Predict games from the model artifact and the team state snapshot.')
+    parser.add_argument('franchise_ids', nargs = '+', type = int, help = 'home and away franchise id of each game in turn')
+    parser.add_argument('--season', type = int, help = 'season of the games (defaults to the latest season in the snapshot)')
+    args = parser.parse_args()
+
+    if len(args.franchise_ids) % 2 != 0:
+        parser.error('expected a home and an away franchise id for each game')
+
+    home_ids, away_ids = args.franchise_ids[0::2], args.franchise_ids[1::2]
+    try:
+        home_probs = predict_fast(home_ids, away_ids, args.season)
+    except (FileNotFoundError, ValueError) as error:
+        sys.exit(f'error: {error}')
+
+    for home_id, away_id, home_prob in zip(home_ids, away_ids, home_probs):
+        print(f'{home_id} vs {away_id}: {100 * home_prob:.1f}% home win')
@@ -3,296 +3,437 @@
 ## SETUP ##
 
 import pickle
-from requests import get
-import sqlite3
+import argparse
+import json
+from time import time
 from pathlib import Path
 import pandas as pd; pd.options.display.max_columns = None
 import numpy as np
-from time import sleep
 from copy import deepcopy
 from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor
+
+from scripts.helper import create_database_connection, execute_query, write_dataframe
+from scripts.download_game_data import API_BASE_URL, CONCURRENCY, download_page, download_schedule, create_session
+from scripts.features import BASELINE_STATS, WEIGHT_PREV_SEASON, load_team_baselines, load_team_state, impute_missing_baselines, compute_point_in_time_features
+from scripts.team_state import load_team_state_snapshot, is_team_state_current, predict_home_win_probability
+from scripts.instrumentation import count, span, start_run, finish_run
+
+PATH_DB = Path('data/raw/nhl.db')
+PATH_MODEL = Path('models/2021_04_20_logreg_win_percentage_only.pickle')
+PATH_PREDICTIONS = Path('app/predictions.csv')
+PATH_QUERIES = Path('queries')
+PATH_TEAM_INDEX = Path('data/raw/team_franchise_ids.json')
+TEAM_INDEX_MAX_AGE_DAYS = 7 ## the team index is re-downloaded once it is older than this
+MODEL_FEATURES = ['wins_per_game_home', 'wins_per_game_away']
 
-from scripts.helper import create_database_connection#convert_team_stats
-from scripts.download_game_data import add_boxscore_to_db
-from scripts.process_feed_data import process_season_feed_data
+## FUNCTIONS ##
 
-PATH_DB = Path('../data/raw/nhl.db')
-PATH_MODEL = Path('../models/2021_04_20_logreg_win_percentage_only.pickle')
+def season_from_date(day):
 
-## FUNCTIONS ##
+    """
+    Determines the season a date falls in.
+
+    :param day: date or timestamp
+    :return: year in which the season started
+    """
+
+    return day.year if day.month >= 9 else day.year - 1
 
-def extract_dates_games(today):
+def extract_dates_games(today, team_franchise_ids = None, session = None):
 
-    ## including this to look up franchise id for each team
-    teams_url = 'https://statsapi.web.nhl.com/api/v1/teams'
-    teams = get(teams_url)
-    teams = teams.json()
+    """
+    Downloads the schedule of a single date and collects its games into a dataframe.
+
+    :param today: date, or string formatted as YYYY-MM-DD
+    :param team_franchise_ids: optional dict mapping team id to franchise id (read from the team index if not given)
+    :param session: optional requests session
+    :return: dataframe with one row per game, as returned by extract_schedule_games
+    """
 
     ## create the url for the given date
     if isinstance(today, date):
         today = datetime.strftime(today, '%Y-%m-%d')
-    today_url = f'https://statsapi.web.nhl.com/api/v1/schedule?date={today}'
+    today_url = f'{API_BASE_URL}/schedule?date={today}'
 
     ## read the page
-    data = get(today_url)
-    data = data.json()
-
-    ## re-organize the game info into a dataframe
-    df_games = pd.DataFrame({})
-    if data['totalGames'] > 0:
-        games = data['dates'][0]['games']
-        for game in games:
-            df_new = pd.DataFrame({'game_id': [game['gamePk']],
-                                   'home_id': [team['franchise']['franchiseId'] for team in teams['teams'] if team['id'] == game['teams']['home']['team']['id']],
-                                   'away_id': [team['franchise']['franchiseId'] for team in teams['teams'] if team['id'] == game['teams']['away']['team']['id']],
-                                   'home_team': [game['teams']['home']['team']['name']],
-                                   'away_team': [game['teams']['away']['team']['name']]})
-            df_games = pd.concat([df_games, df_new])
+    data = download_page(today_url, session = session)
+
+    ## look up the franchise id of each team from the team index
+    if team_franchise_ids is None:
+        team_franchise_ids = load_team_index(list_schedule_team_ids([data]), session = session)
+
+    return extract_schedule_games([data], team_franchise_ids, regular_and_playoffs_only = False)
+
+def compute_game_features(df_games, season, as_of, conn):
+
+    """
+    Computes the weighted per-game features of the home and away team of each game, as of a
+    given datetime, using the same feature function as build_ml_dataset.py. The whole slate
+    costs one query for the team totals and one for the previous-season baselines. Teams
+    without a baseline (e.g. an expansion team before its first processed game) are given the
+    season's mean baseline.
+
+    :param df_games: dataframe as returned by extract_dates_games
+    :param season: year in which the season started
+    :param as_of: datetime at which to take each team's stats (games from this time on are ignored)
+    :param conn: conn for the db
+    :return: copy of df_games with {stat}_per_game_home and {stat}_per_game_away columns added
+    """
+
+    df_state = load_team_state(conn, [season])
+    df_baselines = load_team_baselines(conn, season)
+
+    df_games = df_games.reset_index(drop = True)
+    for side in ['home', 'away']:
+        df_queries = pd.DataFrame({'franchise_id': df_games[f'{side}_id'],
+                                   'season': season,
+                                   'datetime': as_of})
+        df_features = compute_point_in_time_features(df_queries, df_state, impute_missing_baselines(df_baselines, df_queries), WEIGHT_PREV_SEASON)
+        for stat in BASELINE_STATS:
+            df_games[f'{stat}_per_game_{side}'] = df_features[f'{stat}_per_game']
+
+    return df_games
+
+def predict_games(df_games, model):
+
+    """
+    Predicts the probability of a home and away win for each game.
+
+    :param df_games: dataframe as returned by compute_game_features
+    :param model: fitted classifier with a predict_proba method
+    :return: dataframe with the teams and their win probabilities (in percent) for each game
+    """
+
+    probs = model.predict_proba(df_games[MODEL_FEATURES]) # away, home
+
+    df = deepcopy(df_games[['game_id', 'home_id', 'away_id', 'home_team', 'away_team']])
+    df['home_prob'] = np.round(100 * probs[:,1], 1)
+    df['away_prob'] = np.round(100 * probs[:,0], 1) ## note: these "probs" may not be well-calibrated
+
+    return df
+
+def is_snapshot_current(snapshot, df_games, season):
+
+    """
+    Checks whether the team state snapshot holds this season's totals and baseline for every team in df_games.
+
+    :param snapshot: structured array as returned by load_team_state_snapshot
+    :param df_games: dataframe as returned by extract_dates_games
+    :param season: year in which the season started
+    :return: True if every team can be looked up in the snapshot
+    """
+
+    franchise_ids = np.concatenate([df_games['home_id'].to_numpy(dtype = 'int64'), df_games['away_id'].to_numpy(dtype = 'int64')])
+
+    return is_team_state_current(snapshot, franchise_ids, season)
+
+def predict_games_from_snapshot(df_games, snapshot, model):
+
+    """
+    Predicts the probability of a home and away win for each game from the team state
+    snapshot, with the model's coefficients applied directly (no sql or dataframe features).
+
+    :param df_games: dataframe as returned by extract_dates_games
+    :param snapshot: structured array as returned by load_team_state_snapshot
+    :param model: fitted logistic regression
+    :return: dataframe with the teams and their win probabilities (in percent) for each game
+    """
+
+    home_probs = predict_home_win_probability(snapshot, df_games['home_id'], df_games['away_id'],
+                                              model.coef_[0], model.intercept_[0], MODEL_FEATURES)
+
+    df = deepcopy(df_games[['game_id', 'home_id', 'away_id', 'home_team', 'away_team']])
+    df['home_prob'] = np.round(100 * home_probs, 1)
+    df['away_prob'] = np.round(100 * (1 - home_probs), 1) ## note: these "probs" may not be well-calibrated
+
+    return df
+
+def download_team_franchise_ids(base_url = API_BASE_URL, session = None):
+
+    """
+    Downloads the teams endpoint and maps each team id to its franchise id.
+
+    :param base_url: root of the stats api
+    :param session: optional requests session
+    :return: dict mapping team id to franchise id
+    """
+
+    teams = download_page(f'{base_url}/teams', session = session)
+
+    return {team['id']: team['franchise']['franchiseId'] for team in teams['teams']}
+
+def load_boxscore_team_franchise_ids(conn):
+
+    """
+    Maps the id of every team in the boxscore table to its franchise id, including teams
+    the teams endpoint no longer lists (e.g. Atlanta before it moved to Winnipeg).
+
+    :param conn: conn for the db
+    :return: dict mapping team id to franchise id
+    """
+
+    if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'boxscore'").fetchone() is None:
+        return {}
+
+    rows = conn.execute('''SELECT DISTINCT home_id, home_franchise_id FROM boxscore
+                           UNION SELECT DISTINCT away_id, away_franchise_id FROM boxscore''').fetchall()
+
+    return {int(team_id): int(franchise_id) for team_id, franchise_id in rows}
+
+def load_team_index(team_ids = (), path = PATH_TEAM_INDEX, max_age_days = TEAM_INDEX_MAX_AGE_DAYS, session = None, conn = None):
+
+    """
+    Reads the persisted team id to franchise id index, refreshing it from the teams endpoint
+    only when it is missing, older than max_age_days, or lacks one of team_ids (e.g. a new team).
+    Teams the endpoint no longer lists are taken from the boxscore table, if conn is given.
+
+    :param team_ids: team ids that must be in the index
+    :param path: path of the index file
+    :param max_age_days: age after which the index is considered stale
+    :param session: optional requests session
+    :param conn: optional conn for the db, whose boxscore table maps past teams
+    :return: dict mapping team id to franchise id
+    """
+
+    past_franchise_ids = {} if conn is None else load_boxscore_team_franchise_ids(conn)
+
+    path = Path(path)
+    if path.exists() and time() - path.stat().st_mtime < max_age_days * 24 * 3600:
+        with open(path) as f:
+            team_franchise_ids = {**past_franchise_ids, **{int(team_id): franchise_id for team_id, franchise_id in json.load(f).items()}}
+        if all(team_id in team_franchise_ids for team_id in team_ids):
+            count('team_index_hits')
+            return team_franchise_ids
+
+    team_franchise_ids = download_team_franchise_ids(session = session)
+    path.parent.mkdir(parents = True, exist_ok = True)
+    with open(path, 'w') as f:
+        json.dump(team_franchise_ids, f)
+
+    return {**past_franchise_ids, **team_franchise_ids}
+
+def list_schedule_team_ids(schedules):
+
+    """
+    Lists the ids of all teams playing in schedules.
+
+    :param schedules: list of schedule dicts
+    :return: set of team ids
+    """
+
+    return {game['teams'][side]['team']['id'] for schedule in schedules for day in schedule.get('dates', [])
+            for game in day['games'] for side in ['home', 'away']}
+
+def download_schedules(seasons, concurrency = CONCURRENCY, base_url = API_BASE_URL, session = None):
+
+    """
+    Downloads the schedules of several seasons, with at most concurrency requests in flight.
+    Schedules of finished seasons are read from the local schedule cache.
+
+    :param seasons: iterable of seasons
+    :param concurrency: number of downloads in flight at once
+    :param base_url: root of the stats api
+    :param session: optional requests session
+    :return: list of schedule dicts, as returned by download_schedule
+    """
+
+    with ThreadPoolExecutor(max_workers = concurrency) as executor:
+        return list(executor.map(lambda season: download_schedule(season, base_url = base_url, session = session), seasons))
+
+def extract_schedule_games(schedules, team_franchise_ids, start = None, end = None, regular_and_playoffs_only = True):
+
+    """
+    Collects the games of schedules into a dataframe, built column by column in a single pass.
+    Games of teams missing from team_franchise_ids are skipped with a warning.
+
+    :param schedules: list of schedule dicts, as returned by download_schedule
+    :param team_franchise_ids: dict mapping team id to franchise id
+    :param start: optional first date to include
+    :param end: optional last date to include
+    :param regular_and_playoffs_only: skip pre-season and all-star games
+    :return: dataframe with one row per game, sorted by datetime
+    """
+
+    start = None if start is None else str(start)
+    end = None if end is None else str(end)
+
+    columns = {col: [] for col in ['date', 'game_id', 'datetime', 'home_id', 'away_id', 'home_team', 'away_team']}
+    for schedule in schedules:
+        for day in schedule.get('dates', []):
+            if (start is not None and day['date'] < start) or (end is not None and day['date'] > end):
+                continue
+            for game in day['games']:
+                if regular_and_playoffs_only and str(game['gamePk'])[4:6] not in ('02', '03'):
+                    continue ## ignore pre-season and all-star games
+                unknown_ids = [game['teams'][side]['team']['id'] for side in ['home', 'away']
+                               if game['teams'][side]['team']['id'] not in team_franchise_ids]
+                if len(unknown_ids) > 0:
+                    print(f"skipping game {game['gamePk']}: no franchise id for team {', '.join(map(str, unknown_ids))}")
+                    continue
+                columns['date'].append(day['date'])
+                columns['game_id'].append(str(game['gamePk']))
+                columns['datetime'].append(game['gameDate'])
+                for side in ['home', 'away']:
+                    columns[f'{side}_id'].append(team_franchise_ids[game['teams'][side]['team']['id']])
+                    columns[f'{side}_team'].append(game['teams'][side]['team']['name'])
+
+    df_games = pd.DataFrame(columns)
+    df_games.insert(2, 'season', df_games['game_id'].str[:4].astype('int'))
+
+    return df_games.sort_values(['datetime', 'game_id']).reset_index(drop = True)
+
+def compute_schedule_features(df_games, conn):
+
+    """
+    Computes the weighted per-game features of the home and away team of every game, each
+    as of the game's own start time, for any number of dates and seasons in one pass. Teams
+    without a baseline are given the season's mean baseline (see impute_missing_baselines).
+
+    :param df_games: dataframe as returned by extract_schedule_games
+    :param conn: conn for the db
+    :return: copy of df_games with {stat}_per_game_home and {stat}_per_game_away columns added
+    """
+
+    seasons = pd.unique(df_games['season'])
+    df_state = load_team_state(conn, seasons)
+    df_baselines = load_team_baselines(conn)
+    df_baselines = df_baselines[df_baselines['season'].isin(seasons)]
+
+    ## home and away queries stacked, so the whole batch is a single merge
+    n_games = df_games.shape[0]
+    df_queries = pd.DataFrame({'franchise_id': np.concatenate([df_games['home_id'].values, df_games['away_id'].values]),
+                               'season': np.tile(df_games['season'].values, 2),
+                               'datetime': np.tile(df_games['datetime'].values, 2)})
+    df_baselines = impute_missing_baselines(df_baselines, df_queries)
+    df_features = compute_point_in_time_features(df_queries, df_state, df_baselines, WEIGHT_PREV_SEASON)
+
+    df_games = df_games.reset_index(drop = True)
+    for stat in BASELINE_STATS:
+        df_games[f'{stat}_per_game_home'] = df_features[f'{stat}_per_game'].values[:n_games]
+        df_games[f'{stat}_per_game_away'] = df_features[f'{stat}_per_game'].values[n_games:]
 
     return df_games
 
+def write_predictions(df_predictions, conn, cursor):
+
+    """
+    Writes predictions to the predictions table, partitioned by date: every date in
+    df_predictions has its previous predictions replaced as a whole, so that games
+    rescheduled away from a date don't linger.
+
+    :param df_predictions: dataframe with a row per game, including a date column
+    :param conn: conn for the db
+    :param cursor: cursor for the db
+    :return: number of predictions written
+    """
+
+    execute_query(PATH_QUERIES/'create_table_predictions', cursor)
+    dates = sorted(pd.unique(df_predictions['date']))
+    cursor.executemany('DELETE FROM predictions WHERE date = ?', [(day,) for day in dates])
+    n_rows = write_dataframe(df_predictions, 'predictions', cursor)
+    conn.commit()
+
+    return n_rows
+
+def predict_schedule(schedules, model, conn, cursor, start = None, end = None, team_franchise_ids = None, session = None):
+
+    """
+    Predicts every game of the given schedules (optionally restricted to a date range)
+    and writes the predictions to the db.
+
+    :param schedules: list of schedule dicts, as returned by download_schedules
+    :param model: fitted classifier with a predict_proba method
+    :param conn: conn for the db
+    :param cursor: cursor for the db
+    :param start: optional first date to predict
+    :param end: optional last date to predict
+    :param team_franchise_ids: optional dict mapping team id to franchise id (read from the team index if not given)
+    :param session: optional requests session
+    :return: dataframe of the predictions written
+    """
+
+    if team_franchise_ids is None:
+        team_franchise_ids = load_team_index(list_schedule_team_ids(schedules), session = session, conn = conn)
+
+    df_games = extract_schedule_games(schedules, team_franchise_ids, start, end)
+    if df_games.shape[0] == 0:
+        return df_games
+
+    with span('predict.features'):
+        df_games = compute_schedule_features(df_games, conn)
+        df_games = df_games[df_games[MODEL_FEATURES].notna().all(axis = 1)] ## e.g. a season without baselines
+
+    with span('predict.model'):
+        df = predict_games(df_games, model)
+    df.insert(0, 'date', df_games['date'].values)
+    df.insert(2, 'season', df_games['season'].values)
+    df.insert(3, 'datetime', df_games['datetime'].values)
+    df['model'] = PATH_MODEL.stem
+
+    with span('predict.write'):
+        write_predictions(df, conn, cursor)
+
+    return df
+
 
 ## SCRIPT ##
 
-### create a variation of the download_game_data script that only checks games not already in db
-## and run that here for this season
-## then run process_feed_data and build_ml_dataset for this season
-
-WEIGHT_PREV_SEASON = 10
-
-## find today's games
-today = date.today()
-df_games = extract_dates_games(today)
-
-## determine which games have already been completed and make sure they are downloaded
-## using the latest id because the earliest id could be a re-scheduled game
-latest_game_id = df_games['game_id'].max()
-latest_game_code = int(str(latest_game_id)[-4:])
-season = int(str(latest_game_id)[:4])
-
-## load in this season's data
-conn, cursor = create_database_connection(PATH_DB)
-
-# df_features = pd.read_sql_query(f'SELECT * from mlfeatures WHERE season = {season}', conn)
-## prob: mlfeatures doesn't have the after-match numbers
-## also, it would be good to confirm that I'm not leaking current game stats into these
-
-## add these cols in
-df_games['goals_for_per_game_home'] = np.nan
-df_games['goals_against_per_game_home'] = np.nan
-df_games['shots_for_per_game_home'] = np.nan
-df_games['shots_against_per_game_home'] = np.nan
-df_games['wins_per_game_home'] = np.nan
-
-df_games['goals_for_per_game_away'] = np.nan
-df_games['goals_against_per_game_away'] = np.nan
-df_games['shots_for_per_game_away'] = np.nan
-df_games['shots_against_per_game_away'] = np.nan
-df_games['wins_per_game_away'] = np.nan
-for franchise_id in df_games['away_id']:
-
-    ## need to change this to a function that is also used to build the model
-    df_team = pd.read_sql(f"SELECT * FROM boxscore_processed_team WHERE season = {season} AND franchise_id = {franchise_id}", conn)
-    df_team_prev = pd.read_sql(f"SELECT * FROM boxscore_processed_team WHERE season = {season-1} AND franchise_id = {franchise_id}", conn)
-
-    n_games_played_prev = df_team_prev['games_played_after'].max()
-    goals_for_per_game_prev = df_team_prev.loc[n_games_played_prev - 1, ['goals_for_after']].values[0] / n_games_played_prev
-    goals_against_per_game_prev = df_team_prev.loc[n_games_played_prev - 1, ['goals_against_after']].values[0] / n_games_played_prev
-    shots_for_per_game_prev = df_team_prev.loc[n_games_played_prev - 1, ['shots_for_after']].values[0] / n_games_played_prev
-    shots_against_per_game_prev = df_team_prev.loc[n_games_played_prev - 1, ['shots_against_after']].values[0] / n_games_played_prev
-    wins_per_game_prev = df_team_prev.loc[n_games_played_prev - 1, ['wins_after']].values[0] / n_games_played_prev
-
-    n_games_played = df_team['games_played_after'].max()
-    goals_for_per_game = df_team.loc[n_games_played - 1, ['goals_for_after']].values[0] / n_games_played
-    goals_against_per_game = df_team.loc[n_games_played - 1, ['goals_against_after']].values[0] / n_games_played
-    shots_for_per_game = df_team.loc[n_games_played - 1, ['shots_for_after']].values[0] / n_games_played
-    shots_against_per_game = df_team.loc[n_games_played - 1, ['shots_against_after']].values[0] / n_games_played
-    wins_per_game = df_team.loc[n_games_played - 1, ['wins_after']].values[0] / n_games_played
-
-    goals_for_per_game = (goals_for_per_game * n_games_played + WEIGHT_PREV_SEASON * goals_for_per_game_prev) / (WEIGHT_PREV_SEASON + n_games_played)
-    goals_against_per_game = (goals_against_per_game * n_games_played + WEIGHT_PREV_SEASON * goals_against_per_game_prev) / (WEIGHT_PREV_SEASON + n_games_played)
-    shots_for_per_game = (shots_for_per_game * n_games_played + WEIGHT_PREV_SEASON * shots_for_per_game_prev) / (WEIGHT_PREV_SEASON + n_games_played)
-    shots_against_per_game = (shots_against_per_game * n_games_played + WEIGHT_PREV_SEASON * shots_against_per_game_prev) / (WEIGHT_PREV_SEASON + n_games_played)
-    wins_per_game = (wins_per_game * n_games_played + WEIGHT_PREV_SEASON * wins_per_game_prev) / (WEIGHT_PREV_SEASON + n_games_played)
-
-    df_games.loc[df_games['away_id'] == franchise_id,'goals_for_per_game_away'] = goals_for_per_game
-    df_games.loc[df_games['away_id'] == franchise_id, 'goals_against_per_game_away'] = goals_against_per_game
-    df_games.loc[df_games['away_id'] == franchise_id, 'shots_for_per_game_away'] = shots_for_per_game
-    df_games.loc[df_games['away_id'] == franchise_id, 'shots_against_per_game_away'] = shots_against_per_game
-    df_games.loc[df_games['away_id'] == franchise_id, 'wins_per_game_away'] = wins_per_game
-
-
-for franchise_id in df_games['home_id']:
-
-    ## need to change this to a function that is also used to build the model
-    df_team = pd.read_sql(f"SELECT * FROM boxscore_processed_team WHERE season = {season} AND franchise_id = {franchise_id}", conn)
-    df_team_prev = pd.read_sql(f"SELECT * FROM boxscore_processed_team WHERE season = {season-1} AND franchise_id = {franchise_id}", conn)
-
-    n_games_played_prev = df_team_prev['games_played_after'].max()
-    goals_for_per_game_prev = df_team_prev.loc[n_games_played_prev - 1, ['goals_for_after']].values[0] / n_games_played_prev
-    goals_against_per_game_prev = df_team_prev.loc[n_games_played_prev - 1, ['goals_against_after']].values[0] / n_games_played_prev
-    shots_for_per_game_prev = df_team_prev.loc[n_games_played_prev - 1, ['shots_for_after']].values[0] / n_games_played_prev
-    shots_against_per_game_prev = df_team_prev.loc[n_games_played_prev - 1, ['shots_against_after']].values[0] / n_games_played_prev
-    wins_per_game_prev = df_team_prev.loc[n_games_played_prev - 1, ['wins_after']].values[0] / n_games_played_prev
-
-    n_games_played = df_team['games_played_after'].max()
-    goals_for_per_game = df_team.loc[n_games_played - 1, ['goals_for_after']].values[0] / n_games_played
-    goals_against_per_game = df_team.loc[n_games_played - 1, ['goals_against_after']].values[0] / n_games_played
-    shots_for_per_game = df_team.loc[n_games_played - 1, ['shots_for_after']].values[0] / n_games_played
-    shots_against_per_game = df_team.loc[n_games_played - 1, ['shots_against_after']].values[0] / n_games_played
-    wins_per_game = df_team.loc[n_games_played - 1, ['wins_after']].values[0] / n_games_played
-
-    goals_for_per_game = (goals_for_per_game * n_games_played + WEIGHT_PREV_SEASON * goals_for_per_game_prev) / (WEIGHT_PREV_SEASON + n_games_played)
-    goals_against_per_game = (goals_against_per_game * n_games_played + WEIGHT_PREV_SEASON * goals_against_per_game_prev) / (WEIGHT_PREV_SEASON + n_games_played)
-    shots_for_per_game = (shots_for_per_game * n_games_played + WEIGHT_PREV_SEASON * shots_for_per_game_prev) / (WEIGHT_PREV_SEASON + n_games_played)
-    shots_against_per_game = (shots_against_per_game * n_games_played + WEIGHT_PREV_SEASON * shots_against_per_game_prev) / (WEIGHT_PREV_SEASON + n_games_played)
-    wins_per_game = (wins_per_game * n_games_played + WEIGHT_PREV_SEASON * wins_per_game_prev) / (WEIGHT_PREV_SEASON + n_games_played)
-
-    df_games.loc[df_games['home_id'] == franchise_id,'goals_for_per_game_home'] = goals_for_per_game
-    df_games.loc[df_games['home_id'] == franchise_id, 'goals_against_per_game_home'] = goals_against_per_game
-    df_games.loc[df_games['home_id'] == franchise_id, 'shots_for_per_game_home'] = shots_for_per_game
-    df_games.loc[df_games['home_id'] == franchise_id, 'shots_against_per_game_home'] = shots_against_per_game
-    df_games.loc[df_games['home_id'] == franchise_id, 'wins_per_game_home'] = wins_per_game
-
-
-model = pickle.load(open(PATH_MODEL, 'rb'))
-
-away_probs = model.predict_proba(df_games[['wins_per_game_home','wins_per_game_away']])[:,0] # home, away
-home_probs = model.predict_proba(df_games[['wins_per_game_home','wins_per_game_away']])[:,1] # home, away
-df = deepcopy(df_games[['game_id', 'home_id', 'away_id', 'home_team', 'away_team']])
-df['home_prob'] = np.round(100 * home_probs, 1)
-df['away_prob'] = np.round(100 * away_probs, 1)
-
-#
-# ## df with each of these for home and away
-#
-# # new end
-# # old start
-# if __name__ == "__main__":
-#
-#     ## find today's games
-#     today = date.today()
-#     df_games = extract_dates_games(today)
-#
-#     ## determine which games have already been completed and make sure they are downloaded
-#     ## using the latest id because the earliest id could be a re-scheduled game
-#     latest_game_id = df_games['game_id'].max()
-#     latest_game_code = int(str(latest_game_id)[-4:])
-#     season = int(str(latest_game_id)[:4])
-#
-#     ## load in this season's data
-#     conn = sqlite3.connect(str(PATH_DB))
-#     cursor = conn.cursor()
-#     df_previous_games = pd.read_sql_query(f'SELECT * from boxscore WHERE season = {season}', conn)
-#
-#     ## add in any missing games ---
-#     ######### instead of this, just rerun the download_game_Data, process_feed_data, and build_ml_dataset scripts
-#     ### then get stats from build_ml_dataset for the latest games? need to .. hmm
-#     if str(latest_game_id)[5] == '2': ## ie. regular season
-#         i = 0
-#         while i < latest_game_code:
-#             i += 1
-#             id = str(int(latest_game_id) - latest_game_code + i)
-#             if id not in df_previous_games['game_id'].values:
-#                 add_boxscore_to_db(season, 2, id[-4:], conn, cursor); sleep(1)
-#
-#     if str(latest_game_id)[5] == '3': ## ie. playoffs, check all reg season games
-#         i = 0
-#         while i < (82 * 32 / 2): ## presumed number of games in a season
-#             i += 1
-#             id = str(int(latest_game_id) - latest_game_code + i - 10000) # 10k is to adjust from p/o to reg season
-#             print(id, id not in df_previous_games['game_id'].values)
-#             if id not in df_previous_games['game_id'].values:
-#                 add_boxscore_to_db(season, 2, id[-4:], conn, cursor); sleep(1)
-#
-#
-#
-#
-#
-# #### build dataset to input
-#
-# conn, cursor = create_database_connection(PATH_DB)
-# process_season_feed_data(season, conn, cursor) ## process the season in case it isn't already processed
-# df_season = pd.read_sql_query(f'SELECT * from boxscore_processed WHERE season = {season}', conn) ## the processed season is in this table
-
-
-# this has the cumulative stats but still need to do the feature engineering
-
-
-
-
-
-
-
-### just stealing from process_feed_data.py for now....
-## so refactor process_feed_data before this..
-# process_season_feed_data(season, conn, cursor)
-
-# conn = sqlite3.connect(str(PATH_DB))
-# df_season = pd.read_sql_query(f'SELECT * from boxscore WHERE season = {current_season}', conn)
-# conn.close()
-
-#
-# teams = list(df_games['home_id'].values) + list(df_games['away_id'].values)
-#
-# stats = {'team_id' : teams, 'win_percentage': []}
-# for team in teams:
-#
-#     df_team = df_season[(df_season['home_id'] == team)|(df_season['away_id'] == team)]
-#     df_team = df_team.sort_values('game_id').reset_index(drop = True) #### this needs to be sorted by date, not id (see 2020)
-#
-#     ## get the game stats for the given team
-#     home_bool = df_team['home_id'] == team; away_bool = df_team['away_id'] == team
-#     df_team_results = deepcopy(df_team[['game_id']])
-#     df_team_results.loc[home_bool, 'win'] = df_team.loc[home_bool, 'winner'] == 'home'
-#     df_team_results.loc[away_bool, 'win'] = df_team.loc[away_bool, 'winner'] == 'away'
-#
-#     vars = ['shots', 'goals', 'pim', 'shots', 'pp_goals', 'pp_attempts', 'fo_percent', 'blocks', 'takeaways', 'giveaways', 'hits']
-#     for var in vars:
-#         df_team_results = convert_team_stats(var, df_team, df_team_results, homeaway_bools = (home_bool, away_bool))
-#
-#     ## compute cumulative wins, losses, and games played
-#     df_team_results['games_played_before'] = np.arange(df_team_results.shape[0])
-#     df_team_results['games_played_after'] = df_team_results['games_played_before'] + 1
-#
-#     df_team_results['wins_after'] = df_team_results['win'].cumsum()
-#     df_team_results['wins_before'] = df_team_results['wins_after'] - df_team_results['win']
-#
-#     df_team_results['losses_before'] = df_team_results['games_played_before'] - df_team_results['wins_before']
-#     df_team_results['losses_after'] = df_team_results['games_played_after'] - df_team_results['wins_after']
-#
-#     df_team_results['team_id'] = team
-#
-#     wins = df_team_results['wins_after'].values[-1]
-#     gp = df_team_results['games_played_after'].values[-1]
-#
-#     weight_prev = 10
-#
-#     ## previous season
-#     df = pd.read_csv(f'data/processed/temp_{current_season - 1}_season_team{team}.csv')
-#     wins_per_game_previous = int(df.loc[np.max(df['games_played_before']), ['wins_after']].values[0]) / df.loc[np.max(df['games_played_before']), ['games_played_after']].values[0]
-#
-#     ## compute the stats
-#
-#     stats['win_percentage'] += [(weight_prev * wins_per_game_previous + wins) / (weight_prev + gp)] #### need to take into account last year's record here!
-#
-# df_stats = pd.DataFrame(stats)
-#
-# df_games = pd.merge(df_games, df_stats, left_on = 'home_id', right_on = 'team_id')
-# df_games = pd.merge(df_games, df_stats, left_on = 'away_id', right_on = 'team_id', suffixes = ('_home', '_away'))
-
-
-#### run prediction
-lr = pickle.load(open('models/2021_02_16_baseline_winperc_logreg.pickle', 'rb'))
-X = df_games[['win_percentage_home', 'win_percentage_away']]
-
-predictions = lr.predict_proba(X)
-
-results = deepcopy(df_games[['game_id','home_team']]) ## just putting the preductions into a readable format for me
-results['home_id'] = df_games['home_id']
-results['home_prob'] = np.round(100 * predictions[:,1])
-results['away_prob'] = np.round(100 * predictions[:,0])
-results['away_id'] = df_games['away_id']
-results['away_team'] = df_games['away_team'] ## note: these "probs" may not be well-calibrated
-
-results.to_csv('app/predictions.csv', index = False)
\ No newline at end of file
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Predict game outcomes for today, or in batch for a date range or season.')
+    parser.add_argument('--start', type = date.fromisoformat, help = 'first date of a range to predict into the predictions table')
+    parser.add_argument('--end', type = date.fromisoformat, help = 'last date of the range (defaults to --start)')
+    parser.add_argument('--season', type = int, help = 'predict every game of a season into the predictions table')
+    parser.add_argument('--concurrency', type = int, default = CONCURRENCY, help = 'schedule downloads in flight at once')
+    args = parser.parse_args()
+
+    start_run('predict')
+    with span('predict.load_model'):
+        model = pickle.load(open(PATH_MODEL, 'rb'))
+
+    if args.start is not None or args.season is not None:
+
+        ## batch mode: all games of the range / season, each with features as of its own start time
+        if args.season is not None:
+            seasons, start, end = [args.season], None, None
+        else:
+            start, end = args.start, args.end or args.start
+            seasons = range(season_from_date(start), season_from_date(end) + 1)
+
+        session = create_session(args.concurrency)
+        with span('predict.schedule'):
+            schedules = download_schedules(seasons, concurrency = args.concurrency, session = session)
+        conn, cursor = create_database_connection(PATH_DB)
+        df = predict_schedule(schedules, model, conn, cursor, start, end, session = session)
+        print(f'{df.shape[0]} predictions written for {pd.unique(df["date"]).shape[0] if df.shape[0] > 0 else 0} dates')
+
+    else:
+
+        ## find today's games
+        today = date.today()
+        with span('predict.schedule'):
+            df_games = extract_dates_games(today)
+
+        ## using the latest id because the earliest id could be a re-scheduled game
+        latest_game_id = df_games['game_id'].max()
+        season = int(str(latest_game_id)[:4])
+
+        ## features as of now, i.e. using every game processed so far this season; read from the
+        ## team state snapshot when it is current, otherwise computed from the db
+        snapshot = load_team_state_snapshot()
+        if snapshot is not None and is_snapshot_current(snapshot, df_games, season):
+            count('team_state_snapshot_hits')
+            with span('predict.model'):
+                df = predict_games_from_snapshot(df_games, snapshot, model)
+        else:
+            conn, cursor = create_database_connection(PATH_DB)
+            with span('predict.features'):
+                df_games = compute_game_features(df_games, season, pd.Timestamp.now(tz = 'UTC'), conn)
+                df_games = df_games[df_games[MODEL_FEATURES].notna().all(axis = 1)] ## e.g. a season without baselines
+            with span('predict.model'):
+                df = predict_games(df_games, model)
+
+        df.to_csv(PATH_PREDICTIONS, index = False)
+
+    print(f'run report written to {finish_run()}')
@@ -0,0 +1,257 @@
+"""
+This script runs a resident prediction server. The model and every team's cumulative
+season totals are loaded once at startup; requests are then answered from memory.
+Concurrent requests are micro-batched, so that the games of all requests arriving within
+BATCH_WINDOW_MS are featurized together and scored in a single predict_proba call.
+
+    POST /predict  {"games": [{"home_franchise_id": 10, "away_franchise_id": 6, "date": "2021-04-20"}]}
+    GET  /stats    request, game and batch counters with latency percentiles
+    POST /reload   re-reads the team state from the db (e.g. after new games are processed)
+"""
+
+## SETUP ##
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import Future
+from collections import deque
+from threading import Thread, Lock
+from queue import Queue, Empty
+from time import perf_counter
+import argparse
+import pickle
+import json
+import pandas as pd
+import numpy as np
+
+from scripts.helper import create_database_connection
+from scripts.features import load_team_state, load_team_baselines, prepare_point_in_time_lookup, lookup_point_in_time_features
+from scripts.predict_game_outcomes import PATH_DB, PATH_MODEL, MODEL_FEATURES, season_from_date
+
+HOST = '127.0.0.1'
+PORT = 8050
+BATCH_WINDOW_MS = 5 ## how long the batcher waits for more requests before scoring a batch
+MAX_BATCH_SIZE = 4096 ## maximum number of games scored in one batch
+AS_OF_HOUR_UTC = 12 ## features for a date use games before noon UTC, i.e. all of the previous night's games
+LATENCY_WINDOW = 10000 ## number of recent request latencies kept for the percentiles
+
+## FUNCTIONS ##
+
+class TeamStateStore:
+
+    """
+    Every team's cumulative totals after each game and the previous-season baselines, held in
+    memory as the arrays of features.prepare_point_in_time_lookup, for featurizing arbitrary
+    (team, date) pairs with the same lookup as compute_point_in_time_features.
+    """
+
+    def __init__(self, path_db = PATH_DB):
+        self.path_db = path_db
+        self.load()
+
+    def load(self):
+        conn, cursor = create_database_connection(self.path_db)
+        seasons = [row[0] for row in conn.execute('SELECT DISTINCT season FROM boxscore_processed_team')]
+        df_state = load_team_state(conn, seasons)
+        df_baselines = load_team_baselines(conn)
+        conn.close()
+
+        self.lookup = prepare_point_in_time_lookup(df_state, df_baselines) ## swapped in as a whole
+
+    def compute_features(self, df_games):
+
+        """
+        Computes the model features for a batch of games.
+
+        :param df_games: dataframe with columns home_franchise_id, away_franchise_id, season and datetime
+        :return: dataframe with one column per model feature
+        """
+
+        lookup = self.lookup
+        df_features = pd.DataFrame(index = df_games.index)
+        for side in ['home', 'away']:
+            features = lookup_point_in_time_features(lookup, df_games[f'{side}_franchise_id'], df_games['season'], df_games['datetime'])
+            for name, values in features.items():
+                df_features[f'{name}_{side}'] = values
+
+        return df_features[MODEL_FEATURES]
+
+class MicroBatcher:
+
+    """
+    Collects the games of concurrent requests into batches, scored by a single background
+    thread with one predict_proba call per batch, and keeps latency / throughput counters.
+    """
+
+    def __init__(self, model, store, window_ms = BATCH_WINDOW_MS, max_batch_size = MAX_BATCH_SIZE):
+        self.model = model
+        self.store = store
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.queue = Queue()
+        self.lock = Lock()
+        self.counters = {'requests': 0, 'games': 0, 'batches': 0, 'errors': 0}
+        self.latencies = deque(maxlen = LATENCY_WINDOW)
+        self.started = perf_counter()
+        Thread(target = self.run, daemon = True).start()
+
+    def submit(self, df_games):
+
+        """
+        Queues a request's games for scoring.
+
+        :param df_games: dataframe with columns home_franchise_id, away_franchise_id, season and datetime
+        :return: future resolving to an array of home win probabilities
+        """
+
+        future = Future()
+        self.queue.put((df_games, future))
+
+        return future
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            n_games = items[0][0].shape[0]
+            deadline = perf_counter() + self.window
+            while n_games < self.max_batch_size:
+                try:
+                    items.append(self.queue.get(timeout = max(0, deadline - perf_counter())))
+                    n_games += items[-1][0].shape[0]
+                except Empty:
+                    break
+            self.score(items)
+
+    def score(self, items):
+        try:
+            df_batch = pd.concat([df_games for df_games, _ in items], ignore_index = True)
+            df_features = self.store.compute_features(df_batch)
+            ## games without features (e.g. an unknown franchise or a season with no baseline) fail their own request only
+            is_valid = df_features.notna().all(axis = 1).to_numpy()
+            home_probs = np.full(df_batch.shape[0], np.nan)
+            if is_valid.any():
+                home_probs[is_valid] = self.model.predict_proba(df_features[is_valid])[:, 1]
+        except Exception as error:
+            for _, future in items:
+                future.set_exception(error)
+            return
+
+        start = 0
+        for df_games, future in items:
+            end = start + df_games.shape[0]
+            if is_valid[start:end].all():
+                future.set_result(home_probs[start:end])
+            else:
+                future.set_exception(ValueError(f'no features for games {np.flatnonzero(~is_valid[start:end]).tolist()}'))
+            start = end
+
+        with self.lock:
+            self.counters['batches'] += 1
+            self.counters['games'] += int(is_valid.sum())
+
+    def record(self, latency, error = False):
+        with self.lock:
+            self.counters['requests'] += 1
+            self.counters['errors'] += int(error)
+            self.latencies.append(latency)
+
+    def stats(self):
+        with self.lock:
+            latencies_ms = 1000 * np.array(self.latencies)
+            counters = dict(self.counters)
+        elapsed = perf_counter() - self.started
+        counters['games_per_sec'] = counters['games'] / elapsed
+        counters['games_per_batch'] = counters['games'] / max(counters['batches'], 1)
+        if latencies_ms.shape[0] > 0:
+            counters['latency_ms'] = {f'p{q}': float(np.percentile(latencies_ms, q)) for q in [50, 90, 99]}
+            counters['latency_ms']['max'] = float(latencies_ms.max())
+
+        return counters
+
+def parse_games(body):
+
+    """
+    Converts a /predict request body into a games dataframe.
+
+    :param body: dict with a list of games, each with home_franchise_id, away_franchise_id and date
+    :return: dataframe with columns home_franchise_id, away_franchise_id, season and datetime
+    """
+
+    df_games = pd.DataFrame(body['games'], columns = ['home_franchise_id', 'away_franchise_id', 'date'])
+    dates = pd.to_datetime(df_games['date'])
+    df_games['datetime'] = dates.dt.tz_localize('UTC') + pd.Timedelta(hours = AS_OF_HOUR_UTC)
+    df_games['season'] = [season_from_date(date) for date in dates]
+
+    return df_games.drop(columns = 'date')
+
+def create_handler(batcher):
+
+    """
+    Creates the request handler class, bound to a batcher.
+    """
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, batcher.stats())
+            else:
+                self.send_json(404, {'error': f'unknown path {self.path}'})
+
+        def do_POST(self):
+            start = perf_counter()
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            if self.path == '/reload':
+                batcher.store.load()
+                self.send_json(200, {'reloaded': True})
+                return
+            if self.path != '/predict':
+                self.send_json(404, {'error': f'unknown path {self.path}'})
+                return
+
+            try:
+                df_games = parse_games(json.loads(body))
+                home_probs = batcher.submit(df_games).result()
+            except Exception as error:
+                batcher.record(perf_counter() - start, error = True)
+                self.send_json(400, {'error': str(error)})
+                return
+
+            self.send_json(200, {'home_win_probabilities': [float(prob) for prob in home_probs]})
+            batcher.record(perf_counter() - start)
+
+    return PredictionHandler
+
+class PredictionServer(ThreadingHTTPServer):
+
+    request_queue_size = 128 ## listen backlog, so that bursts of concurrent clients aren't refused
+
+
+## SCRIPT ##
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Serve game outcome predictions over http.')
+    parser.add_argument('--host', default = HOST)
+    parser.add_argument('--port', type = int, default = PORT)
+    parser.add_argument('--db', default = PATH_DB)
+    parser.add_argument('--model', default = PATH_MODEL)
+    args = parser.parse_args()
+
+    model = pickle.load(open(args.model, 'rb'))
+    batcher = MicroBatcher(model, TeamStateStore(args.db))
+
+    server = PredictionServer((args.host, args.port), create_handler(batcher))
+    print(f'serving predictions on http://{args.host}:{args.port}')
+    server.serve_forever()
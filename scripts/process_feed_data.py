@@ -10,10 +10,12 @@ over the season).
 from pathlib import Path
 import pandas as pd
 import numpy as np
-from copy import deepcopy
 import re
+import argparse
 
-from scripts.helper import create_database_connection, execute_query
+from scripts.helper import create_database_connection, migrate_database, execute_query, write_dataframe, write_rows, compute_seasons_parallel
+from scripts.team_state import refresh_team_state
+from scripts.instrumentation import span, start_run, finish_run
 
 PATH_DB = Path('data/raw/nhl.db')
 PATH_QUERIES = Path('queries')
@@ -23,134 +25,315 @@ STATS_TO_PROCESS = ['shots', 'goals', 'pim', 'pp_goals', 'pp_attempts', 'fo_perc
 
 ## FUNCTIONS ##
 
-def compute_cumulative_stats(stat, df_games, home_bool = None, team_id = None):
+def compute_team_game_stats(df_season, df_start = None):
 
     """
-    Given a dataframe containing each of a team's games, determines a team's stat for and against for each game,
-    as well as cumulatively across all games.
+    Computes every team's stats for and against in each of its games, as well as cumulatively
+    over the season (as of the start and end of each game). The season is reshaped once into
+    a long table with one row per team per game, and all cumulative columns are computed with
+    a single grouped cumsum.
+
+    :param df_season: dataframe containing raw feed data for each game of a season
+    :param df_start: optional dataframe with each team's last processed boxscore_processed_team row,
+                     whose *_after totals the running totals are continued from (teams missing from it start at 0)
+    :return: dataframe with one row per team per game, sorted by team and date
+    """
+
+    ## one row per team per game, from the point of view of the home and away team respectively
+    sides = []
+    for side, opponent in [('home', 'away'), ('away', 'home')]:
+        df_side = pd.DataFrame({'game_id': df_season['game_id'].values,
+                                'datetime': df_season['datetime'].values,
+                                'season': df_season['season'].values,
+                                'franchise_id': df_season[f'{side}_franchise_id'].values,
+                                'win': (df_season['winner'] == side).astype('int').values,
+                                'is_home': side == 'home'})
+        for stat in STATS_TO_PROCESS:
+            df_side[f'{stat}_for'] = df_season[f'{side}_{stat}'].values
+            df_side[f'{stat}_against'] = df_season[f'{opponent}_{stat}'].values
+        sides.append(df_side)
+
+    df_long = pd.concat(sides, ignore_index = True)
+    df_long = df_long.sort_values(['franchise_id', 'datetime'], kind = 'stable').reset_index(drop = True)
+
+    ## cumulative stats as of the end of each game, computed for all stats at once within each team's
+    ## block of rows (a plain cumsum per block, so float stats round exactly as a per-team cumsum would)
+    stat_cols = ['win'] + [f'{stat}_{direction}' for stat in STATS_TO_PROCESS for direction in ['for', 'against']]
+    grouped = df_long.groupby('franchise_id', sort = False)
+    values = df_long[stat_cols].to_numpy(dtype = 'float64')
+    team_starts = np.flatnonzero(np.r_[True, df_long['franchise_id'].values[1:] != df_long['franchise_id'].values[:-1]])
+    games_played_start = np.zeros(df_long.shape[0], dtype = 'int')
+
+    ## continue from previously processed totals by folding them into each team's first row
+    if df_start is not None and df_start.shape[0] > 0:
+        start_cols = ['wins_after'] + [f'{col}_after' for col in stat_cols[1:]]
+        df_start = df_start.set_index('franchise_id').reindex(df_long['franchise_id'].values[team_starts])
+        values[team_starts] += df_start[start_cols].fillna(0).to_numpy(dtype = 'float64')
+        games_played_start = np.repeat(df_start['games_played_after'].fillna(0).to_numpy(dtype = 'int'),
+                                       np.diff(np.r_[team_starts, df_long.shape[0]]))
+
+    values_after = np.concatenate([np.cumsum(block, axis = 0) for block in np.split(values, team_starts[1:])])
+    df_after = pd.DataFrame(values_after, columns = stat_cols)
+    df_after['win'] = df_after['win'].astype('int')
+
+    df_results = df_long[['game_id', 'datetime', 'season', 'franchise_id']].copy()
+
+    ## cumulative count of games played, wins and losses before / after each game
+    df_results['games_played_before'] = grouped.cumcount().values + games_played_start
+    df_results['games_played_after'] = df_results['games_played_before'] + 1
+    df_results['win'] = df_long['win']
+    df_results['wins_after'] = df_after['win']
+    df_results['wins_before'] = df_results['wins_after'] - df_results['win']
+    df_results['losses_before'] = df_results['games_played_before'] - df_results['wins_before']
+    df_results['losses_after'] = df_results['games_played_after'] - df_results['wins_after']
+
+    ## each of the other stats for / against, per game and as of the end / start of each game
+    for stat in STATS_TO_PROCESS:
+        for direction in ['for', 'against']:
+            df_results[f'{stat}_{direction}'] = df_long[f'{stat}_{direction}']
+        for direction in ['for', 'against']:
+            df_results[f'{stat}_{direction}_after'] = df_after[f'{stat}_{direction}']
+        for direction in ['for', 'against']:
+            df_results[f'{stat}_{direction}_before'] = df_after[f'{stat}_{direction}'] - df_long[f'{stat}_{direction}']
+
+    df_results['is_home'] = df_long['is_home']
+
+    return df_results
+
+def add_season_stats(df_season, df_team_results):
+
+    """
+    Adds each team's season stats as of the start of each game to the game-level data,
+    as home_season_{stat} and away_season_{stat} columns.
 
-    :param stat: Name of the statistic to be cumulated. df_games should have columns named "home_{stat}" and "away_{stat}"
-    :param df_games: Dataframe containing raw feed data for each of the team's games
-    :param home_bools: optional array or series of booleans indicating the games for which the team played at home
-    :param team_id: optional int with the team's franchise id
-    :return: returns a dataframe containing the teams stats for and against for each game as well as cumulatively
+    :param df_season: dataframe containing raw feed data for each game of a season
+    :param df_team_results: dataframe as returned by compute_team_game_stats
+    :return: copy of df_season with the season stat columns added
     """
 
-    ## set up a df to add data to
-    df_team_results = deepcopy(df_games[['game_id']])
+    stats_to_add = [re.sub('_before', '', stat) for stat in df_team_results.columns if '_before' in stat]
+    df_home = df_team_results[df_team_results['is_home']].set_index('game_id').reindex(df_season['game_id'])
+    df_away = df_team_results[~df_team_results['is_home']].set_index('game_id').reindex(df_season['game_id'])
 
-    ## determine when the team is home /away
-    if home_bool is None:
-        if team_id is None:
-            raise ValueError('Need to input either homeaway_bools or team_id')
-        else:
-            home_bool = df_games['home_franchise_id'] == team_id
-            away_bool = ~home_bool
-    else:
-        away_bool = ~home_bool
+    df_season_stats = {}
+    for stat in stats_to_add:
+        df_season_stats[f'home_season_{stat}'] = df_home[f'{stat}_before'].values
+        df_season_stats[f'away_season_{stat}'] = df_away[f'{stat}_before'].values
+
+    return pd.concat([df_season.reset_index(drop = True), pd.DataFrame(df_season_stats)], axis = 1)
+
+def get_processing_state(season, conn):
+
+    """
+    Looks up the high-water mark of a season, i.e. the latest game that has been processed.
+
+    :param season: year in which the season started
+    :param conn: conn for the db
+    :return: tuple with the datetime and game id of the latest processed game, or None if the season hasn't been processed
+    """
+
+    if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'processing_state'").fetchone() is None:
+        return None
+
+    return conn.execute('SELECT last_datetime, last_game_id FROM processing_state WHERE season = ?', (int(season),)).fetchone()
+
+def write_processed_season(season, df_season, df_team_results, conn, cursor):
+
+    """
+    Upserts processed game and team rows into the db, moves the season's high-water
+    mark forward to the latest game written and refreshes the team state snapshot.
+
+    :param season: year in which the season started
+    :param df_season: dataframe as returned by add_season_stats
+    :param df_team_results: dataframe as returned by compute_team_game_stats
+    :param conn: conn for the db
+    :param cursor: cursor for the db
+    :return: no return
+    """
+
+    with span('process.write'):
+
+        ## add processed team data to db
+        execute_query(PATH_QUERIES/'create_table_boxscore_processed_team', cursor)
+        write_dataframe(df_team_results.drop(columns = 'is_home'), 'boxscore_processed_team', cursor, on_conflict = 'REPLACE')
+
+        ## add processed season data to db
+        execute_query(PATH_QUERIES / 'create_table_boxscore_processed', cursor)
+        write_dataframe(df_season, 'boxscore_processed', cursor, on_conflict = 'REPLACE')
+
+        ## move the high-water mark forward
+        latest_game = df_season.sort_values(['datetime', 'game_id']).iloc[-1]
+        state = get_processing_state(season, conn)
+        if state is None or latest_game['datetime'] > state[0]:
+            execute_query(PATH_QUERIES/'create_table_processing_state', cursor)
+            write_rows([(int(season), latest_game['datetime'], latest_game['game_id'])],
+                       ['season', 'last_datetime', 'last_game_id'], 'processing_state', cursor, on_conflict = 'REPLACE')
+
+        conn.commit()
+
+    ## keep the prediction snapshot of each team's latest totals up to date
+    with span('process.team_state'):
+        refresh_team_state(season, conn)
 
-    ## add in the stats FOR the given team
-    df_team_results[f'{stat}_for'] = np.nan
-    df_team_results.loc[home_bool, f'{stat}_for'] = df_games.loc[home_bool, f'home_{stat}']
-    df_team_results.loc[away_bool, f'{stat}_for'] = df_games.loc[away_bool, f'away_{stat}']
+def compute_season_feed_data(season, conn):
 
-    ## add in the stats AGAINST the given team
-    df_team_results[f'{stat}_against'] = np.nan
-    df_team_results.loc[home_bool, f'{stat}_against'] = df_games.loc[home_bool, f'away_{stat}']
-    df_team_results.loc[away_bool, f'{stat}_against'] = df_games.loc[away_bool, f'home_{stat}']
+    """
+    Computes the processed game and team rows of every game of a season, without writing
+    them (see process_season_feed_data). Only reads from the db, so seasons can be computed
+    in parallel worker processes.
+
+    :param season: year in which the season started
+    :param conn: conn for the db
+    :return: tuple with the dataframes passed to write_processed_season (df_season, df_team_results), or None if there are no games
+    """
+
+    query_str = f"SELECT * from boxscore WHERE season = {season} AND game_type IN (2,3)" ## ignore pre-season (game_type = 1)
+    with span('process.read'):
+        df_season = pd.read_sql_query(query_str, conn)
+    if df_season.shape[0] == 0:
+        return None
+
+    with span('process.compute'):
+        df_team_results = compute_team_game_stats(df_season)
+        df_season = add_season_stats(df_season, df_team_results)
+
+    return df_season, df_team_results
 
-    ## compute seasons stats as of end of each game
-    df_team_results[f'{stat}_for_after'] = df_team_results[f'{stat}_for'].cumsum()
-    df_team_results[f'{stat}_against_after'] = df_team_results[f'{stat}_against'].cumsum()
+def compute_season_feed_data_incremental(season, conn):
 
-    ## compute seasons stats as of start of each game
-    df_team_results[f'{stat}_for_before'] = df_team_results[f'{stat}_for_after'] - df_team_results[f'{stat}_for']
-    df_team_results[f'{stat}_against_before'] = df_team_results[f'{stat}_against_after'] - df_team_results[f'{stat}_against']
+    """
+    Computes the processed rows of only the games of a season that haven't been processed yet,
+    without writing them (see process_season_feed_data_incremental).
+
+    :param season: year in which the season started
+    :param conn: conn for the db
+    :return: tuple with the dataframes passed to write_processed_season (df_season, df_team_results), or None if there are no new games
+    """
 
-    return df_team_results
+    state = get_processing_state(season, conn)
+    if state is None:
+        return compute_season_feed_data(season, conn)
+
+    query_new = f"""SELECT * FROM boxscore WHERE season = {season} AND game_type IN (2,3)
+                    AND game_id NOT IN (SELECT game_id FROM boxscore_processed WHERE season = {season})"""
+    with span('process.read'):
+        df_new = pd.read_sql_query(query_new, conn)
+    if df_new.shape[0] == 0:
+        return None
+
+    if df_new['datetime'].min() <= state[0]:
+        print(f'{season}: new games before the high-water mark, reprocessing the full season')
+        return compute_season_feed_data(season, conn)
+
+    ## last processed row of each affected franchise
+    franchise_ids = ', '.join([str(franchise_id) for franchise_id in pd.unique(df_new[['home_franchise_id', 'away_franchise_id']].values.ravel())])
+    query_start = f"""SELECT t.* FROM boxscore_processed_team t
+                      JOIN (SELECT franchise_id, MAX(games_played_after) AS games_played_after FROM boxscore_processed_team
+                            WHERE season = {season} AND franchise_id IN ({franchise_ids}) GROUP BY franchise_id) m
+                      ON t.franchise_id = m.franchise_id AND t.games_played_after = m.games_played_after
+                      WHERE t.season = {season}"""
+    with span('process.read'):
+        df_start = pd.read_sql_query(query_start, conn)
+
+    with span('process.compute'):
+        df_team_results = compute_team_game_stats(df_new, df_start = df_start)
+        df_new = add_season_stats(df_new, df_team_results)
+
+    return df_new, df_team_results
 
 def process_season_feed_data(season, conn, cursor):
 
     """
     Processes raw live feed data (from db conn input) for a given season into a format
-    more suitable for building ML models, and saves back to the db.
+    more suitable for building ML models, and saves back to the db. Every game of the
+    season is recomputed, and existing rows are replaced.
 
     :param season: year in which the season started
     :param conn:
     :param cursor:
-    :return: no return
+    :return: number of games processed
     """
 
-    query_str = f"SELECT * from boxscore WHERE season = {season} AND game_type IN (2,3)" ## ignore pre-season (game_type = 1)
-    df_season = pd.read_sql_query(query_str, conn)
-    all_teams = df_season['home_franchise_id'].unique()
+    frames = compute_season_feed_data(season, conn)
+    if frames is None:
+        return 0
 
-    for team in all_teams:
+    write_processed_season(season, *frames, conn, cursor)
 
-        ## get all of team's games, sorted by date
-        df_team = deepcopy(df_season[(df_season['home_franchise_id'] == team)|(df_season['away_franchise_id'] == team)])
-        df_team = df_team.sort_values('datetime').reset_index(drop = True)
+    return frames[0].shape[0]
 
-        ## get the game stats for the given team
-        home_bool = df_team['home_franchise_id'] == team
-        away_bool = ~home_bool
+def process_season_feed_data_incremental(season, conn, cursor):
 
-        ## set up a df to which to add the team's results
-        df_team_results = deepcopy(df_team[['game_id', 'datetime', 'season']])
-        df_team_results['franchise_id'] = team
+    """
+    Processes only the games of a season that haven't been processed yet. The running totals
+    of the franchises playing in those games are continued from their last processed
+    *_after values, and only the new rows are written. Falls back to reprocessing the whole
+    season if it hasn't been processed before, or if a new game is older than the season's
+    high-water mark (e.g. a late-arriving game), since later totals would then be stale.
 
-        ## cumulative count of games played before / after each game
-        df_team_results['games_played_before'] = np.arange(df_team_results.shape[0])
-        df_team_results['games_played_after'] = df_team_results['games_played_before'] + 1
+    :param season: year in which the season started
+    :param conn:
+    :param cursor:
+    :return: number of games processed
+    """
 
-        ## check whether the team won each game
-        df_team_results.loc[home_bool, 'win'] = df_team.loc[home_bool, 'winner'] == 'home'
-        df_team_results.loc[away_bool, 'win'] = df_team.loc[away_bool, 'winner'] == 'away'
-        df_team_results['win'] = df_team_results['win'].astype('int')
+    frames = compute_season_feed_data_incremental(season, conn)
+    if frames is None:
+        return 0
 
-        ## cumulative count of wins before / after each game
-        df_team_results['wins_after'] = df_team_results['win'].cumsum()
-        df_team_results['wins_before'] = df_team_results['wins_after'] - df_team_results['win']
+    write_processed_season(season, *frames, conn, cursor)
 
-        ## cumulative count of losses before / after each game
-        df_team_results['losses_before'] = df_team_results['games_played_before'] - df_team_results['wins_before']
-        df_team_results['losses_after'] = df_team_results['games_played_after'] - df_team_results['wins_after']
+    return frames[0].shape[0]
 
-        ## add in each of the other stats
-        for stat in STATS_TO_PROCESS:
-            df_team_next_result = compute_cumulative_stats(stat, df_team, home_bool = home_bool)
-            df_team_results = pd.merge(df_team_results, df_team_next_result, on = 'game_id')
+def process_seasons_parallel(seasons, conn, cursor, path_db = PATH_DB, workers = None, full = False):
 
-        ## add processed team data to db
-        execute_query(PATH_QUERIES/'create_table_boxscore_processed_team', cursor)
-        execute_query(PATH_QUERIES/'insert_or_ignore_entry', cursor,
-                      replacements = {'xtablex' : 'boxscore_processed_team',
-                                      'xkeysx' : ', '.join(list(df_team_results.iloc[0].to_dict().keys())),
-                                      'xvaluesx' : ', '.join([str(tuple(row[1].to_dict().values())) for row in df_team_results.iterrows()])})
-        conn.commit()
+    """
+    Processes many seasons at once: each season's frames are computed in a pool of worker
+    processes (seasons are independent of each other), and written by this process, the
+    db's only writer, as they complete.
+
+    :param seasons: iterable of seasons
+    :param conn: conn for the db
+    :param cursor: cursor for the db
+    :param path_db: path of the db, opened by each worker
+    :param workers: number of worker processes (defaults to the number of cpus)
+    :param full: whether to reprocess every game instead of only new ones
+    :return: dict mapping season to number of games processed
+    """
+
+    compute = compute_season_feed_data if full else compute_season_feed_data_incremental
 
-        ## add season stats (as of start of each game) back to df_season
-        stats_to_add = [re.sub('_before','',stat) for stat in df_team_results.columns if '_before' in stat]
-        for stat in stats_to_add:
-            if f'home_season_{stat}' not in df_season.columns:
-                df_season[f'home_season_{stat}'] = np.nan
-            if f'away_season_{stat}' not in df_season.columns:
-                df_season[f'away_season_{stat}'] = np.nan
-            df_season.loc[df_season['game_id'].isin(df_team.loc[home_bool, 'game_id']),f'home_season_{stat}'] = df_team_results.loc[home_bool, f'{stat}_before'].values
-            df_season.loc[df_season['game_id'].isin(df_team.loc[away_bool, 'game_id']),f'away_season_{stat}'] = df_team_results.loc[away_bool, f'{stat}_before'].values
-
-    ## add processed season data to db
-    execute_query(PATH_QUERIES / 'create_table_boxscore_processed', cursor)
-    execute_query(PATH_QUERIES/'insert_or_ignore_entry', cursor,
-                  replacements = {'xtablex' : 'boxscore_processed',
-                                  'xkeysx' : ', '.join(list(df_season.iloc[0].to_dict().keys())),
-                                  'xvaluesx' : ', '.join([str(tuple(row[1].to_dict().values())) for row in df_season.iterrows()])})
-    conn.commit()
+    n_games = {}
+    for season, frames in compute_seasons_parallel(compute, [int(season) for season in seasons], path_db, workers):
+        n_games[season] = 0 if frames is None else frames[0].shape[0]
+        if frames is not None:
+            write_processed_season(season, *frames, conn, cursor)
+
+    return n_games
 
 ## SCRIPT ##
 
 if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Process raw boxscore data into cumulative season stats.')
+    parser.add_argument('--full', action = 'store_true', help = 'reprocess every game instead of only new ones')
+    parser.add_argument('--workers', type = int, default = 1, help = 'compute seasons in this many worker processes (writes stay in the main process)')
+    args = parser.parse_args()
+
+    start_run('process')
     conn, cursor = create_database_connection(PATH_DB)
-    for season in SEASONS_TO_PROCESS:
-        process_season_feed_data(season, conn, cursor)
+    if args.workers > 1:
+        n_games = process_seasons_parallel(SEASONS_TO_PROCESS, conn, cursor, PATH_DB, args.workers, args.full)
+        for season in sorted(n_games):
+            print(f'{season}: {n_games[season]} games processed')
+    else:
+        for season in SEASONS_TO_PROCESS:
+            if args.full:
+                n_games = process_season_feed_data(season, conn, cursor)
+            else:
+                n_games = process_season_feed_data_incremental(season, conn, cursor)
+            print(f'{season}: {n_games} games processed')
+
+    migrate_database(conn, cursor)
 
+    print(f'run report written to {finish_run()}')
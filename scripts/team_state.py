@@ -0,0 +1,249 @@
+"""
+Compact snapshot of each franchise's latest cumulative season totals and previous-season
+baseline, stored as a numpy structured array indexed by franchise_id and persisted to disk.
+Predicting a game from the snapshot is an array lookup plus a dot product, with no sql.
+Looking teams up only needs numpy (see predict_fast.py), so pandas is imported by the
+functions that build the snapshot from the db.
+"""
+
+## SETUP ##
+
+from pathlib import Path
+import numpy as np
+
+from scripts.feature_config import BASELINE_STATS, WEIGHT_PREV_SEASON
+
+PATH_TEAM_STATE = Path('data/processed/team_state.npy')
+
+TEAM_STATE_DTYPE = np.dtype([('franchise_id', 'i4'), ('season', 'i4'), ('datetime', 'U20'), ('games_played', 'f8')]
+                            + [(f'{stat}_after', 'f8') for stat in BASELINE_STATS]
+                            + [(f'previous_{stat}_per_game', 'f8') for stat in BASELINE_STATS])
+
+## FUNCTIONS ##
+
+def create_empty_team_state(size):
+
+    """
+    Creates a snapshot with room for franchise ids 0 to size - 1. Unused slots have franchise_id -1.
+
+    :param size: number of slots
+    :return: structured array with dtype TEAM_STATE_DTYPE
+    """
+
+    snapshot = np.zeros(size, dtype = TEAM_STATE_DTYPE)
+    snapshot['franchise_id'] = -1
+    snapshot['season'] = -1
+    for stat in BASELINE_STATS:
+        snapshot[f'previous_{stat}_per_game'] = np.nan
+
+    return snapshot
+
+def update_team_state(snapshot, df_team_results, df_baselines, replace_season = False):
+
+    """
+    Moves the snapshot forward with newly processed boxscore_processed_team rows. Each
+    franchise's slot is only replaced by a row at least as late as the one it holds (a
+    reprocessed last game keeps its datetime but can have new totals), so reprocessing an
+    older season leaves the snapshot untouched.
+
+    :param snapshot: structured array as returned by create_empty_team_state or build_team_state
+    :param df_team_results: boxscore_processed_team rows
+    :param df_baselines: previous-season baselines covering the rows' seasons
+    :param replace_season: whether df_team_results holds all rows of its season, so that slots
+        holding that season are replaced whatever their datetime (e.g. after games were removed)
+    :return: updated snapshot (a new array if it had to grow)
+    """
+
+    import pandas as pd
+
+    if df_team_results.shape[0] == 0:
+        return snapshot
+
+    ## latest row of each franchise among the new rows
+    df_latest = df_team_results.sort_values(['season', 'datetime']).groupby('franchise_id').tail(1)
+    df_latest = pd.merge(df_latest, df_baselines, on = ['season', 'franchise_id'], how = 'left')
+
+    max_franchise_id = int(df_latest['franchise_id'].max())
+    if max_franchise_id >= snapshot.shape[0]:
+        snapshot_grown = create_empty_team_state(max_franchise_id + 1)
+        snapshot_grown[:snapshot.shape[0]] = snapshot
+        snapshot = snapshot_grown
+
+    franchise_ids = df_latest['franchise_id'].to_numpy(dtype = 'int64')
+    seasons = df_latest['season'].to_numpy(dtype = 'int64')
+    datetimes = df_latest['datetime'].to_numpy(dtype = 'U20')
+    is_later = (seasons > snapshot['season'][franchise_ids]) | \
+               ((seasons == snapshot['season'][franchise_ids]) & ((datetimes >= snapshot['datetime'][franchise_ids]) | replace_season))
+
+    df_latest = df_latest[is_later]
+    slots = franchise_ids[is_later]
+    snapshot['franchise_id'][slots] = slots
+    snapshot['season'][slots] = seasons[is_later]
+    snapshot['datetime'][slots] = datetimes[is_later]
+    snapshot['games_played'][slots] = df_latest['games_played_after'].to_numpy(dtype = 'float64')
+    for stat in BASELINE_STATS:
+        snapshot[f'{stat}_after'][slots] = df_latest[f'{stat}_after'].to_numpy(dtype = 'float64')
+        snapshot[f'previous_{stat}_per_game'][slots] = df_latest[f'previous_{stat}_per_game'].to_numpy(dtype = 'float64')
+
+    return snapshot
+
+def build_team_state(conn, season):
+
+    """
+    Builds a snapshot from each franchise's latest processed row of a season.
+
+    :param conn: conn for the db
+    :param season: year in which the season started
+    :return: structured array with dtype TEAM_STATE_DTYPE
+    """
+
+    import pandas as pd
+
+    df_team_results = pd.read_sql_query(f'SELECT * FROM boxscore_processed_team WHERE season = {season}', conn)
+    df_baselines = pd.read_sql_query(f'SELECT * FROM team_baselines WHERE season = {season}', conn)
+
+    return update_team_state(create_empty_team_state(0), df_team_results, df_baselines, replace_season = True)
+
+def save_team_state(snapshot, path = PATH_TEAM_STATE):
+
+    """
+    Saves a snapshot to disk.
+
+    :param snapshot: structured array with dtype TEAM_STATE_DTYPE
+    :param path: path of the .npy file
+    :return: no return
+    """
+
+    Path(path).parent.mkdir(parents = True, exist_ok = True)
+    np.save(path, snapshot)
+
+def load_team_state_snapshot(path = PATH_TEAM_STATE):
+
+    """
+    Loads a snapshot from disk.
+
+    :param path: path of the .npy file
+    :return: structured array with dtype TEAM_STATE_DTYPE, or None if no snapshot has been saved
+    """
+
+    if not Path(path).exists():
+        return None
+
+    return np.load(path)
+
+def is_team_state_current(snapshot, franchise_ids, season):
+
+    """
+    Checks whether the snapshot holds this season's totals and baseline for every franchise.
+
+    :param snapshot: structured array with dtype TEAM_STATE_DTYPE
+    :param franchise_ids: array of franchise ids
+    :param season: year in which the season started
+    :return: True if every franchise can be looked up in the snapshot
+    """
+
+    franchise_ids = np.asarray(franchise_ids, dtype = 'int64')
+    if franchise_ids.max() >= snapshot.shape[0]:
+        return False
+
+    rows = snapshot[franchise_ids]
+
+    return bool((rows['season'] == season).all() and not np.isnan(rows['previous_wins_per_game']).any())
+
+def compute_snapshot_features(snapshot, franchise_ids, weight_previous_season = WEIGHT_PREV_SEASON):
+
+    """
+    Computes the weighted per-game features of each franchise from the snapshot, with the same
+    weighting as compute_point_in_time_features.
+
+    :param snapshot: structured array with dtype TEAM_STATE_DTYPE
+    :param franchise_ids: array of franchise ids
+    :param weight_previous_season: weight of previous season
+    :return: dict mapping {stat}_per_game to an array of features aligned with franchise_ids
+    """
+
+    rows = snapshot[np.asarray(franchise_ids, dtype = 'int64')]
+    if (rows['franchise_id'] < 0).any():
+        raise KeyError('Franchise not in the team state snapshot')
+
+    return {f'{stat}_per_game': (weight_previous_season * rows[f'previous_{stat}_per_game'] + rows[f'{stat}_after'])
+                                / (rows['games_played'] + weight_previous_season)
+            for stat in BASELINE_STATS}
+
+def predict_home_win_probability(snapshot, home_ids, away_ids, coef, intercept, feature_names):
+
+    """
+    Predicts the probability of a home win for each game with a logistic model, directly
+    from the snapshot.
+
+    :param snapshot: structured array with dtype TEAM_STATE_DTYPE
+    :param home_ids: array of home franchise ids
+    :param away_ids: array of away franchise ids
+    :param coef: array of model coefficients, ordered as feature_names
+    :param intercept: model intercept
+    :param feature_names: names of the model features, e.g. 'wins_per_game_home'
+    :return: array of home win probabilities
+    """
+
+    features = {'home': compute_snapshot_features(snapshot, home_ids),
+                'away': compute_snapshot_features(snapshot, away_ids)}
+    X = np.column_stack([features[name.rsplit('_', 1)[1]][name.rsplit('_', 1)[0]] for name in feature_names])
+
+    return 1 / (1 + np.exp(-(X @ np.asarray(coef, dtype = 'float64') + intercept)))
+
+def refresh_team_state(season, conn, path = PATH_TEAM_STATE):
+
+    """
+    Rebuilds the slots of a season in the snapshot on disk from all of its rows in the
+    boxscore_processed_team table, so it is called whenever the season is (re)written.
+
+    :param season: year in which the season started
+    :param conn: conn for the db
+    :param path: path of the .npy file
+    :return: no return
+    """
+
+    import pandas as pd
+    from scripts.features import load_team_baselines
+
+    df_team_results = pd.read_sql_query(f'SELECT * FROM boxscore_processed_team WHERE season = {season}', conn)
+    if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'team_baselines'").fetchone() is None:
+        df_baselines = pd.DataFrame({col: pd.Series(dtype = 'int64' if col in ['season', 'franchise_id'] else 'float64')
+                                     for col in ['season', 'franchise_id'] + [f'previous_{stat}_per_game' for stat in BASELINE_STATS]})
+    else:
+        df_baselines = load_team_baselines(conn, season)
+
+    snapshot = load_team_state_snapshot(path)
+    if snapshot is None:
+        snapshot = create_empty_team_state(0)
+
+    save_team_state(update_team_state(snapshot, df_team_results, df_baselines, replace_season = True), path)
+
+def refresh_team_state_baselines(conn, path = PATH_TEAM_STATE):
+
+    """
+    Refreshes the previous-season baseline of every slot of the snapshot on disk from the
+    team_baselines table. Seasons are processed before their baselines are materialized,
+    so this is called after materialize_team_baselines.
+
+    :param conn: conn for the db
+    :param path: path of the .npy file
+    :return: no return
+    """
+
+    import pandas as pd
+    from scripts.features import load_team_baselines
+
+    snapshot = load_team_state_snapshot(path)
+    if snapshot is None or conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'team_baselines'").fetchone() is None:
+        return
+
+    slots = np.flatnonzero(snapshot['franchise_id'] >= 0)
+    df_slots = pd.DataFrame({'season': snapshot['season'][slots].astype('int64'), 'franchise_id': slots.astype('int64')})
+    df_baselines = load_team_baselines(conn).astype({'season': 'int64', 'franchise_id': 'int64'})
+    df_slots = pd.merge(df_slots, df_baselines, on = ['season', 'franchise_id'], how = 'left')
+
+    for stat in BASELINE_STATS:
+        snapshot[f'previous_{stat}_per_game'][slots] = df_slots[f'previous_{stat}_per_game'].to_numpy(dtype = 'float64')
+
+    save_team_state(snapshot, path)
@@ -7,17 +7,22 @@ from pathlib import Path
 import pickle
 from sklearn.linear_model import LogisticRegression
 from sklearn import metrics
-import matplotlib.pyplot as plt
 
-plt.interactive(False)
+from scripts.feature_store import load_features, get_latest_version
+from scripts.features import WEIGHT_PREV_SEASON
+from scripts.build_ml_dataset import TRAINING_SEASONS
+from scripts.model_artifact import PATH_MODEL_ARTIFACT, export_model_artifact
 
-PATH_DATA_PROCESSED = Path('data/processed')
 PATH_MODELS = Path('models')
-DATASET_NAME = 'dataset_2021_03_01_wins_only.csv'
+SHOW_PLOTS = False ## plot the validation probabilities (needs matplotlib)
 
 ### LOAD AND SPLIT DATA ###
 
-df = pd.read_csv(PATH_DATA_PROCESSED/DATASET_NAME)
+X_vars = ['wins_per_game_home', 'wins_per_game_away']
+y_var = 'home_win'
+
+## only the columns and seasons needed, memory-mapped from the latest feature store version
+df = load_features(columns = ['season'] + X_vars + [y_var], seasons = TRAINING_SEASONS)
 seasons = df['season'].unique()
 validation_seasons = np.sort(seasons)[-1:] ## use the last season as a validation set
 train_seasons = [season for season in seasons if season not in validation_seasons]
@@ -25,9 +30,6 @@ train_seasons = [season for season in seasons if season not in validation_season
 df_train = df[df['season'].isin(train_seasons)]
 df_valid = df[df['season'].isin(validation_seasons)]
 
-X_vars = ['wins_per_game_home', 'wins_per_game_away']
-y_var = 'home_win'
-
 X_train = df_train[X_vars]; X_valid = df_valid[X_vars]
 y_train = df_train[y_var]; y_valid = df_valid[y_var]
 
@@ -43,8 +45,10 @@ coefficients = pd.DataFrame({'variable':X_train.columns, 'coefficient':lr.coef_[
 probs_train = lr.predict_proba(X_train)
 probs_val = lr.predict_proba(X_valid)
 
-plt.hist(probs_val[:,1])
-plt.show()
+if SHOW_PLOTS:
+    import matplotlib.pyplot as plt
+    plt.hist(probs_val[:,1])
+    plt.show()
 
 ## set cut-off so that prob home win roughly correct in train set
 np.mean(y_train)
@@ -58,3 +62,9 @@ metrics.confusion_matrix(y_valid, probs_val[:,1] > cutoff)
 
 pickle.dump(lr, open('models/2021_04_20_logreg_win_percentage_only.pickle', 'wb'))
 
+## compact artifact for numpy-only prediction (see predict_fast.py)
+export_model_artifact(lr, X_vars, cutoff, PATH_MODEL_ARTIFACT,
+                      weight_previous_season = WEIGHT_PREV_SEASON,
+                      training_seasons = [int(season) for season in train_seasons],
+                      feature_store_version = get_latest_version())
+
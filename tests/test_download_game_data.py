@@ -0,0 +1,100 @@
+"""
+Tests of the download engine (TokenBucket, download_page and download_games) against a
+local stand-in for the stats api, serving canned feeds, 429 and 500 responses. Run from the
+repo root with
+
+    python -m pytest tests
+"""
+
+## SETUP ##
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from time import monotonic
+import unittest
+import json
+
+from requests.exceptions import RequestException
+
+from scripts.download_game_data import TokenBucket, download_page, download_games
+
+GAME_OK = '2019020001'
+GAME_RATE_LIMITED = '2019020002' ## 429 on the first request, then the feed
+GAME_FAILING = '2019020003' ## always 500
+
+## FUNCTIONS ##
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    """
+    Serves /game/<game code>/feed/live, counting the requests made for each path.
+    """
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests[self.path] = self.server.requests.get(self.path, 0) + 1
+            n_requests = self.server.requests[self.path]
+
+        game_code = self.path.split('/')[2]
+        if game_code == GAME_FAILING or (game_code == GAME_RATE_LIMITED and n_requests == 1):
+            self.send_response(500 if game_code == GAME_FAILING else 429)
+            self.end_headers()
+            return
+
+        body = json.dumps({'gamePk': int(game_code)}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestDownloadEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.requests = {}
+        self.server.lock = Lock()
+        Thread(target = self.server.serve_forever, daemon = True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def feed_url(self, game_code):
+        return f'{self.base_url}/game/{game_code}/feed/live'
+
+    def n_requests(self, game_code):
+        return self.server.requests.get(f'/game/{game_code}/feed/live', 0)
+
+    def test_token_bucket_caps_rate(self):
+        bucket = TokenBucket(rate = 50, capacity = 1)
+        start = monotonic()
+        for _ in range(11):
+            bucket.acquire()
+        self.assertGreaterEqual(monotonic() - start, 0.9 * 10 / 50)
+
+    def test_download_page_retries_rate_limited(self):
+        data = download_page(self.feed_url(GAME_RATE_LIMITED), retries = 2, backoff = 0.01)
+        self.assertEqual(data, {'gamePk': int(GAME_RATE_LIMITED)})
+        self.assertEqual(self.n_requests(GAME_RATE_LIMITED), 2)
+
+    def test_download_page_raises_after_retries(self):
+        with self.assertRaises(RequestException):
+            download_page(self.feed_url(GAME_FAILING), retries = 2, backoff = 0.01)
+        self.assertEqual(self.n_requests(GAME_FAILING), 3)
+
+    def test_download_games_reports_failures(self):
+        feeds = {}
+        downloaded, failed = download_games([GAME_FAILING, GAME_OK, GAME_RATE_LIMITED], feeds.__setitem__, concurrency = 3, rate = 100,
+                                            retries = 1, backoff = 0.01, base_url = self.base_url, path_archive = None)
+        self.assertEqual(downloaded, [GAME_OK, GAME_RATE_LIMITED])
+        self.assertEqual(feeds, {GAME_OK: {'gamePk': int(GAME_OK)}, GAME_RATE_LIMITED: {'gamePk': int(GAME_RATE_LIMITED)}})
+        self.assertEqual(failed, [GAME_FAILING])
+
+
+if __name__ == "__main__":
+    unittest.main()
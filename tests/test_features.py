@@ -0,0 +1,154 @@
+"""
+Tests of the shared feature code (features.py) on small synthetic dbs: baselines, the
+point-in-time lookup, and the same features at training (build_ml_dataset.py) and
+prediction time (predict_game_outcomes.py, prediction_server.py). Run from the repo root with
+
+    python -m pytest tests
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+import os
+import pandas as pd
+import numpy as np
+
+from scripts.helper import create_database_connection, write_dataframe
+from scripts.process_feed_data import process_season_feed_data
+from scripts.features import BASELINE_STATS, compute_previous_season_baselines, impute_missing_baselines, materialize_team_baselines, \
+    load_team_state, compute_point_in_time_features, weight_season_stats
+from scripts.build_ml_dataset import build_season_features
+from scripts.predict_game_outcomes import compute_schedule_features, compute_game_features
+from scripts.prediction_server import TeamStateStore
+from benchmarks.synthetic import create_synthetic_db, generate_boxscore_season
+
+SEASONS = [2010, 2011]
+EXPANSION_FRANCHISE_ID = 99
+
+## FUNCTIONS ##
+
+def compute_point_in_time_features_reference(df_queries, df_state, df_baselines):
+
+    """
+    Straightforward merge_asof version of compute_point_in_time_features, to check it against.
+    """
+
+    after_cols = ['games_played_after'] + [f'{stat}_after' for stat in BASELINE_STATS]
+    df_left = df_queries.assign(row = range(df_queries.shape[0]), datetime = pd.to_datetime(df_queries['datetime'], utc = True))
+    df_right = df_state.assign(datetime = pd.to_datetime(df_state['datetime'], utc = True))
+    df_totals = pd.merge_asof(df_left.sort_values('datetime'), df_right.sort_values('datetime'), on = 'datetime',
+                              by = ['franchise_id', 'season'], allow_exact_matches = False)
+    df_totals[after_cols] = df_totals[after_cols].fillna(0)
+    df_totals = pd.merge(df_totals, df_baselines, on = ['season', 'franchise_id'], how = 'left').sort_values('row')
+
+    return pd.DataFrame({f'{stat}_per_game': weight_season_stats(df_totals, f'previous_{stat}_per_game', f'{stat}_after',
+                                                                 'games_played_after', 10).values
+                         for stat in BASELINE_STATS}, index = df_queries.index)
+
+class TestBaselines(unittest.TestCase):
+
+    def setUp(self):
+        ## queries and the team state snapshot are read and written relative to the working directory
+        self.cwd = os.getcwd()
+        self.tmp = TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.symlink(Path(self.cwd)/'queries', 'queries')
+        self.conn, self.cursor = create_database_connection(Path(self.tmp.name)/'nhl.db')
+        create_synthetic_db(self.conn, self.cursor, SEASONS, n_teams = 6, games_per_team = 10)
+
+    def tearDown(self):
+        self.conn.close()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_expansion_team_with_only_road_games_is_imputed(self):
+        ## an expansion team whose only processed game so far is on the road
+        df_game = generate_boxscore_season(SEASONS[-1], n_teams = 6, games_per_team = 10).tail(1)
+        df_game = df_game.assign(game_id = f'{SEASONS[-1]}029999', datetime = f'{SEASONS[-1] + 1}-04-01T00:00:00Z',
+                                 away_id = EXPANSION_FRANCHISE_ID, away_franchise_id = EXPANSION_FRANCHISE_ID)
+        write_dataframe(df_game, 'boxscore', self.cursor)
+        for season in SEASONS:
+            process_season_feed_data(season, self.conn, self.cursor)
+
+        df_baselines = compute_previous_season_baselines(self.conn)
+        row = df_baselines[(df_baselines['season'] == SEASONS[-1]) & (df_baselines['franchise_id'] == EXPANSION_FRANCHISE_ID)]
+        self.assertEqual(row.shape[0], 1)
+        self.assertFalse(row.isna().any(axis = None))
+
+    def test_impute_missing_baselines(self):
+        baseline_cols = [f'previous_{stat}_per_game' for stat in BASELINE_STATS]
+        df_baselines = pd.DataFrame({'season': [2011, 2011], 'franchise_id': [1, 2],
+                                     **{col: [0.25, 0.75] for col in baseline_cols}})
+        df_queries = pd.DataFrame({'season': [2011, 2011, 2010], 'franchise_id': [1, EXPANSION_FRANCHISE_ID, 1]})
+
+        df_imputed = impute_missing_baselines(df_baselines, df_queries)
+        row = df_imputed[df_imputed['franchise_id'] == EXPANSION_FRANCHISE_ID]
+        self.assertEqual(df_imputed.shape[0], 3) ## nothing to impute from in 2010
+        self.assertEqual(row['season'].tolist(), [2011])
+        self.assertEqual(row[baseline_cols].values.tolist(), [[0.5] * len(baseline_cols)])
+
+class TestPointInTimeFeatures(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.symlink(Path(self.cwd)/'queries', 'queries')
+        self.path_db = Path(self.tmp.name)/'nhl.db'
+        conn, cursor = create_database_connection(self.path_db)
+        create_synthetic_db(conn, cursor, SEASONS, n_teams = 6, games_per_team = 10)
+        for season in SEASONS:
+            process_season_feed_data(season, conn, cursor)
+        self.df_baselines = materialize_team_baselines(conn, cursor)
+        self.df_state = load_team_state(conn, SEASONS)
+        conn.close()
+
+        ## every team (and one unknown franchise) at random times, including exact game times
+        rng = np.random.default_rng(0)
+        datetimes = np.concatenate([self.df_state['datetime'].sample(20, random_state = 0).to_numpy(),
+                                    pd.date_range(f'{SEASONS[0]}-09-01', f'{SEASONS[-1] + 1}-06-01', periods = 20, tz = 'UTC').strftime('%Y-%m-%dT%H:%M:%SZ')])
+        self.df_queries = pd.DataFrame({'franchise_id': rng.choice([1, 2, 3, 4, 5, 6, EXPANSION_FRANCHISE_ID], datetimes.shape[0]),
+                                        'season': [int(day[:4]) if int(day[5:7]) >= 9 else int(day[:4]) - 1 for day in datetimes],
+                                        'datetime': datetimes})
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_matches_reference(self):
+        pd.testing.assert_frame_equal(compute_point_in_time_features(self.df_queries, self.df_state, self.df_baselines),
+                                      compute_point_in_time_features_reference(self.df_queries, self.df_state, self.df_baselines))
+
+    def test_prediction_server_matches(self):
+        df_games = pd.DataFrame({'home_franchise_id': self.df_queries['franchise_id'], 'away_franchise_id': self.df_queries['franchise_id'][::-1].values,
+                                 'season': self.df_queries['season'], 'datetime': pd.to_datetime(self.df_queries['datetime'], utc = True)})
+        df_features = TeamStateStore(self.path_db).compute_features(df_games)
+
+        df_home = compute_point_in_time_features(self.df_queries, self.df_state, self.df_baselines)
+        np.testing.assert_array_equal(df_features['wins_per_game_home'].to_numpy(), df_home['wins_per_game'].to_numpy())
+
+    def test_prediction_features_match_build_features(self):
+        conn, cursor = create_database_connection(self.path_db)
+        df_build = build_season_features(SEASONS[-1], conn, self.df_baselines)
+        feature_cols = [col for col in df_build.columns if col.endswith(('_per_game_home', '_per_game_away'))]
+
+        ## the season's games as a prediction schedule, each featurized as of its own start time
+        df_games = df_build[['game_id', 'season', 'datetime']].assign(home_id = df_build['home_franchise_id'], away_id = df_build['away_franchise_id'])
+        df_schedule = compute_schedule_features(df_games, conn)
+        pd.testing.assert_frame_equal(df_schedule[feature_cols], df_build[feature_cols].reset_index(drop = True), check_exact = True)
+
+        ## and a single game as of its start time, as predicted on the day
+        df_game = compute_game_features(df_games.iloc[[-1]], SEASONS[-1], df_games['datetime'].iloc[-1], conn)
+        pd.testing.assert_frame_equal(df_game[feature_cols], df_build[feature_cols].iloc[[-1]].reset_index(drop = True), check_exact = True)
+        conn.close()
+
+    def test_empty_state_and_baselines(self):
+        df_features = compute_point_in_time_features(self.df_queries, self.df_state.iloc[:0], self.df_baselines.iloc[:0])
+        self.assertEqual(df_features.shape, (self.df_queries.shape[0], len(BASELINE_STATS)))
+        self.assertTrue(df_features.isna().all(axis = None))
+
+
+if __name__ == "__main__":
+    unittest.main()
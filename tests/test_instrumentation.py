@@ -0,0 +1,82 @@
+"""
+Tests that the run report of a season-parallel rebuild (process_seasons_parallel and
+build_seasons_parallel) records the same counters and span calls as a serial rebuild,
+with the workers' spans and counters merged into the parent exactly once. Run from the
+repo root with
+
+    python -m pytest tests
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+import os
+
+from scripts.helper import create_database_connection
+from scripts.instrumentation import span, start_run, get_report
+from scripts.process_feed_data import process_season_feed_data, process_seasons_parallel
+from scripts.features import materialize_team_baselines
+from scripts.build_ml_dataset import build_season_features, write_season_features, build_seasons_parallel
+from benchmarks.synthetic import create_synthetic_db
+
+SEASONS = [2010, 2011, 2012]
+
+## FUNCTIONS ##
+
+def rebuild(path_db, workers):
+
+    """
+    Processes and builds every season of a fresh synthetic db, serially or in worker
+    processes, returning the run report.
+    """
+
+    conn, cursor = create_database_connection(path_db)
+    create_synthetic_db(conn, cursor, SEASONS, n_teams = 6, games_per_team = 10)
+
+    start_run('test')
+    if workers == 1:
+        for season in SEASONS:
+            process_season_feed_data(season, conn, cursor)
+    else:
+        process_seasons_parallel(SEASONS, conn, cursor, path_db, workers, full = True)
+
+    df_baselines = materialize_team_baselines(conn, cursor)
+    if workers == 1:
+        for season in SEASONS[1:]:
+            df = build_season_features(season, conn, df_baselines)
+            with span('build.write'): ## as in build_ml_dataset.py
+                write_season_features(df, season, conn, cursor)
+    else:
+        build_seasons_parallel(SEASONS[1:], conn, cursor, df_baselines, path_db, workers)
+
+    report = get_report()
+    conn.close()
+
+    return report
+
+class TestParallelReport(unittest.TestCase):
+
+    def setUp(self):
+        ## queries and the team state snapshot are read and written relative to the working directory
+        self.cwd = os.getcwd()
+        self.tmp = TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.symlink(Path(self.cwd)/'queries', 'queries')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_parallel_report_matches_serial(self):
+        report_serial = rebuild(Path(self.tmp.name)/'serial.db', workers = 1)
+        report_parallel = rebuild(Path(self.tmp.name)/'parallel.db', workers = 2)
+
+        self.assertEqual(report_parallel['counters'], report_serial['counters'])
+        self.assertEqual({name: stats['calls'] for name, stats in report_parallel['spans'].items()},
+                         {name: stats['calls'] for name, stats in report_serial['spans'].items()})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+Tests of the schedule and team index handling of predict_game_outcomes.py, without the
+live api. Run from the repo root with
+
+    python -m pytest tests
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+import sqlite3
+import json
+
+from scripts.predict_game_outcomes import load_team_index, extract_schedule_games
+
+CURRENT_TEAMS = {52: 36, 6: 6} ## Winnipeg and Boston, as listed by the teams endpoint
+ATLANTA_ID, ATLANTA_FRANCHISE_ID = 11, 35 ## no longer listed by the teams endpoint
+
+## FUNCTIONS ##
+
+def create_schedule(games):
+
+    """
+    Creates a single-day schedule dict of (game id, home team id, away team id) games.
+    """
+
+    return {'dates': [{'date': '2010-10-09',
+                       'games': [{'gamePk': game_id, 'gameDate': '2010-10-09T23:00:00Z',
+                                  'teams': {side: {'team': {'id': team_id, 'name': f'Team {team_id}'}}
+                                            for side, team_id in [('home', home_id), ('away', away_id)]}}
+                                 for game_id, home_id, away_id in games]}]}
+
+class TestTeamIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.path_index = Path(self.tmp.name)/'team_franchise_ids.json'
+        with open(self.path_index, 'w') as f:
+            json.dump(CURRENT_TEAMS, f)
+
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE boxscore (home_id INTEGER, home_franchise_id INTEGER, away_id INTEGER, away_franchise_id INTEGER)')
+        self.conn.execute('INSERT INTO boxscore VALUES (?, ?, ?, ?)', (6, 6, ATLANTA_ID, ATLANTA_FRANCHISE_ID))
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp.cleanup()
+
+    def test_past_teams_come_from_the_boxscore_table(self):
+        ## a fresh index that lacks a team would otherwise be re-downloaded
+        team_franchise_ids = load_team_index([ATLANTA_ID, 6], path = self.path_index, conn = self.conn)
+        self.assertEqual(team_franchise_ids[ATLANTA_ID], ATLANTA_FRANCHISE_ID)
+        self.assertEqual(team_franchise_ids[52], 36)
+
+    def test_games_of_unknown_teams_are_skipped(self):
+        schedule = create_schedule([(2010020001, 6, 52), (2010020002, ATLANTA_ID, 6)])
+        df_games = extract_schedule_games([schedule], CURRENT_TEAMS)
+        self.assertEqual(df_games['game_id'].tolist(), ['2010020001'])
+        self.assertEqual(df_games[['home_id', 'away_id']].values.tolist(), [[6, 36]])
+
+
+if __name__ == "__main__":
+    unittest.main()
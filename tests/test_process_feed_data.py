@@ -0,0 +1,158 @@
+"""
+Tests of process_feed_data.py on synthetic seasons: the vectorized cumulative stats match
+the original per-team computation, and incremental processing of new games leaves the db
+as a full reprocess would. Run from the repo root with
+
+    python -m pytest tests
+"""
+
+## SETUP ##
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+import os
+import re
+import pandas as pd
+import numpy as np
+
+from scripts.helper import create_database_connection, execute_query, write_dataframe
+from scripts.process_feed_data import PATH_QUERIES, STATS_TO_PROCESS, compute_team_game_stats, add_season_stats, \
+    process_season_feed_data, process_season_feed_data_incremental
+from benchmarks.synthetic import generate_boxscore_season
+
+SEASON = 2010
+
+## FUNCTIONS ##
+
+def compute_season_stats_per_team(df_season):
+
+    """
+    The original per-team loop: each team's games in date order, with its stats for and
+    against cumulated one team at a time, and the as-of-start stats written back per game.
+
+    :param df_season: dataframe containing raw feed data for each game of a season
+    :return: tuple with the team results (one row per team per game) and df_season with the season stat columns
+    """
+
+    df_season = df_season.copy()
+    team_results = []
+    for team in df_season['home_franchise_id'].unique():
+        df_team = df_season[(df_season['home_franchise_id'] == team) | (df_season['away_franchise_id'] == team)]
+        df_team = df_team.sort_values('datetime').reset_index(drop = True)
+        home_bool = df_team['home_franchise_id'] == team
+
+        df_results = df_team[['game_id', 'datetime', 'season']].copy()
+        df_results['franchise_id'] = team
+        df_results['games_played_before'] = np.arange(df_results.shape[0])
+        df_results['games_played_after'] = df_results['games_played_before'] + 1
+        df_results['win'] = np.where(home_bool, df_team['winner'] == 'home', df_team['winner'] == 'away').astype('int')
+        df_results['wins_after'] = df_results['win'].cumsum()
+        df_results['wins_before'] = df_results['wins_after'] - df_results['win']
+        df_results['losses_before'] = df_results['games_played_before'] - df_results['wins_before']
+        df_results['losses_after'] = df_results['games_played_after'] - df_results['wins_after']
+        for stat in STATS_TO_PROCESS:
+            df_results[f'{stat}_for'] = np.where(home_bool, df_team[f'home_{stat}'], df_team[f'away_{stat}'])
+            df_results[f'{stat}_against'] = np.where(home_bool, df_team[f'away_{stat}'], df_team[f'home_{stat}'])
+            df_results[f'{stat}_for_after'] = df_results[f'{stat}_for'].cumsum()
+            df_results[f'{stat}_against_after'] = df_results[f'{stat}_against'].cumsum()
+            df_results[f'{stat}_for_before'] = df_results[f'{stat}_for_after'] - df_results[f'{stat}_for']
+            df_results[f'{stat}_against_before'] = df_results[f'{stat}_against_after'] - df_results[f'{stat}_against']
+        team_results.append(df_results)
+
+        for stat in [re.sub('_before', '', col) for col in df_results.columns if '_before' in col]:
+            for side, is_side in [('home', home_bool), ('away', ~home_bool)]:
+                if f'{side}_season_{stat}' not in df_season.columns:
+                    df_season[f'{side}_season_{stat}'] = np.nan
+                df_season.loc[df_season['game_id'].isin(df_team.loc[is_side, 'game_id']), f'{side}_season_{stat}'] = df_results.loc[is_side, f'{stat}_before'].values
+
+    return pd.concat(team_results, ignore_index = True), df_season
+
+def read_processed_tables(conn):
+
+    """
+    Reads the tables written by processing, in a fixed row order.
+    """
+
+    return {table: pd.read_sql_query(f'SELECT * FROM {table} ORDER BY {order}', conn)
+            for table, order in [('boxscore_processed', 'game_id'), ('boxscore_processed_team', 'franchise_id, game_id'),
+                                 ('processing_state', 'season')]}
+
+class TestTeamGameStats(unittest.TestCase):
+
+    def setUp(self):
+        self.df_season = generate_boxscore_season(SEASON, n_teams = 8, games_per_team = 20)
+
+    def test_team_results_match_per_team_loop(self):
+        df_expected, _ = compute_season_stats_per_team(self.df_season)
+        df_results = compute_team_game_stats(self.df_season).drop(columns = 'is_home')
+
+        df_expected = df_expected.sort_values(['franchise_id', 'datetime']).reset_index(drop = True)
+        self.assertEqual(set(df_results.columns), set(df_expected.columns))
+        pd.testing.assert_frame_equal(df_results, df_expected[df_results.columns], check_dtype = False, rtol = 0, atol = 0)
+
+    def test_season_stats_match_per_team_loop(self):
+        _, df_expected = compute_season_stats_per_team(self.df_season)
+        df_season = add_season_stats(self.df_season, compute_team_game_stats(self.df_season))
+
+        self.assertEqual(list(df_season.columns), list(df_expected.columns))
+        pd.testing.assert_frame_equal(df_season, df_expected, check_dtype = False, rtol = 0, atol = 0)
+
+class TestIncrementalProcessing(unittest.TestCase):
+
+    def setUp(self):
+        ## queries and the team state snapshot are read and written relative to the working directory
+        self.cwd = os.getcwd()
+        self.tmp = TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.symlink(Path(self.cwd)/'queries', 'queries')
+        self.df_season = generate_boxscore_season(SEASON, n_teams = 8, games_per_team = 20)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def create_db(self, name):
+        conn, cursor = create_database_connection(Path(self.tmp.name)/f'{name}.db')
+        execute_query(PATH_QUERIES/'create_table_boxscore', cursor)
+
+        return conn, cursor
+
+    def assert_matches_full_reprocess(self, batches):
+
+        """
+        Adds each batch of games to a fresh db in turn, processing incrementally after each, and
+        checks the processed tables against a full reprocess of all the games.
+        """
+
+        conn, cursor = self.create_db('incremental')
+        for df_batch in batches:
+            write_dataframe(df_batch, 'boxscore', cursor)
+            conn.commit()
+            process_season_feed_data_incremental(SEASON, conn, cursor)
+        tables_incremental = read_processed_tables(conn)
+        conn.close()
+
+        conn, cursor = self.create_db('full')
+        write_dataframe(self.df_season, 'boxscore', cursor)
+        conn.commit()
+        process_season_feed_data(SEASON, conn, cursor)
+        tables_full = read_processed_tables(conn)
+        conn.close()
+
+        for table in tables_full:
+            self.assertGreater(tables_full[table].shape[0], 0)
+            pd.testing.assert_frame_equal(tables_incremental[table], tables_full[table], check_exact = True)
+
+    def test_new_games_in_batches(self):
+        n_games = self.df_season.shape[0]
+        self.assert_matches_full_reprocess([self.df_season.iloc[:n_games // 2], self.df_season.iloc[n_games // 2:3 * n_games // 4],
+                                            self.df_season.iloc[3 * n_games // 4:]])
+
+    def test_late_game_before_the_high_water_mark(self):
+        is_late = self.df_season.index == self.df_season.shape[0] // 4
+        self.assert_matches_full_reprocess([self.df_season[~is_late], self.df_season[is_late]])
+
+
+if __name__ == "__main__":
+    unittest.main()